@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+benchmark.py
+
+   Synthetic large-pool benchmarks of the node pool and poller
+
+      Generates raw-nodes files and databases of --sizes nodes, then runs
+      every stage in its own process and reports, as JSON:
+         wall and cpu time, peak RSS, database statements and rows,
+         ping/ssh forks.
+
+      Stages:
+         merge    raw-nodes file into a database that only holds DNS entries
+         remerge  raw-nodes file with 10% new, 10% removed and 10%
+                  re-authored nodes into a populated database
+         update   flush a state change of every node
+         status   pool status aggregates
+         dbstatus `deploypl status` queries counted by the database
+                  (PLNodeStatus), when no daemon runs
+         control  `deploypl status` queries answered by the daemon over
+                  its control socket
+         poll     PLPoller.poll() of --poll-nodes nodes, with the fake ping
+                  and ssh from fakebin/ (see their headers for the
+                  latency/failure knobs)
+
+      ./benchmarks/benchmark.py --sizes 1000 10000 -o results.json
+
+@author: K.Edeline
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import tempfile
+import argparse
+import resource
+import subprocess
+
+from datetime import datetime
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHDIR))
+
+STAGES = ["merge", "remerge", "update", "status", "dbstatus", "control",
+          "poll"]
+
+class BenchDaemon(object):
+   """
+   BenchDaemon
+
+      the daemon interface used by the node pool, logs to stderr
+   """
+   sshkeyloc = None
+
+   def __init__(self, verbose=False):
+      self.verbose = verbose
+
+   def _log(self, msg):
+      if self.verbose:
+         sys.stderr.write(msg+"\n")
+
+   debug = info = warn = _log
+
+   def error(self, msg):
+      sys.stderr.write(msg+"\n")
+
+   def root(self):
+      pass
+
+   def drop_privileges(self):
+      pass
+
+def node_name(i):
+   return "node{}.site{}.example.org".format(i, i // 4)
+
+def node_addr(i):
+   return "10.{}.{}.{}".format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff)
+
+def write_raw(path, nodes):
+   """
+   write a raw-nodes file of (index, authority) nodes,
+   one out of twenty is not in boot state
+   """
+   with open(path, 'w') as f:
+      for i, auth in nodes:
+         state = "boot" if i % 20 else "disabled"
+         f.write("{}\t{}\t{}\t\t\n".format(node_name(i), auth, state))
+
+def copy_db(src, dst):
+   """
+   copy a WAL database
+   """
+   conn = sqlite3.connect(src)
+   conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+   conn.close()
+   shutil.copyfile(src, dst)
+
+def prepare(workdir, size):
+   """
+   generate raw-nodes files and databases of size nodes in workdir
+   """
+   from deployer.node import PLNodePool, PLDNSEntry, session_scope
+   import deployer.scheduler
+
+   daemon = BenchDaemon()
+   nodes  = [(i, "PLE" if i % 3 else "PLC") for i in range(size)]
+   write_raw(os.path.join(workdir, "raw-nodes.txt"), nodes)
+
+   # 10% removed, 10% new, 10% authority changes
+   step     = 10
+   modified = [(i, auth) for i, auth in nodes if i % step != 0]
+   modified = [(i, "PLC" if i % step == 1 else auth) for i, auth in modified]
+   modified += [(size + i, "PLE") for i in range(size // step)]
+   write_raw(os.path.join(workdir, "raw-nodes-modified.txt"), modified)
+
+   # DNS entries of all nodes, so that no lookup is performed
+   dns_loc = os.path.join(workdir, "dns.sqlite")
+   now     = datetime.utcnow()
+   with session_scope(daemon, dns_loc) as session:
+      session.execute(PLDNSEntry.__table__.insert(),
+               [{"name": node_name(i), "addr": node_addr(i),
+                 "ttl": 86400, "resolved_at": now, "failures": 0}
+                     for i in range(size + size // step)])
+
+   db_loc = os.path.join(workdir, "nodes.sqlite")
+   copy_db(dns_loc, db_loc)
+   PLNodePool(daemon, rawfile=os.path.join(workdir, "raw-nodes.txt"),
+              db_loc=db_loc)
+
+def run_stage(stage, workdir, args):
+   """
+   set up and run stage in this process
+
+   @return stage measurements dictionary
+   """
+   from sqlalchemy import event
+   from deployer.node import PLNodePool, PLNodeState, PLNodeStatus, get_engine
+   from deployer.poller import PLPoller
+   from deployer.control import PLControlServer, PLControlClient
+
+   daemon = BenchDaemon(verbose=args.verbose)
+   db_loc = os.path.join(workdir, "stage.sqlite")
+   copy_db(os.path.join(workdir,
+               "dns.sqlite" if stage == "merge" else "nodes.sqlite"), db_loc)
+
+   ## setup
+   pool, server = None, None
+   if stage in ["update", "status"]:
+      pool = PLNodePool(daemon, db_loc=db_loc)
+   elif stage == "dbstatus":
+      pool = PLNodeStatus(daemon, db_loc=db_loc)
+   elif stage == "control":
+      pool   = PLNodePool(daemon, db_loc=db_loc)
+      server = PLControlServer(os.path.join(workdir, "control.sock"), pool)
+      server.start()
+      client = PLControlClient(server.path)
+   elif stage == "poll":
+      pool = PLPoller(daemon, plslice="bench", user="bench", db_loc=db_loc,
+                      threadlimit=args.ping_limit, sshlimit=args.ssh_limit)
+   rawfile = os.path.join(workdir, "raw-nodes-modified.txt"
+                            if stage == "remerge" else "raw-nodes.txt")
+
+   ## measure
+   db = {"statements": 0, "rows": 0}
+   def count(conn, cursor, statement, parameters, context, executemany):
+      db["statements"] += 1
+      db["rows"]       += len(parameters) if executemany else 1
+   event.listen(get_engine(db_loc)[0], "before_cursor_execute", count)
+
+   forks     = os.environ["BENCH_FORKS"]
+   rss_setup = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+   usage     = resource.getrusage(resource.RUSAGE_SELF)
+   start     = time.perf_counter()
+
+   if stage in ["merge", "remerge"]:
+      pool = PLNodePool(daemon, rawfile=rawfile, db_loc=db_loc)
+   elif stage == "update":
+      for node in pool.pool:
+         pool._update_node(node, {"state": PLNodeState.reachable})
+      pool.update()
+   elif stage == "status":
+      pool.status(string=True)
+      pool.status(min_state=PLNodeState.reachable)
+   elif stage in ["dbstatus", "control"]:
+      # deploypl status -vv, -v, and default
+      status = client if stage == "control" else pool
+      status.status(string=True)
+      status.status(min_state=PLNodeState.usable, string=True)
+      status._get("addr", min_state=PLNodeState.usable)
+   elif stage == "poll":
+      pool.poll(nodes=pool.pool[:args.poll_nodes])
+
+   wall   = time.perf_counter() - start
+   after  = resource.getrusage(resource.RUSAGE_SELF)
+   with open(forks) as f:
+      binaries = f.read().split()
+   if server is not None:
+      server.stop()
+   if stage == "dbstatus":
+      nodes = sum(n for _, n in pool.status()["state"])
+   else:
+      nodes = len(pool.pool)
+
+   return {"stage"         : stage,
+           "nodes"         : nodes,
+           "wall_s"        : round(wall, 6),
+           "cpu_s"         : round(after.ru_utime - usage.ru_utime
+                                 + after.ru_stime - usage.ru_stime, 6),
+           "rss_setup_kb"  : rss_setup,
+           "rss_peak_kb"   : after.ru_maxrss,
+           "db_statements" : db["statements"],
+           "db_rows"       : db["rows"],
+           "forks"         : {b : binaries.count(b) for b in ["ping", "ssh"]},
+          }
+
+def run(args):
+   """
+   run every stage of every size in a child process
+
+   @return results dictionary
+   """
+   env = dict(os.environ)
+   env["PATH"] = os.path.join(BENCHDIR, "fakebin") + os.pathsep + env["PATH"]
+   env.update({"BENCH_PING_LATENCY" : str(args.ping_latency),
+               "BENCH_PING_LOSS"    : str(args.ping_loss),
+               "BENCH_SSH_LATENCY"  : str(args.ssh_latency),
+               "BENCH_SSH_FAIL"     : str(args.ssh_fail)})
+
+   results = []
+   for size in args.sizes:
+      workdir = tempfile.mkdtemp(prefix="deploypl-bench-")
+      try:
+         start = time.perf_counter()
+         prepare(workdir, size)
+         sys.stderr.write("{} nodes: generated in {:.1f}s\n".format(size,
+                                                time.perf_counter() - start))
+         for stage in args.stages:
+            env["BENCH_FORKS"] = os.path.join(workdir, stage+".forks")
+            open(env["BENCH_FORKS"], 'w').close()
+            cmd = [sys.executable, os.path.abspath(__file__),
+                   "--stage", stage, "--workdir", workdir] + sys.argv[1:]
+            child = subprocess.run(cmd, env=env, stdout=subprocess.PIPE,
+                                   check=True)
+            result = json.loads(child.stdout.decode('utf8'))
+            result["size"] = size
+            results.append(result)
+            sys.stderr.write("{} nodes: {} {:.3f}s\n".format(size, stage,
+                                                         result["wall_s"]))
+      finally:
+         shutil.rmtree(workdir)
+
+   return {"date"    : datetime.utcnow().isoformat(),
+           "python"  : sys.version.split()[0],
+           "revision": revision(),
+           "params"  : {k: v for k, v in vars(args).items()
+                           if k not in ["stage", "workdir", "output"]},
+           "results" : results}
+
+def revision():
+   try:
+      return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                  cwd=BENCHDIR, stderr=subprocess.DEVNULL).decode().strip()
+   except (OSError, subprocess.CalledProcessError):
+      return None
+
+def parse_args():
+   parser = argparse.ArgumentParser(description='deploypl benchmarks')
+   parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                       default=[1000, 10000, 100000],
+                       help='node pool sizes')
+   parser.add_argument('-S', '--stages', nargs='+', choices=STAGES,
+                       default=STAGES, help='stages to run')
+   parser.add_argument('-o', '--output', type=str, default=None,
+                       help='JSON results file, defaults to stdout')
+   parser.add_argument('--poll-nodes', type=int, default=1000,
+                       help='number of nodes probed by the poll stage')
+   parser.add_argument('--ping-limit', type=int, default=100,
+                       help='concurrent pings')
+   parser.add_argument('--ssh-limit', type=int, default=50,
+                       help='concurrent ssh sessions per stage')
+   parser.add_argument('--ping-latency', type=float, default=0.05,
+                       help='mean fake ping latency (s)')
+   parser.add_argument('--ping-loss', type=float, default=0.1,
+                       help='fraction of unreachable hosts')
+   parser.add_argument('--ssh-latency', type=float, default=0.1,
+                       help='mean fake ssh session time (s)')
+   parser.add_argument('--ssh-fail', type=float, default=0.1,
+                       help='fraction of reachable hosts refusing ssh')
+   parser.add_argument('-v', '--verbose', action='store_true',
+                       help='log pool messages to stderr')
+   ## child process
+   parser.add_argument('--stage', choices=STAGES, help=argparse.SUPPRESS)
+   parser.add_argument('--workdir', help=argparse.SUPPRESS)
+   return parser.parse_args()
+
+def main():
+   args = parse_args()
+   if args.stage:
+      json.dump(run_stage(args.stage, args.workdir, args), sys.stdout)
+      return 0
+
+   results = run(args)
+   if args.output:
+      with open(args.output, 'w') as f:
+         json.dump(results, f, indent=2)
+   else:
+      json.dump(results, sys.stdout, indent=2)
+      sys.stdout.write("\n")
+   return 0
+
+if __name__ == "__main__":
+   sys.exit(main())
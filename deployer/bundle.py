@@ -0,0 +1,225 @@
+"""
+bundle.py
+
+   Cache of compressed bundles of local directories
+
+      A bundle is the tar.gz of local directories and files laid out as
+      `scp -r localdirs remotedir` would copy them, named after the hash
+      of their content, so that it is compressed once and the same bytes
+      are streamed to every host:
+
+         upload(hosts, user, localdirs, remotedir, cache=cache)
+
+      Least recently used bundles are evicted when the cache grows over
+      its size limit.
+
+      Bundles are sent as they are to nodes, so the cache directory must
+      be private: owned by the daemon user with mode 0700. Each bundle has
+      a <bundle>.sha1 file, checked before the bundle is reused.
+
+@author: K.Edeline
+"""
+import os
+import stat
+import shutil
+import hashlib
+import tarfile
+import tempfile
+
+from deployer.sync import scan_manifest, manifest_digest, file_entry
+from deployer.sync import _file_digest
+
+## bumped when the bundle layout changes
+BUNDLE_VERSION = 1
+
+class PLBundleCache(object):
+   """
+   PLBundleCache
+
+      cache = PLBundleCache("/var/cache/deploypl")
+      path  = cache.get(["/home/user/exp"])
+   """
+
+   def __init__(self, cachedir=None, maxsize=1 << 30):
+      """
+      @param cachedir cache directory, created if needed. Defaults to a 
+                      temporary directory removed by close()
+      """
+      self.maxsize  = maxsize
+      ## local path -> (size, mtime, digest), see file_entry()
+      self._stats   = {}
+      ## bundle path -> (size, mtime_ns) when its digest was last checked
+      self._checked = {}
+
+      self._temporary = cachedir is None
+      if self._temporary:
+         cachedir = tempfile.mkdtemp(prefix="deploypl-bundles-")
+      else:
+         os.makedirs(cachedir, mode=0o700, exist_ok=True)
+      self.cachedir = cachedir
+      self._check_dir()
+
+   def _check_dir(self):
+      """
+      refuse a cache directory that others could write bundles to
+      """
+      st = os.lstat(self.cachedir)
+      if not stat.S_ISDIR(st.st_mode):
+         raise PLBundleCacheException("{} is not a directory".format(
+                                      self.cachedir))
+      if st.st_uid != os.geteuid():
+         raise PLBundleCacheException("{} is not owned by uid {}".format(
+                                      self.cachedir, os.geteuid()))
+      if st.st_mode & 0o077:
+         raise PLBundleCacheException("{} has mode {:o}, not 700".format(
+                                      self.cachedir, st.st_mode & 0o777))
+
+   def close(self):
+      """
+      remove the cache directory if it is temporary
+      """
+      if self._temporary:
+         shutil.rmtree(self.cachedir, ignore_errors=True)
+
+   def _manifests(self, localdirs):
+      """
+      @return [(local path, arcname, manifest)], the manifest of a file
+              has a single "" path
+      """
+      entries = []
+      for localdir in localdirs:
+         localdir = os.path.normpath(localdir)
+         arcname  = os.path.basename(localdir)
+         st       = os.stat(localdir)
+         if stat.S_ISDIR(st.st_mode):
+            manifest = scan_manifest(localdir, stats=self._stats)
+         else:
+            manifest = {"" : file_entry(localdir, st, stats=self._stats)}
+         entries.append((localdir, arcname, manifest))
+      return entries
+
+   def key(self, localdirs):
+      """
+      @return the content hash of localdirs
+      """
+      return self._key(self._manifests(localdirs))
+
+   def _key(self, entries):
+      sha1 = hashlib.sha1("{}\n".format(BUNDLE_VERSION).encode('utf8'))
+      for _, arcname, manifest in entries:
+         sha1.update("{}\0{}\n".format(arcname,
+                                 manifest_digest(manifest)).encode('utf8'))
+      return sha1.hexdigest()
+
+   def path(self, key):
+      return os.path.join(self.cachedir, "{}.tar.gz".format(key))
+
+   def get(self, localdirs):
+      """
+      @return the path of the bundle of localdirs, built if it is not
+              in cache
+      """
+      entries = self._manifests(localdirs)
+      path    = self.path(self._key(entries))
+      if self._valid(path):
+         # last use time, for eviction
+         os.utime(path)
+         st = os.stat(path)
+         self._checked[path] = (st.st_size, st.st_mtime_ns)
+         return path
+
+      tmp = "{}.{}.tmp".format(path, os.getpid())
+      try:
+         self._write(entries, tmp)
+         digest = _file_digest(tmp)
+         with open(tmp+".sha1", 'w') as f:
+            f.write(digest+"\n")
+         os.replace(tmp, path)
+         os.replace(tmp+".sha1", path+".sha1")
+      finally:
+         for leftover in [tmp, tmp+".sha1"]:
+            if os.path.exists(leftover):
+               os.remove(leftover)
+      st = os.stat(path)
+      self._checked[path] = (st.st_size, st.st_mtime_ns)
+      self.evict(keep=path)
+      return path
+
+   def _valid(self, path):
+      """
+      @return True if bundle path exists and matches its digest. It is
+              hashed again only if it changed since it was last checked
+      """
+      try:
+         st = os.stat(path)
+      except OSError:
+         return False
+      if self._checked.get(path) == (st.st_size, st.st_mtime_ns):
+         return True
+      try:
+         with open(path+".sha1") as f:
+            valid = f.read().strip() == _file_digest(path)
+      except OSError:
+         valid = False
+      if not valid:
+         # corrupted or left by an interrupted write, rebuilt
+         self._remove(path)
+      return valid
+
+   def _remove(self, path):
+      self._checked.pop(path, None)
+      for name in [path, path+".sha1"]:
+         try:
+            os.remove(name)
+         except OSError:
+            pass
+
+   def _write(self, entries, bundle):
+      def reset(info):
+         info.uid = info.gid = 0
+         info.uname = info.gname = ""
+         return info
+
+      with tarfile.open(bundle, "w:gz") as tar:
+         for localdir, arcname, manifest in entries:
+            for path in sorted(manifest):
+               tar.add(os.path.join(localdir, path) if path else localdir,
+                       arcname=os.path.join(arcname, path).rstrip("/"),
+                       recursive=False, filter=reset)
+
+   def evict(self, keep=None):
+      """
+      Remove least recently used bundles until the cache fits maxsize
+
+      @param keep bundle never removed
+      """
+      bundles = []
+      for name in os.listdir(self.cachedir):
+         if not name.endswith(".tar.gz"):
+            continue
+         path = os.path.join(self.cachedir, name)
+         try:
+            st = os.stat(path)
+         except OSError:
+            continue
+         bundles.append((st.st_mtime, st.st_size, path))
+
+      total = sum(size for _, size, _ in bundles)
+      for _, size, path in sorted(bundles):
+         if total <= self.maxsize:
+            break
+         if path == keep:
+            continue
+         self._remove(path)
+         total -= size
+
+class PLBundleCacheException(Exception):
+   """
+   PLBundleCacheException(Exception)
+   """
+
+   def __init__(self, value):
+      self.value = value
+
+   def __str__(self):
+      return repr(self.value)
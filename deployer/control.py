@@ -0,0 +1,276 @@
+"""
+control.py
+
+   Unix socket control API
+      The daemon answers queries from its in-memory node pool snapshot,
+      one JSON object per line in each direction:
+
+      {"cmd": "status", "min_state": "usable"}
+      {"cmd": "nodes",  "attribute": "addr", "min_state": "usable"}
+      {"cmd": "node",   "key": "1.2.3.4"}    (addr, name or id)
+      {"cmd": "top",    "n": 10, "sort": "rtt"}
+      {"cmd": "history", "key": "1.2.3.4", "start": 1476700000,
+       "end": 1476800000, "resolution": "hourly"}     (raw, hourly, daily)
+      {"cmd": "metrics"}
+
+@author: K.Edeline
+"""
+import os
+import json
+import socket
+import threading
+import socketserver
+
+from datetime import datetime
+
+from deployer.node import PLNode, PLNodeState, PLNodeState_ge, PLNodePool
+from deployer.node import most_common
+from deployer.scores import SORTS, top_row
+from deployer.history import RESOLUTIONS
+
+def _jsonable(value):
+   if isinstance(value, PLNodeState):
+      return value.value
+   if isinstance(value, datetime):
+      return value.isoformat()
+   return value
+
+def _state(value):
+   return PLNodeState(value) if value else None
+
+class PLControlHandler(socketserver.StreamRequestHandler):
+   """
+   PLControlHandler
+
+   """
+
+   def handle(self):
+      for line in self.rfile:
+         try:
+            request  = json.loads(line.decode('utf8'))
+            response = self.server.control.dispatch(request)
+         except Exception as e:
+            response = {"error": str(e)}
+
+         self.wfile.write((json.dumps(response)+"\n").encode('utf8'))
+
+class PLControlServer(object):
+   """
+   PLControlServer
+
+      Serves the snapshot of a PLNodePool on a unix socket, from a
+      background thread. The socket is open to its owner and group only.
+   """
+
+   def __init__(self, path, pool, mode=0o660, group=None):
+      """
+      @param group gid of the users allowed to query, defaults to the 
+                   group of the daemon
+      """
+      self.path   = path
+      self.pool   = pool
+      self.mode   = mode
+      self.group  = group
+      self.server = None
+
+   def start(self):
+      if os.path.exists(self.path):
+         os.remove(self.path)
+
+      self.server = socketserver.ThreadingUnixStreamServer(self.path,
+                                                           PLControlHandler)
+      self.server.daemon_threads = True
+      self.server.control        = self
+      # read-only queries, open to the group of the daemon user
+      if self.group is not None:
+         os.chown(self.path, -1, self.group)
+      os.chmod(self.path, self.mode)
+
+      thread = threading.Thread(target=self.server.serve_forever,
+                                name="control", daemon=True)
+      thread.start()
+
+   def stop(self):
+      if self.server is None:
+         return
+      self.server.shutdown()
+      self.server.server_close()
+      self.server = None
+      if os.path.exists(self.path):
+         os.remove(self.path)
+
+   def dispatch(self, request):
+      """
+      @return response dictionary of request
+      """
+      handlers = {"status" : self.status,
+                  "nodes"  : self.nodes,
+                  "node"   : self.node,
+                  "metrics": self.metrics,
+                  "top"    : self.top,
+                  "history": self.history,
+                 }
+      cmd = request.pop("cmd", None)
+      if cmd not in handlers:
+         raise PLControlException("unknown command {}".format(cmd))
+
+      return handlers[cmd](**request)
+
+   def _nodes(self, min_state=None, state=None):
+      # single read of the snapshot reference
+      nodes = self.pool.snapshot.values()
+      if min_state:
+         states = set(PLNodeState_ge[_state(min_state)])
+         nodes  = [n for n in nodes if n["state"] in states]
+      elif state:
+         nodes  = [n for n in nodes if n["state"] == _state(state)]
+      return nodes
+
+   def status(self, min_state=None):
+      nodes  = self._nodes(min_state=min_state)
+      counts = {}
+      for a in PLNode.columns():
+         counter   = most_common([node[a] for node in nodes])
+         counts[a] = [(_jsonable(v), n) for v, n in counter]
+      return {"status": counts}
+
+   def nodes(self, attribute="addr", min_state=None, state=None):
+      if attribute not in PLNode.columns(data_only=False):
+         raise PLControlException("unknown attribute {}".format(attribute))
+      nodes = self._nodes(min_state=min_state, state=state)
+      return {"nodes": [_jsonable(n[attribute]) for n in nodes
+                                       if n[attribute] is not None]}
+
+   def _find(self, key):
+      """
+      @return (id, snapshot) of the node whose id, addr or name is key
+      """
+      key      = str(key)
+      snapshot = self.pool.snapshot
+      if key.isdigit() and int(key) in snapshot:
+         return int(key), snapshot[int(key)]
+      for attribute in ["addr", "name"]:
+         try:
+            # pool indexes are updated by the poller thread
+            node = self.pool._find(attribute, key)
+         except IndexError:
+            node = None
+         if node is not None and node.id in snapshot:
+            return node.id, snapshot[node.id]
+      raise PLControlException("node {} not found".format(key))
+
+   def node(self, key=None):
+      nodeid, node = self._find(key)
+      detail       = {k : _jsonable(v) for k, v in node.items()}
+      detail["id"] = nodeid
+      return {"node": detail}
+
+   def history(self, key=None, start=None, end=None, resolution="raw"):
+      if resolution not in RESOLUTIONS:
+         raise PLControlException("unknown resolution {}".format(resolution))
+      history = getattr(self.pool, "history", None)
+      if history is None:
+         return {"history": []}
+      nodeid, _ = self._find(key)
+      records   = history.scan(nodeid, start=start, end=end, 
+                               resolution=resolution)
+      return {"history": [{k : _jsonable(v) for k, v in r._asdict().items()}
+                            for r in records]}
+
+   def top(self, n=10, sort="availability"):
+      if sort not in SORTS:
+         raise PLControlException("unknown sort {}".format(sort))
+      scores = getattr(self.pool, "scores", None)
+      if scores is None:
+         return {"top": []}
+      # rankings precomputed by the poller, single read of each reference
+      ranking  = scores.ranking[sort]
+      snapshot = self.pool.snapshot
+      rows     = []
+      for nodeid, score in ranking:
+         if len(rows) >= n:
+            break
+         if nodeid in snapshot:
+            row = top_row(nodeid, snapshot[nodeid], score)
+            rows.append({k : _jsonable(v) for k, v in row.items()})
+      return {"top": rows}
+
+   def metrics(self):
+      # snapshot published by the poller, empty before the first export
+      return getattr(self.pool, "metrics_snapshot", {})
+
+def control_request(path, request, timeout=2):
+   """
+   Send request to the control socket at path
+
+   @return response dictionary
+   """
+   with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+      sock.settimeout(timeout)
+      sock.connect(path)
+      sock.sendall((json.dumps(request)+"\n").encode('utf8'))
+      line = sock.makefile('rb').readline()
+
+   if not line:
+      raise PLControlException("no response")
+   response = json.loads(line.decode('utf8'))
+   if "error" in response:
+      raise PLControlException(response["error"])
+   return response
+
+class PLControlClient(object):
+   """
+   PLControlClient
+
+      PLNodeStatus counterpart that queries the running daemon
+   """
+
+   def __init__(self, path):
+      self.path = path
+
+   def status(self, min_state=None, string=False):
+      """
+      @param min_state consider only node with state >= min_state
+      @param string return status as a string
+
+      @return node state count as a list, like PLNodePool.status()
+      """
+      request = {"cmd": "status", "min_state": _jsonable(min_state)}
+      counts  = control_request(self.path, request)["status"]
+
+      counterdict = {}
+      for a in PLNode.columns():
+         convert        = PLNodeState if a == "state" else (lambda v: v)
+         counterdict[a] = [(convert(v), n) for v, n in counts[a]]
+
+      if string:
+         return PLNodePool._status_string(counterdict, min_state)
+
+      return counterdict
+
+   def top(self, n=10, sort="availability"):
+      """
+      @return the n best nodes by sort, as scores.top_row() dictionaries
+      """
+      request = {"cmd": "top", "n": n, "sort": sort}
+      return control_request(self.path, request)["top"]
+
+   def _get(self, attribute, min_state=None, state=None):
+      """
+      @return a list of nodes 'attribute'
+      """
+      request = {"cmd": "nodes", "attribute": attribute,
+                 "min_state": _jsonable(min_state), "state": _jsonable(state)}
+      return control_request(self.path, request)["nodes"]
+
+class PLControlException(Exception):
+   """
+   PLControlException(Exception)
+   """
+
+   def __init__(self, value):
+      self.value = value
+
+   def __str__(self):
+      return repr(self.value)
+
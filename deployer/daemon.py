@@ -12,7 +12,7 @@ import pwd
 import time
 import atexit
 
-from signal import SIGTERM
+from signal import SIGTERM, signal
 
 class Daemon(object):
    """
@@ -71,6 +71,8 @@ class Daemon(object):
 
       # Register a function to clean up.
       atexit.register(self.delpid)
+      # exit on stop(), so that atexit functions run
+      signal(SIGTERM, self._terminate)
 
       # drop privileges with seteuid to get it back atexit
       self.drop_privileges()
@@ -80,6 +82,9 @@ class Daemon(object):
       self.redirect_fds()   
 
 
+   def _terminate(self, signum, frame):
+      sys.exit(0)
+
    def delpid(self):
       self.root()
       os.remove(self.pidfile)
@@ -174,6 +179,13 @@ class Daemon(object):
 
       return 1 
 
+   def is_running(self):
+      """
+      @return True if the pidfile points to a running process
+      """
+      pid = self._open_pid()
+      return pid is not None and os.path.exists("/proc/{}".format(pid))
+
    def stop(self):
       """
       Stop the daemon.
@@ -6,18 +6,24 @@ deloypl.py
 @author: K.Edeline
 """
 import sys
+import pwd
 import time
+import atexit
 
 from deployer.ios import IOManager
 from deployer.daemon import Daemon
 from deployer.poller import PLPoller
-from deployer.node import PLNodeState, PLNodePool, PLNodePoolException
+from deployer.ssh import SSHOutput
+from deployer.node import PLNodeState, PLNodeStatus, PLNodePoolException
+from deployer.control import PLControlServer, PLControlClient
+from deployer.control import PLControlException
 
 class PLDeployer(IOManager, Daemon):
    """
    PLDeployer
    
    """
+   CONTROL_SOCKET = '/var/run/deploypl.sock'
 
    def __init__(self):
       super(PLDeployer, self).__init__(child=self, 
@@ -27,7 +33,8 @@ class PLDeployer(IOManager, Daemon):
                       name='deploypl')
       self.load_inputs()
       
-      self.pool = None
+      self.pool    = None
+      self.control = None
 
    def load(self):
       """
@@ -39,7 +46,23 @@ class PLDeployer(IOManager, Daemon):
       self.pool = PLPoller(self, rawfile=self._rawfile, user=self.user, 
                                period=self.period, threadlimit=self.threadlimit,
                                sshlimit=self.sshlimit, plslice=self.slice,
-                               initialdelay=self.initialdelay)
+                               sshpersist=self.sshpersist, 
+                               sshmasters=self.sshmasters,
+                               initialdelay=self.initialdelay,
+                               pingmode=self.pingmode,
+                               minperiod=self.minperiod,
+                               maxperiod=self.maxperiod,
+                               metricsdir=self.metricsdir,
+                               bundledir=self.bundledir,
+                               bundlesize=self.bundlesize,
+                               historydir=self.historydir,
+                               historydays=self.historydays,
+                               sshoutput=SSHOutput(self.outputmode, 
+                                             head=self.outputlimit // 2,
+                                             tail=self.outputlimit // 2,
+                                             spooldir=self.spooldir))
+      atexit.register(self.pool.close)
+
    def run(self):
       """      
       while True:
@@ -49,26 +72,52 @@ class PLDeployer(IOManager, Daemon):
       """
       # Load env
       self.load()
-      return
+      self.serve()
       self.debug(self.pool.status())
       self.debug("loading completed, starting to probe ...")
 
-      # main loop
+      # main loop, probe nodes as they become due
       time.sleep(self.initialdelay)
       while True:
          self.pool.poll()
+         # only nodes that are due are checked and synced
          self.pool.install_packages(self.pkglist)
          self.pool.sync_data(self.userdir)
-         self.info("Deploying on slice "+self.config["planet-lab.eu"]["slice"])
-         time.sleep(self.period)
+         self.info("Deploying on slice "+self.slice)
+         time.sleep(self.pool.sleep_time())
 
       """"""
 
+   def serve(self):
+      """
+      serve node pool queries on the control socket
+      """
+      group = pwd.getpwnam(self.username).pw_gid if self.username else None
+      self.control = PLControlServer(self.CONTROL_SOCKET, self.pool, 
+                                     group=group)
+      self.root()
+      try:
+         self.control.start()
+         atexit.register(self._stop_control)
+      except OSError as e:
+         self.error("cannot open control socket: {}".format(e))
+      finally:
+         self.drop_privileges()
+
+   def _stop_control(self):
+      self.root()
+      self.control.stop()
+
    def status_str(self, spaced=False):
       """
       Returns a string that describes current node pool state
       """
-      if self.args.vverbose:
+      if self.args.top > 0:
+         ## Print best nodes with their scores
+         status = self.top_str(self.pool.top(n=self.args.top, 
+                                             sort=self.args.sort))
+
+      elif self.args.vverbose:
          ## Print profile of all nodes
          status = self.pool.status(string=True)
 
@@ -87,21 +136,56 @@ class PLDeployer(IOManager, Daemon):
 
       return status
 
+   def top_str(self, rows):
+      """
+      Returns a string that describes ranked nodes
+      """
+      if not rows:
+         return "No scored node found.\n"
+
+      def fmt(value, spec):
+         return "-" if value is None else spec.format(value)
+
+      attribute = "name" if self.args.names else "addr"
+      lines = ["{:<40} {:<11} {:>9} {:>9} {:>6} {:>6} {:>6}".format(attribute,
+               "state", "rtt", "jitter", "loss", "avail", "probes")]
+      for row in rows:
+         state = row["state"]
+         lines.append("{:<40} {:<11} {:>9} {:>9} {:>6} {:>6} {:>6}".format(
+                  str(row[attribute]), getattr(state, "value", state),
+                  fmt(row["rtt"], "{:.1f}ms"), fmt(row["jitter"], "{:.1f}ms"),
+                  fmt(row["loss"], "{:.0%}"), 
+                  fmt(row["availability"], "{:.0%}"), row["probes"]))
+      return "\n".join(lines)+"\n"
+
    def status(self):
       """
       Print node pool status to stdout.
+
+         Asks the running daemon through its control socket, falls back
+         to counting nodes in the database.
       """
-      if Daemon.status(self) != 0:
-         return 1
-      
       # Load decoy logger
       self.load_outputs(decoy=True)
 
-      # Load node pool & print status
+      if self.is_running():
+         try:
+            self.pool = PLControlClient(self.CONTROL_SOCKET)
+            sys.stdout.write(self.status_str())
+            return 0
+         except (OSError, PLControlException):
+            pass
+
+      # Count nodes in database & print status
       try:
-         self.pool = PLNodePool(self)
+         self.pool = PLNodeStatus(self)
          sys.stdout.write(self.status_str())
-      except PLNodePoolException:
+      except PLNodePoolException as e:
+         if e.value != "Empty node pool":
+            # e.g. the database is not readable by this user
+            sys.stderr.write("Cannot read node database: {}\n".format(
+                                                               e.value))
+            return 1
          sys.stdout.write("No node found.\n")
 
       return 0
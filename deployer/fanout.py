@@ -0,0 +1,340 @@
+"""
+fanout.py
+
+   Tree-structured relay distribution of a file to many hosts
+
+      The controller uploads the file to a few seed hosts, the best
+      connected ones, then every host that received it relays it to
+      the next tier over ssh:
+
+         controller -> seeds -> tier 1 -> tier 2 ...
+
+      so that the controller uplink carries the file `seeds` times
+      instead of once per host. Every hop checks the SHA-1 of what it
+      received, hosts whose relay fails get a direct upload from the
+      controller, and then relay to their own children.
+
+      Relays do not get the controller credentials: they authenticate
+      with a one-off key pair, whose private key is only copied to the
+      relays, and whose public key is only authorized on the other hosts
+      for a forced command that receives this very file. Both are
+      removed once the file is distributed.
+
+@author: K.Edeline
+"""
+import os
+import shlex
+import shutil
+import asyncio
+import hashlib
+import binascii
+import tempfile
+
+from collections import deque
+
+from deployer.ssh import ssh_command, _execute, _run_quiet
+
+## comment of relay keys, followed by a random tag
+RELAY_KEY = "deploypl-relay-"
+## sshd options of relay keys in authorized_keys
+RELAY_OPTIONS = ["no-pty", "no-port-forwarding", "no-agent-forwarding",
+                 "no-X11-forwarding"]
+
+def _sha1(path, blocksize=65536):
+   sha1 = hashlib.sha1()
+   with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(blocksize), b""):
+         sha1.update(block)
+   return sha1.hexdigest()
+
+def receive_command(remotefile, digest):
+   """
+   @return the command line that writes its standard input to remotefile,
+           if its SHA-1 is digest
+   """
+   target  = shlex.quote(remotefile)
+   partial = shlex.quote(remotefile+".part")
+   steps   = []
+   dirname = os.path.dirname(remotefile)
+   if dirname:
+      steps.append("mkdir -p {}".format(shlex.quote(dirname)))
+   steps += ["cat > {}".format(partial),
+             'test "$(sha1sum {} | cut -c1-40)" = {}'.format(partial, digest),
+             "mv -f {} {}".format(partial, target)]
+   return " && ".join(steps)
+
+def relay_command(host, loginname, remotefile, digest, keyloc, port=None):
+   """
+   @param keyloc relay private key, relative to the relay login directory
+   @return the command line, run on a relay, that sends its copy of
+           remotefile to host
+   """
+   cmd = ssh_command(host, loginname, receive_command(remotefile, digest),
+                     keyloc=keyloc, port=port, 
+                     options=["BatchMode=yes", "IdentitiesOnly=yes"])
+   return "{} < {}".format(" ".join(shlex.quote(arg) for arg in cmd),
+                           shlex.quote(remotefile))
+
+def authorized_key(pubkey, remotefile, digest):
+   """
+   @param pubkey public key, as written by ssh-keygen
+   @return the authorized_keys line that only lets pubkey write remotefile,
+           if its SHA-1 is digest
+   """
+   command = receive_command(remotefile, digest)
+   command = command.replace('\\', '\\\\').replace('"', '\\"')
+   return '{},command="{}" {}'.format(",".join(RELAY_OPTIONS), command,
+                                      pubkey.strip())
+
+def setup_command(authorized=None, keyloc=None):
+   """
+   @param authorized authorized_keys line to add
+   @param keyloc where to write the relay private key read from standard
+                 input, relative to the login directory
+   @return the command line that prepares a host of the relay tree
+   """
+   steps = []
+   if authorized:
+      steps += ["mkdir -p .ssh", "chmod 700 .ssh",
+                "echo {} >> .ssh/authorized_keys".format(
+                                                   shlex.quote(authorized))]
+   if keyloc:
+      steps.append("(umask 077 && cat > {})".format(shlex.quote(keyloc)))
+   return " && ".join(steps)
+
+def cleanup_command(tag):
+   """
+   @return the command line that removes the relay key tag from a host
+   """
+   # rewritten in place, keeping its mode
+   return ("rm -f {0}; test -f .ssh/authorized_keys || exit 0; "
+           "grep -v ' {0}$' .ssh/authorized_keys > .ssh/{0}.tmp; "
+           "cat .ssh/{0}.tmp > .ssh/authorized_keys && "
+           "rm -f .ssh/{0}.tmp".format(tag))
+
+def fanout_tree(hosts, rtts=None, seeds=4, degree=4):
+   """
+   Arrange hosts in a relay tree, lowest rtt first: the seeds are the
+   best connected hosts, and each host relays to at most degree hosts
+   of the next tier.
+
+   @param rtts {host: round-trip time}, unknown hosts are ranked last
+   @return (seed hosts, {host: [children]})
+   """
+   rtts     = rtts or {}
+   ranked   = sorted(hosts, key=lambda h: (rtts.get(h) is None,
+                                           rtts.get(h) or 0))
+   seeds    = ranked[:max(1, seeds)]
+   children = {host : [] for host in ranked}
+   parents  = deque(seeds)
+   for host in ranked[len(seeds):]:
+      parent = parents[0]
+      children[parent].append(host)
+      parents.append(host)
+      if len(children[parent]) >= degree:
+         parents.popleft()
+   return seeds, children
+
+class SSHFanout(object):
+   """
+   SSHFanout
+
+      Distributes a local file to remotefile of hosts through a relay
+      tree (see fanout_tree()):
+         - at most `seeds` direct uploads run at once,
+         - at most `limit` relays run at once,
+         - each transfer is killed after `timeout` seconds.
+
+      Relays authenticate to their children with a one-off key pair, 
+      generated for each run and removed from hosts when it completes.
+
+      Every host gets a result dictionary (see ssh_result()) with a
+      "relay" item, the host it got the file from, None if it came from
+      the controller, and a "relay_failed" item, the host whose relay
+      failed before a direct upload.
+
+      fanout  = SSHFanout(user, "bundle.tar.gz", "bundle.tar.gz")
+      results = fanout.run_sync(hosts, rtts=rtts)
+   """
+
+   def __init__(self, loginname, localfile, remotefile, keyloc=None,
+                port=None, seeds=4, degree=4, limit=100, timeout=300,
+                output=None):
+      self.loginname  = loginname
+      self.localfile  = localfile
+      self.remotefile = remotefile
+      self.keyloc     = keyloc
+      self.port       = port
+      self.seeds      = seeds
+      self.degree     = degree
+      self.limit      = limit
+      self.timeout    = timeout
+      self.output     = output
+
+   def _direct(self, host, digest):
+      return ssh_command(host, self.loginname,
+                         receive_command(self.remotefile, digest),
+                         keyloc=self.keyloc, port=self.port)
+
+   def _relay(self, host, parent, digest, tag):
+      return ssh_command(parent, self.loginname,
+                         relay_command(host, self.loginname, self.remotefile,
+                                       digest, tag, port=self.port),
+                         keyloc=self.keyloc, port=self.port)
+
+   async def _keygen(self, workdir):
+      """
+      generate the relay key pair in workdir
+
+      @return (tag, private key path, public key), None if ssh-keygen failed
+      """
+      tag  = RELAY_KEY + binascii.hexlify(os.urandom(8)).decode('ascii')
+      path = os.path.join(workdir, tag)
+      if not await _run_quiet(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '',
+                               '-C', tag, '-f', path], self.timeout):
+         return None
+      with open(path+".pub") as f:
+         return tag, path, f.read()
+
+   async def _prepare(self, hosts, relayed, relays, key, digest, index,
+                      prepared):
+      """
+      authorize the relay key on hosts that get the file from a relay,
+      copy it to relays
+
+      @param prepared list extended with the hosts that must be cleaned up
+      """
+      tag, path, pubkey = key
+      authorized = authorized_key(pubkey, self.remotefile, digest)
+      limit      = asyncio.Semaphore(max(1, self.limit))
+
+      async def prepare(host):
+         cmd = setup_command(authorized if host in relayed else None,
+                             tag if host in relays else None)
+         if not cmd:
+            return
+         # partially prepared hosts are cleaned up too
+         prepared.append(host)
+         async with limit:
+            await _execute(host, ssh_command(host, self.loginname, cmd, 
+                                             keyloc=self.keyloc, 
+                                             port=self.port),
+                           timeout=self.timeout, index=index[host],
+                           stdin=path if host in relays else None)
+
+      await asyncio.gather(*[prepare(host) for host in hosts])
+
+   async def _cleanup(self, hosts, tag, index):
+      limit = asyncio.Semaphore(max(1, self.limit))
+      async def cleanup(host):
+         async with limit:
+            await _execute(host, ssh_command(host, self.loginname,
+                                             cleanup_command(tag),
+                                             keyloc=self.keyloc, 
+                                             port=self.port),
+                           timeout=self.timeout, index=index[host])
+      await asyncio.gather(*[cleanup(host) for host in hosts])
+
+   async def run(self, hosts, rtts=None, callback=None):
+      """
+      @param rtts {host: round-trip time}, used to choose the seeds
+      @param callback called as callback(result) as soon as a host
+                      completes, results are then not kept
+      @return list of result dictionaries in completion order,
+              None if callback is given
+      """
+      results = []
+      report  = callback or results.append
+      hosts   = list(hosts)
+      if not hosts:
+         return None if callback else results
+
+      digest          = _sha1(self.localfile)
+      index           = {host : i for i, host in enumerate(hosts)}
+      seeds, children = fanout_tree(hosts, rtts=rtts, seeds=self.seeds,
+                                    degree=self.degree)
+      uplink = asyncio.Semaphore(len(seeds))
+      relays = asyncio.Semaphore(max(1, self.limit))
+
+      # relay key, hosts are uploaded to directly without one
+      workdir  = tempfile.mkdtemp(prefix="deploypl-fanout-")
+      prepared = []
+      try:
+         key = None
+         if len(seeds) < len(hosts):
+            key = await self._keygen(workdir)
+         if key is not None:
+            relayed = {child for host in hosts for child in children[host]}
+            await self._prepare(hosts, relayed, 
+                                {h for h in hosts if children[h]}, key, 
+                                digest, index, prepared)
+         await self._deliver(seeds, children, digest, key, uplink, relays, 
+                             index, report)
+      finally:
+         shutil.rmtree(workdir, ignore_errors=True)
+         if prepared:
+            await self._cleanup(prepared, key[0], index)
+      return None if callback else results
+
+   async def _deliver(self, seeds, children, digest, key, uplink, relays, 
+                      index, report):
+      """
+      upload to seeds, then relay down the tree
+      """
+      async def deliver(host, parent=None):
+         result, failed = None, None
+         if parent is not None and key is not None:
+            async with relays:
+               result = await _execute(host,
+                                 self._relay(host, parent, digest, key[0]),
+                                 timeout=self.timeout, index=index[host],
+                                 output=self.output)
+            if result['status'] != 0:
+               result, failed = None, parent
+         if result is None:
+            # seed, or failed relay
+            parent = None
+            async with uplink:
+               result = await _execute(host, self._direct(host, digest),
+                                 timeout=self.timeout, index=index[host],
+                                 output=self.output, stdin=self.localfile)
+         result['relay']        = parent
+         result['relay_failed'] = failed
+         report(result)
+
+         # children of a host that did not get the file are uploaded to
+         # directly
+         relay = host if result['status'] == 0 else None
+         await asyncio.gather(*[deliver(child, relay)
+                                   for child in children[host]])
+
+      await asyncio.gather(*[deliver(seed) for seed in seeds])
+
+   def run_sync(self, hosts, rtts=None, callback=None):
+      """
+      run() in a new event loop
+      """
+      loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(loop)
+      try:
+         return loop.run_until_complete(self.run(hosts, rtts=rtts,
+                                                 callback=callback))
+      finally:
+         asyncio.set_event_loop(None)
+         loop.close()
+
+def fanout_upload(hosts, loginname, localfile, remotefile, rtts=None,
+                  keyloc=None, port=None, seeds=4, degree=4, threads=100,
+                  timeout=300, callback=None, output=None):
+   """
+   Copy localfile to remotefile of all hosts through a relay tree, see
+   SSHFanout
+
+   @param rtts {host: round-trip time}, the lowest ones are seeded first
+   @param callback called as callback(result) as soon as a host completes
+   @return list of result dictionaries, None if callback is given
+   """
+   fanout = SSHFanout(loginname, localfile, remotefile, keyloc=keyloc,
+                      port=port, seeds=seeds, degree=degree, limit=threads,
+                      timeout=timeout, output=output)
+   return fanout.run_sync(hosts, rtts=rtts, callback=callback)
@@ -0,0 +1,376 @@
+"""
+history.py
+
+   Append-only probe history
+
+      Probes are stored as fixed-width records (node id, time, last stage,
+      state, ping packets sent and received, min/avg/max rtt, jitter) in
+      chunk files partitioned by period and by node id shard, so that the
+      history of a node over a time range is read from a handful of small
+      files:
+
+         raw/20261017/17.bin      probes of 2026-10-17, node id % 64 == 17
+         hourly/202610/17.bin     hourly aggregates of October 2026
+         daily/2026/17.bin        daily aggregates of 2026
+
+      Raw partitions older than raw_days are folded into hourly aggregates,
+      hourly ones older than hourly_days into daily aggregates, and daily
+      ones older than daily_days are deleted.
+
+      A fold writes the new target chunk files next to the current ones,
+      then a journal listing them (the commit point), then moves them in
+      place and deletes the folded partition. A fold interrupted before 
+      its journal is written is discarded, one interrupted after it is
+      completed by the next downsample(), so that no probe is counted
+      twice or lost.
+
+@author: K.Edeline
+"""
+import os
+import json
+import math
+import time
+import shutil
+import struct
+import calendar
+
+from datetime import datetime
+from collections import namedtuple
+
+from deployer.node import PLNodeState, PLNodeState_order
+from deployer.scores import ping_ms
+
+## probing stages, in order
+STAGES = ["ping", "ssh", "profile", "fix"]
+
+## node id, time, stage, state, packets sent, packets received,
+## min rtt, avg rtt, max rtt, jitter (ms, NaN if no reply)
+RAW       = struct.Struct("<qdBBHHffff")
+## node id, period start, probes, usable probes, replied probes,
+## packets sent, packets received, mean rtt of replied probes, min rtt,
+## max rtt, mean jitter of replied probes
+AGGREGATE = struct.Struct("<qIIIIIIffff")
+
+PLProbeRecord     = namedtuple("PLProbeRecord",
+                               ["node_id", "time", "stage", "state", "sent",
+                                "received", "rttmin", "rtt", "rttmax", 
+                                "jitter"])
+PLAggregateRecord = namedtuple("PLAggregateRecord",
+                               ["node_id", "start", "probes", "usable",
+                                "replied", "sent", "received", "rtt", 
+                                "rttmin", "rttmax", "jitter"])
+
+## resolution -> (partition name format, aggregated period in seconds)
+RESOLUTIONS = {"raw"    : ("%Y%m%d", None),
+               "hourly" : ("%Y%m",   3600),
+               "daily"  : ("%Y",     86400)}
+
+## state of a record, by index
+_STATES = {PLNodeState_order[s.value] : s for s in PLNodeState}
+
+def _partition_end(resolution, name):
+   """
+   @return the end of partition name as a timestamp
+   """
+   start = datetime.strptime(name, RESOLUTIONS[resolution][0])
+   if resolution == "raw":
+      return calendar.timegm(start.timetuple()) + 86400
+   if resolution == "hourly":
+      year, month = start.year + start.month // 12, start.month % 12 + 1
+      return calendar.timegm(datetime(year, month, 1).timetuple())
+   return calendar.timegm(datetime(start.year + 1, 1, 1).timetuple())
+
+def _partition(resolution, ts):
+   return time.strftime(RESOLUTIONS[resolution][0], time.gmtime(ts))
+
+def _nan(value):
+   return float("nan") if value is None else value
+
+def _none(value):
+   return None if math.isnan(value) else value
+
+def _whole(path, record):
+   """
+   @return the content of chunk file path, without a partially written
+           last record
+   """
+   try:
+      with open(path, 'rb') as f:
+         data = f.read()
+   except FileNotFoundError:
+      return b""
+   return data[:len(data) - len(data) % record.size]
+
+def _read(path, record):
+   """
+   @return the records of chunk file path, without a partially written
+           last record
+   """
+   return record.iter_unpack(_whole(path, record))
+
+def _write(path, *chunks):
+   """
+   write chunks to path, and to disk
+   """
+   with open(path, 'wb') as f:
+      for data in chunks:
+         f.write(data)
+      f.flush()
+      os.fsync(f.fileno())
+
+def _append(path, data, record):
+   """
+   append data to chunk file path, after dropping a partially written
+   last record
+   """
+   with open(path, 'ab') as f:
+      partial = f.tell() % record.size
+      if partial:
+         f.truncate(f.tell() - partial)
+         f.seek(0, os.SEEK_END)
+      f.write(data)
+
+class PLHistory(object):
+   """
+   PLHistory
+
+      history = PLHistory("/var/lib/deploypl/history")
+      history.append(node.id, "ssh", node.state, ping=ping_parse(output))
+      history.flush()
+      history.scan(node.id, start=time.time() - 86400)
+      history.downsample()
+   """
+
+   def __init__(self, directory, shards=64, raw_days=7, hourly_days=90,
+                daily_days=730):
+      self.directory = directory
+      self.shards    = shards
+      ## resolution -> retention in seconds
+      self.retention = {"raw"    : raw_days * 86400,
+                        "hourly" : hourly_days * 86400,
+                        "daily"  : daily_days * 86400}
+      ## (partition, shard) -> raw records not written yet
+      self._pending  = {}
+
+   def _path(self, resolution, partition, shard):
+      return os.path.join(self.directory, resolution, partition,
+                          "{}.bin".format(shard))
+
+   def _partitions(self, resolution):
+      """
+      @return partition names of resolution, oldest first
+      """
+      try:
+         names = os.listdir(os.path.join(self.directory, resolution))
+      except FileNotFoundError:
+         return []
+      fmt = RESOLUTIONS[resolution][0]
+      def valid(name):
+         try:
+            datetime.strptime(name, fmt)
+         except ValueError:
+            return False
+         return True
+      return sorted(filter(valid, names))
+
+   def append(self, node_id, stage, state, ping=None, ts=None):
+      """
+      Record a probe of node_id that ended at stage with state
+
+      @param ping ping_parse() dictionary, None if node was not pinged
+      """
+      ts   = time.time() if ts is None else ts
+      ping = ping or {}
+      key  = (_partition("raw", ts), node_id % self.shards)
+      self._pending.setdefault(key, bytearray()).extend(RAW.pack(node_id, ts,
+                  STAGES.index(stage) if stage in STAGES else 255,
+                  PLNodeState_order[state.value] if state is not None else 0,
+                  min(ping.get('sent', 0), 0xffff), 
+                  min(ping.get('received', 0), 0xffff),
+                  *[_nan(ping_ms(ping.get(k))) for k in ["minping", "avgping",
+                                                       "maxping", "jitter"]]))
+
+   def flush(self):
+      """
+      Write appended records to their chunk files
+
+      @return the number of records written
+      """
+      pending, self._pending = self._pending, {}
+      count = 0
+      for (partition, shard), data in pending.items():
+         path = self._path("raw", partition, shard)
+         os.makedirs(os.path.dirname(path), exist_ok=True)
+         _append(path, data, RAW)
+         count += len(data) // RAW.size
+      return count
+
+   def scan(self, node_id, start=None, end=None, resolution="raw"):
+      """
+      @return records of node_id within [start, end), oldest first,
+              PLProbeRecord for raw resolution, PLAggregateRecord else
+      """
+      start  = 0 if start is None else start
+      end    = float("inf") if end is None else end
+      record = RAW if resolution == "raw" else AGGREGATE
+      shard  = node_id % self.shards
+
+      last    = _partition(resolution, min(end, 2**31 - 1))
+      records = []
+      for partition in self._partitions(resolution):
+         if partition > last:
+            break
+         if _partition_end(resolution, partition) <= start:
+            continue
+         path = self._path(resolution, partition, shard)
+         for values in _read(path, record):
+            if values[0] != node_id or not (start <= values[1] < end):
+               continue
+            if resolution == "raw":
+               nid, ts, stage, state = values[:4]
+               records.append(PLProbeRecord(nid, ts,
+                     STAGES[stage] if stage < len(STAGES) else None,
+                     _STATES.get(state), values[4], values[5],
+                     *[_none(v) for v in values[6:]]))
+            else:
+               records.append(PLAggregateRecord(*values[:7],
+                     *[_none(v) for v in values[7:]]))
+      records.sort(key=lambda r: r[1])
+      return records
+
+   def _fold(self, resolution, partition, target):
+      """
+      Aggregate the chunk files of a partition into target resolution
+      partitions, see _commit()
+      """
+      period = RESOLUTIONS[target][1]
+      moves  = []
+      for shard in range(self.shards):
+         path = self._path(resolution, partition, shard)
+         ## (node id, period start) -> [probes, usable, replied, sent,
+         ##                   received, rtt sum, jitter sum, rtt min, rtt max]
+         buckets = {}
+         for values in _read(path, RAW if resolution == "raw" else AGGREGATE):
+            if resolution == "raw":
+               nid, ts, _, state, sent, received, rttmin, rtt, rttmax, \
+                  jitter = values
+               replied = 0 if math.isnan(rtt) else 1
+               values  = (nid, ts, 1,
+                          int(state == PLNodeState_order["usable"]),
+                          replied, sent, received)
+            else:
+               nid, ts, probes, usable, replied, sent, received, rtt, \
+                  rttmin, rttmax, jitter = values
+               values  = (nid, ts, probes, usable, replied, sent, received)
+            if replied:
+               values += (rtt * replied, 
+                          0 if math.isnan(jitter) else jitter * replied,
+                          rttmin, rttmax)
+            else:
+               values += (0, 0, math.inf, -math.inf)
+
+            key = (values[0], int(values[1] // period * period))
+            if key not in buckets:
+               buckets[key] = [0, 0, 0, 0, 0, 0.0, 0.0, math.inf, -math.inf]
+            bucket = buckets[key]
+            for i in range(7):
+               bucket[i] += values[2 + i]
+            bucket[7] = min(bucket[7], values[9])
+            bucket[8] = max(bucket[8], values[10])
+
+         chunks = {}
+         for (nid, ts), (probes, usable, replied, sent, received, rttsum,
+                         jittersum, rttmin, rttmax) in sorted(buckets.items(),
+                                           key=lambda item: item[0][1]):
+            nan = float("nan")
+            chunks.setdefault(_partition(target, ts), bytearray()).extend(
+                  AGGREGATE.pack(nid, ts, probes, usable, replied, sent,
+                                 received,
+                                 rttsum / replied if replied else nan,
+                                 rttmin if replied else nan,
+                                 rttmax if replied else nan,
+                                 jittersum / replied if replied else nan))
+
+         # new target chunk files, moved in place once all are written
+         for name, data in chunks.items():
+            target_path = self._path(target, name, shard)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            new = "{}.{}.new".format(target_path, partition)
+            _write(new, _whole(target_path, AGGREGATE), data)
+            moves.append((os.path.relpath(new, self.directory),
+                          os.path.relpath(target_path, self.directory)))
+
+      journal = self._journal(resolution, partition)
+      _write(journal+".tmp", json.dumps(moves).encode('utf8'))
+      os.replace(journal+".tmp", journal)
+      self._commit(resolution, partition)
+
+   def _journal(self, resolution, partition):
+      return os.path.join(self.directory, resolution, partition+".fold")
+
+   def _commit(self, resolution, partition):
+      """
+      Move the target chunk files listed in the journal of a fold in
+      place, then delete the folded partition. Moves already done are
+      skipped, so that an interrupted commit can be run again.
+      """
+      journal = self._journal(resolution, partition)
+      with open(journal) as f:
+         moves = json.load(f)
+      for new, path in moves:
+         new = os.path.join(self.directory, new)
+         if os.path.exists(new):
+            os.replace(new, os.path.join(self.directory, path))
+      shutil.rmtree(os.path.join(self.directory, resolution, partition),
+                    ignore_errors=True)
+      os.remove(journal)
+
+   def _recover(self):
+      """
+      Complete folds whose journal was written, discard the chunk files
+      of folds interrupted before
+
+      @return the number of folds completed
+      """
+      count = 0
+      for resolution in RESOLUTIONS:
+         root = os.path.join(self.directory, resolution)
+         try:
+            names = os.listdir(root)
+         except FileNotFoundError:
+            continue
+         for name in sorted(names):
+            if name.endswith(".fold"):
+               self._commit(resolution, name[:-len(".fold")])
+               count += 1
+            elif name.endswith(".fold.tmp"):
+               os.remove(os.path.join(root, name))
+         for partition in self._partitions(resolution):
+            directory = os.path.join(root, partition)
+            for name in os.listdir(directory):
+               if name.endswith(".new"):
+                  os.remove(os.path.join(directory, name))
+      return count
+
+   def downsample(self, now=None):
+      """
+      Fold expired raw and hourly partitions into coarser ones, delete
+      expired daily partitions
+
+      @return the number of partitions folded or deleted
+      """
+      now   = time.time() if now is None else now
+      count = self._recover()
+      for resolution, target in [("raw", "hourly"), ("hourly", "daily"),
+                                 ("daily", None)]:
+         for partition in self._partitions(resolution):
+            if (_partition_end(resolution, partition)
+                  > now - self.retention[resolution]):
+               break
+            if target is not None:
+               self._fold(resolution, partition, target)
+            else:
+               shutil.rmtree(os.path.join(self.directory, resolution, 
+                                          partition))
+            count += 1
+      return count
@@ -0,0 +1,256 @@
+"""
+icmp.py
+
+   single socket ICMP echo prober
+
+      All echo requests are sent from one ICMP socket, replies are matched
+      back to their probe by identifier/sequence. Uses an unprivileged
+      datagram ICMP socket when the kernel allows it (net.ipv4.ping_group_range),
+      a raw socket otherwise (root only).
+
+@author: K.Edeline
+
+"""
+import os
+import math
+import time
+import errno
+import socket
+import struct
+import asyncio
+
+from deployer.ping import ping_pool, ping_failed, PingException
+
+ICMP_ECHO_REPLY   = 0
+ICMP_ECHO_REQUEST = 8
+
+_header  = struct.Struct("!BBHHH")
+_payload = bytes(range(56))
+
+def checksum(data):
+   """
+   RFC 1071 internet checksum
+   """
+   if len(data) % 2:
+      data += b'\x00'
+   total  = sum(struct.unpack("!{}H".format(len(data) // 2), data))
+   total  = (total >> 16) + (total & 0xffff)
+   total += total >> 16
+   return ~total & 0xffff
+
+def echo_request(ident, seq):
+   """
+   return an ICMP echo request packet
+   """
+   header = _header.pack(ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+   csum   = checksum(header + _payload)
+   return _header.pack(ICMP_ECHO_REQUEST, 0, csum, ident, seq) + _payload
+
+def icmp_socket():
+   """
+   open an ICMP socket, datagram if the kernel allows it for this gid,
+   raw otherwise
+
+   @return (socket, True if it is a raw socket)
+   """
+   try:
+      return socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                           socket.IPPROTO_ICMP), False
+   except OSError:
+      pass
+   try:
+      return socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                           socket.IPPROTO_ICMP), True
+   except OSError as e:
+      raise PingException("cannot open ICMP socket: {}".format(e))
+
+def icmp_check():
+   """
+   check that an ICMP socket can be opened, raise PingException if not
+   """
+   sock, _ = icmp_socket()
+   sock.close()
+
+class ICMPProber(object):
+   """
+   ICMPProber
+
+      prober = ICMPProber()
+      ping_pool(addrs, callback, prober=prober.ping)
+      prober.close()
+
+   The socket is opened on first use, in the running asyncio event loop.
+   """
+   RCVBUF = 1 << 20
+
+   def __init__(self):
+      self.sock     = None
+      self.raw      = False
+      self.ident    = os.getpid() & 0xffff
+      self._loop    = None
+      self._seq     = 0
+      ## seq -> (addr, send time, future)
+      self._pending = {}
+
+   def open(self, loop):
+      """
+      open the ICMP socket and register it to loop
+      """
+      sock, self.raw = icmp_socket()
+      # replies from thousands of hosts may arrive in bursts
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF)
+      sock.setblocking(False)
+      self.sock  = sock
+      self._loop = loop
+      loop.add_reader(sock.fileno(), self._read)
+
+   def close(self):
+      """
+      close socket, pending probes are considered lost
+      """
+      if self.sock is None:
+         return
+      if not self._loop.is_closed():
+         self._loop.remove_reader(self.sock.fileno())
+      self.sock.close()
+      self.sock = None
+
+      for _, _, future in self._pending.values():
+         if not future.done():
+            future.cancel()
+      self._pending.clear()
+
+   def _next_seq(self):
+      """
+      return next free sequence number
+      """
+      if len(self._pending) >= 0xffff:
+         raise PingException("too many ICMP probes in flight")
+      while True:
+         self._seq = (self._seq + 1) & 0xffff
+         if self._seq not in self._pending:
+            return self._seq
+
+   def _read(self):
+      """
+      socket reader callback, drains replies and resolves pending probes
+      """
+      while True:
+         try:
+            data, (src, _) = self.sock.recvfrom(2048)
+         except (BlockingIOError, InterruptedError):
+            return
+         except OSError:
+            # ICMP error reported on socket, ignore
+            continue
+         now = time.time()
+
+         # raw sockets receive the IP header
+         if self.raw:
+            data = data[(data[0] & 0x0f) * 4:]
+         if len(data) < _header.size:
+            continue
+         icmptype, _, _, ident, seq = _header.unpack_from(data)
+         if icmptype != ICMP_ECHO_REPLY:
+            continue
+         # datagram sockets: the kernel rewrites ident and filters replies
+         if self.raw and ident != self.ident:
+            continue
+
+         probe = self._pending.get(seq)
+         if probe is None or probe[0] != src:
+            continue
+         _, sent, future = probe
+         if not future.done():
+            future.set_result((now - sent) * 1000.0)
+
+   def _send(self, addr):
+      """
+      send one echo request to addr, returns a future of the rtt in ms
+      """
+      seq    = self._next_seq()
+      future = self._loop.create_future()
+      self._pending[seq] = (addr, time.time(), future)
+      try:
+         self.sock.sendto(echo_request(self.ident, seq), (addr, 0))
+      except OSError as e:
+         # buffer full, unreachable network, ... : packet lost
+         if e.errno not in (errno.EAGAIN, errno.ENETUNREACH,
+                            errno.EHOSTUNREACH, errno.EPERM):
+            del self._pending[seq]
+            raise PingException("cannot send to {}: {}".format(addr, e))
+      return seq, future
+
+   async def ping(self, dipaddr, count=1, deadline=5, period=1, **kwargs):
+      """
+      send count echo requests to dipaddr, one every period seconds, and
+      wait for replies until deadline seconds after the first one was sent.
+
+      @return a ping_parse() dictionary
+      """
+      addr    = str(dipaddr)
+      count   = count or 1
+      start   = time.time()
+      probes  = []
+      try:
+         if self.sock is None:
+            self.open(asyncio.get_event_loop())
+         for i in range(count):
+            if i > 0:
+               await asyncio.sleep(period)
+               if time.time() - start >= deadline:
+                  break
+            probes.append(self._send(addr))
+
+         futures = [future for _, future in probes]
+         timeout = max(0, deadline - (time.time() - start))
+         await asyncio.wait(futures, timeout=timeout)
+      except PingException:
+         return ping_failed(addr, sent=count)
+      finally:
+         for seq, _ in probes:
+            self._pending.pop(seq, None)
+
+      rtts = [f.result() for f in futures if f.done() and not f.cancelled()]
+      return icmp_result(addr, len(probes), rtts)
+
+def icmp_result(addr, sent, rtts):
+   """
+   return a ping_parse() dictionary from a list of rtts
+   """
+   if not rtts:
+      return ping_failed(addr, sent=sent)
+
+   avg    = sum(rtts) / len(rtts)
+   jitter = math.sqrt(max(0, sum(r*r for r in rtts) / len(rtts) - avg*avg))
+   fmt    = "{:.3f}".format
+   return {'host': addr, 'sent': sent, 'received': len(rtts),
+         'minping': fmt(min(rtts)), 'avgping': fmt(avg),
+         'maxping': fmt(max(rtts)), 'jitter': fmt(jitter)}
+
+def icmp_pool(addrs, callback, limit=1000, **kwargs):
+   """
+   ping_pool() counterpart that probes all addresses from a single ICMP socket
+
+   @param callback called as callback(addr, result) as soon as a probe
+                   completes, result is a ping_parse() dictionary
+   """
+   prober = ICMPProber()
+   try:
+      ping_pool(addrs, callback, limit=limit, prober=prober.ping, **kwargs)
+   finally:
+      prober.close()
+
+def icmp_batch(addrs, limit=1000, **kwargs):
+   """
+   ping all addresses from addrs
+
+   @return a dictionary {addr: ping_parse() dictionary}
+   """
+   results = {}
+   def save(addr, result):
+      results[addr] = result
+
+   icmp_pool(addrs, save, limit=limit, **kwargs)
+   return results
+
@@ -6,6 +6,7 @@ ios.py
 @author: K.Edeline
 """
 
+import os
 import sys
 import argparse
 import configparser
@@ -69,6 +70,11 @@ class IOManager(object):
                          help='print info about non-usable nodes')
       parser.add_argument('-n' , '--names', action='store_true',
                          help='status print node names, not addresses')
+      parser.add_argument('-t' , '--top', type=int, default=0, metavar='N',
+                         help='status print the N best nodes with their scores')
+      parser.add_argument('-s' , '--sort', type=str, default="availability",
+                         choices=["availability", "rtt"],
+                         help='--top ranking (default: availability)')
 
       self.args = parser.parse_args()
       return self.args
@@ -113,16 +119,61 @@ class IOManager(object):
       self._rawfile = self._to_absolute(self.config["core"]["raw_nodes"], 
                                           root=self._nodedir)
       self.userdir  = self._to_absolute(self.user, root=self._logdir)
+      self.metricsdir = (self._to_absolute(
+                           self.config["core"].get("metrics_dir", ""))
+                         or self._logdir)
       self.pkgfile  = self._to_absolute(IOManager.PKG_FILE, root=self.userdir)
       
       self.threadlimit  = int(self.config["core"]["thread_limit"])
       self.sshlimit     = int(self.config["core"]["ssh_limit"])
       self.sshkeyloc    =     self.config["core"]["ssh_keyloc"]
+      self.sshpersist   = int(self.config["core"].get("ssh_persist", "600"))
+      self.sshmasters   = int(self.config["core"].get("ssh_masters", "200"))
+      self.pingmode     =     self.config["core"].get("ping_mode", "process")
       self.period       = int(self.config["core"]["probing_period"])
+      self.minperiod    = int(self.config["core"].get("probing_min", "600"))
+      self.maxperiod    = int(self.config["core"].get("probing_max", "604800"))
       self.initialdelay =    (self.config["core"]["initial_delay"] == 'yes')
+      self.outputmode   =     self.config["core"].get("output_capture", 
+                                                      "headtail")
+      self.outputlimit  = int(self.config["core"].get("output_limit", "8192"))
+      self.spooldir     = self._to_absolute(
+                              self.config["core"].get("output_spool_dir", ""))
+      self.bundledir    = self._to_absolute(
+                              self.config["core"].get("bundle_cache_dir", ""))
+      self.bundlesize   = int(self.config["core"].get("bundle_cache_size", 
+                                                      "1024")) << 20
+      self.historydir   = self._to_absolute(
+                              self.config["core"].get("history_dir", ""))
+      self.historydays  = tuple(int(self.config["core"].get(
+                                 "history_{}_days".format(resolution), days))
+                              for resolution, days in [("raw", "7"),
+                                 ("hourly", "90"), ("daily", "730")])
+
+      if self.pingmode not in ["process", "icmp"]:
+         raise IOManagerException("Unknown ping_mode: "+self.pingmode)
+      if self.outputmode not in ["full", "headtail", "spool", "digest"]:
+         raise IOManagerException("Unknown output_capture: "+self.outputmode)
+      if self.outputmode == "spool" and not self.spooldir:
+         raise IOManagerException("output_capture spool needs output_spool_dir")
+      if self.outputmode == "spool":
+         self._spool_dir()
 
       self._package_list()
 
+   def _spool_dir(self):
+      """
+      create the output spool dir, sessions cannot spool to a dir the 
+      daemon cannot write
+      """
+      try:
+         os.makedirs(self.spooldir, exist_ok=True)
+      except OSError as e:
+         raise IOManagerException("output_spool_dir: "+str(e))
+      if not os.access(self.spooldir, os.W_OK | os.X_OK):
+         raise IOManagerException("output_spool_dir is not writable: "
+                                  +self.spooldir)
+
    def _package_list(self):
       """
       load pkg list from file
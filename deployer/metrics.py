@@ -0,0 +1,260 @@
+"""
+metrics.py
+
+   Poller instrumentation
+
+      Counters, gauges and histograms, exported as a Prometheus textfile
+      (node_exporter textfile collector format) and as a JSON summary of
+      the last polling cycle.
+
+@author: K.Edeline
+"""
+import os
+import json
+import bisect
+
+## latency histogram buckets, in seconds
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _key(labels):
+   return tuple(sorted(labels.items()))
+
+def _escape(value):
+   return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+                    .replace('\n', '\\n')
+
+def _format_labels(key):
+   """
+   @return prometheus label set of a label key
+   """
+   if not key:
+      return ""
+   return "{" + ",".join('{}="{}"'.format(k, _escape(v))
+                           for k, v in key) + "}"
+
+class PLHistogram(object):
+   """
+   PLHistogram
+
+   """
+
+   def __init__(self, buckets=BUCKETS):
+      self.buckets = buckets
+      ## counts[i] observations <= buckets[i], last one for +Inf
+      self.counts  = [0] * (len(buckets) + 1)
+      self.sum     = 0.0
+      self.count   = 0
+      self.min     = None
+      self.max     = None
+
+   def observe(self, value):
+      self.counts[bisect.bisect_left(self.buckets, value)] += 1
+      self.sum   += value
+      self.count += 1
+      self.min    = value if self.min is None else min(self.min, value)
+      self.max    = value if self.max is None else max(self.max, value)
+
+   def quantile(self, q):
+      """
+      @return upper bound of the bucket holding the q-quantile
+      """
+      if not self.count:
+         return None
+      rank, total = q * self.count, 0
+      for bound, n in zip(self.buckets, self.counts):
+         total += n
+         if total >= rank:
+            return min(bound, self.max)
+      return self.max
+
+   def to_dict(self):
+      return {"count" : self.count,
+              "sum"   : round(self.sum, 6),
+              "mean"  : round(self.sum / self.count, 6) if self.count else None,
+              "min"   : self.min,
+              "max"   : self.max,
+              "p50"   : self.quantile(0.5),
+              "p90"   : self.quantile(0.9),
+              "p99"   : self.quantile(0.99),
+             }
+
+class PLMetrics(object):
+   """
+   PLMetrics
+
+      metrics registry, values are keyed by metric name and label set:
+
+      metrics.inc("deploypl_stage_total", stage="ping", result="ok")
+      metrics.observe("deploypl_stage_seconds", 0.2, stage="ping")
+
+      A registry created with a parent forwards all its values to it,
+      e.g. a per-cycle registry feeds the daemon lifetime one.
+   """
+
+   ## name -> (type, help)
+   METRICS = {
+      "deploypl_stage_seconds"       : ("histogram",
+                              "Duration of a probing stage on one node"),
+      "deploypl_stage_wait_seconds"  : ("histogram",
+                              "Time spent waiting for a probing stage slot"),
+      "deploypl_stage_span_seconds"  : ("gauge",
+                              "Wall time from first to last probe of a stage "
+                              "in the last cycle"),
+      "deploypl_stage_total"         : ("counter",
+                              "Probes by stage and result"),
+      "deploypl_stage_inflight"      : ("gauge",
+                              "Probes currently running, by stage"),
+      "deploypl_timeouts_total"      : ("counter",
+                              "Probes that timed out, by stage"),
+      "deploypl_errors_total"        : ("counter",
+                              "Probes that raised an error, by stage"),
+      "deploypl_ping_rtt_seconds"    : ("histogram",
+                              "Average ping round-trip time of reachable nodes"),
+      "deploypl_host_stage_seconds"  : ("gauge",
+                              "Duration of the last probing stage on a node, "
+                              "by stage and host"),
+      "deploypl_host_ping_rtt_seconds" : ("gauge",
+                              "Average ping round-trip time of the last "
+                              "ping of a node, by host"),
+      "deploypl_dns_seconds"         : ("histogram",
+                              "Duration of DNS cache refreshes"),
+      "deploypl_dns_lookups_total"   : ("counter",
+                              "DNS names looked up"),
+      "deploypl_db_flush_seconds"    : ("histogram",
+                              "Duration of node database flushes"),
+      "deploypl_db_flush_rows_total" : ("counter",
+                              "Node rows written by database flushes"),
+      "deploypl_package_checks_total"   : ("counter",
+                              "Package checks by result"),
+      "deploypl_package_installs_total" : ("counter",
+                              "Package installs by result"),
+      "deploypl_sync_total"          : ("counter",
+                              "Directory syncs by result"),
+      "deploypl_sync_bytes_total"    : ("counter",
+                              "Compressed bytes sent by directory syncs"),
+      "deploypl_fanout_total"        : ("counter",
+                              "Relay tree uploads by result: direct, relay "
+                              "or fail"),
+      "deploypl_cycles_total"        : ("counter",
+                              "Polling cycles"),
+      "deploypl_cycle_seconds"       : ("gauge",
+                              "Duration of the last polling cycle"),
+      "deploypl_cycle_nodes"         : ("gauge",
+                              "Nodes probed by the last polling cycle"),
+      "deploypl_nodes"               : ("gauge",
+                              "Nodes by state"),
+   }
+
+   def __init__(self, parent=None):
+      self.parent = parent
+      ## name -> {label key: value or PLHistogram}
+      self.values = {}
+
+   def _series(self, name):
+      if name not in PLMetrics.METRICS:
+         raise PLMetricsException("unknown metric {}".format(name))
+      return self.values.setdefault(name, {})
+
+   def inc(self, name, value=1, **labels):
+      series      = self._series(name)
+      key         = _key(labels)
+      series[key] = series.get(key, 0) + value
+      if self.parent is not None:
+         self.parent.inc(name, value, **labels)
+
+   def set(self, name, value, **labels):
+      self._series(name)[_key(labels)] = value
+      if self.parent is not None:
+         self.parent.set(name, value, **labels)
+
+   def observe(self, name, value, **labels):
+      series = self._series(name)
+      key    = _key(labels)
+      if key not in series:
+         series[key] = PLHistogram()
+      series[key].observe(value)
+      if self.parent is not None:
+         self.parent.observe(name, value, **labels)
+
+   def prune(self, name, label, keep):
+      """
+      drop the series of name whose label value is not in keep
+      """
+      series = self.values.get(name, {})
+      for key in [k for k in series if dict(k).get(label) not in keep]:
+         del series[key]
+
+   def get(self, name, **labels):
+      return self.values.get(name, {}).get(_key(labels))
+
+   def prometheus(self):
+      """
+      @return metrics in prometheus text exposition format
+      """
+      lines = []
+      for name in sorted(self.values):
+         kind, helpstr = PLMetrics.METRICS[name]
+         lines.append("# HELP {} {}".format(name, helpstr))
+         lines.append("# TYPE {} {}".format(name, kind))
+         for key, value in sorted(self.values[name].items()):
+            if kind != "histogram":
+               lines.append("{}{} {}".format(name, _format_labels(key), value))
+               continue
+
+            total = 0
+            for bound, n in zip(value.buckets + ("+Inf",), value.counts):
+               total += n
+               lines.append("{}_bucket{} {}".format(name,
+                              _format_labels(key + (("le", bound),)), total))
+            lines.append("{}_sum{} {}".format(name, _format_labels(key),
+                                              value.sum))
+            lines.append("{}_count{} {}".format(name, _format_labels(key),
+                                                value.count))
+
+      return "\n".join(lines) + "\n"
+
+   def summary(self):
+      """
+      @return metrics as a json-serializable dictionary,
+              {name: {"label=value,...": value}}
+      """
+      summary = {}
+      for name, series in self.values.items():
+         summary[name] = {}
+         for key, value in series.items():
+            labels = ",".join("{}={}".format(k, v) for k, v in key)
+            if isinstance(value, PLHistogram):
+               value = value.to_dict()
+            summary[name][labels] = value
+      return summary
+
+def write_atomic(path, data):
+   """
+   write data to path so that readers never see a partial file
+   """
+   tmp = "{}.{}.tmp".format(path, os.getpid())
+   with open(tmp, 'w') as f:
+      f.write(data)
+   os.replace(tmp, path)
+
+def export(directory, metrics, cycle=None):
+   """
+   Write metrics to directory/deploypl.prom and the cycle summary to
+   directory/deploypl-cycle.json
+   """
+   write_atomic(os.path.join(directory, "deploypl.prom"), metrics.prometheus())
+   if cycle is not None:
+      write_atomic(os.path.join(directory, "deploypl-cycle.json"),
+                   json.dumps(cycle, indent=2, sort_keys=True))
+
+class PLMetricsException(Exception):
+   """
+   PLMetricsException(Exception)
+   """
+
+   def __init__(self, value):
+      self.value = value
+
+   def __str__(self):
+      return repr(self.value)
+
@@ -9,19 +9,22 @@ import hashlib
 import enum
 import time
 import sys
+import os
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from collections import Counter
 from contextlib import contextmanager
 from pkg_resources import resource_filename
 
 from sqlalchemy import MetaData, Table, Column, DateTime
-from sqlalchemy import Integer, String, Boolean
+from sqlalchemy import Integer, String, Boolean, Float
 from sqlalchemy.types import SchemaType, TypeDecorator
 from sqlalchemy.types import Enum as SAEnum
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, bindparam, event, func
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import SingletonThreadPool
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 
 from deployer.resolver import AsyncResolver, is_valid_ipv4_address
@@ -29,6 +32,10 @@ from deployer.resolver import AsyncResolver, is_valid_ipv4_address
 
 Base = declarative_base()
 
+## tables of per-node rows keyed by node id, declared by deployer.scores,
+## deployer.scheduler, deployer.packages and deployer.sync
+NODE_TABLES = ["scores", "schedule", "packages", "syncs"]
+
 class EnumType(SchemaType, TypeDecorator):
     def __init__(self, enum, name):
         self.enum = enum
@@ -111,6 +118,30 @@ class PLNodeState(DBEnum):
    def __ge__(self, other):
       return PLNodeState_order[self.value] >= PLNodeState_order[other.value]
 
+## states greater or equal to each state, usable first
+PLNodeState_ge = {state : [s for s in PLNodeState if s >= state] 
+                     for state in PLNodeState}
+
+def node_id(name):
+   """
+   PLNode id of node name
+   """
+   return int(hashlib.sha1(bytes(name, "ascii")).hexdigest(), 
+                                                  16) % (2**63 - 1)
+
+def most_common(values):
+   """
+   Count values, most common first. Ties are ordered as PLNodeStatus
+   orders them in the database: None first, then by database value.
+
+   @return list of (value, count)
+   """
+   def key(item):
+      value, count = item
+      return (-count, value is not None, 
+              getattr(value, "value", value) if value is not None else 0)
+   return sorted(Counter(values).items(), key=key)
+
 class PLNode(Base):
    """
    PLNode
@@ -170,22 +201,35 @@ class PLNode(Base):
       Update node state from value of to_update 
       @param to_update {'name': value}
       self.__dict__.update( kwargs )
+
+      @return the set of attributes whose value changed
       """
+      changed   = set()
+      last_seen = self.last_seen
       for k, d in to_update.items():
          if "state" in k:
             self._update__state(d)
+         if getattr(self, k) != d:
+            changed.add(k)
          setattr(self, k, d)
+
+      if self.last_seen != last_seen:
+         changed.add("last_seen")
+      return changed
          
    def _update__state(self, state):
       """
-      update node state and lastseen ts
+      update node state and lastseen ts, notify state listener
       """
       if state > PLNodeState.unreachable:
          self._update_time()
 
+      listener = getattr(self, "_state_listener", None)
+      if listener is not None and state != self.state:
+         listener(self, self.state, state)
+
    def _id(self):
-      return int(hashlib.sha1(bytes(self.name, "ascii")).hexdigest(), 
-                                                     16) % (2**63 - 1)
+      return node_id(self.name)
    def __str__(self):
       return "{} node {} is in state {}".format(self.authority, 
                                                 self.name, 
@@ -197,27 +241,237 @@ class PLNode(Base):
    def __ne__(self, other):
         return not self.__eq__(other)  
 
+class PLRawFile(Base):
+   """
+   PLRawFile
+
+      raw nodes file as of its last merge
+   """
+   ## SQLAlchemy attributes
+   __tablename__ = "rawfile"
+   path   = Column(String(1024), primary_key=True)
+   size   = Column(Integer)
+   mtime  = Column(Float)
+   digest = Column(String(40))
+
+class PLDNSEntry(Base):
+   """
+   PLDNSEntry
+
+      cached A record of a node name
+   """
+   ## SQLAlchemy attributes
+   __tablename__ = "dns"
+   name        = Column(String(255), primary_key=True)
+   addr        = Column(String(64))
+   ttl         = Column(Integer)
+   resolved_at = Column(DateTime)
+   ## consecutive NXDOMAIN/NODATA answers
+   failures    = Column(Integer)
+
+   def to_dict(self):
+      return {k : getattr(self, k)
+               for k in PLDNSEntry.__table__.columns.keys()}
+
+class PLDNSCache(object):
+   """
+   PLDNSCache
+
+      DNS answers of node names. Entries are refreshed when their TTL 
+      (bounded by [MIN_TTL, MAX_TTL]) expires, names that do not exist 
+      are retried with exponential backoff. Timed out lookups keep the
+      previous answer and are retried on next refresh.
+   """
+   MIN_TTL   = 3600
+   MAX_TTL   = 86400
+   RETRY     = 3600
+   MAX_RETRY = 604800
+
+   def __init__(self):
+      ## name -> PLDNSEntry
+      self._entries = {}
+      self._dirty   = set()
+
+   def load(self, session):
+      self._entries = {e.name : e for e in session.query(PLDNSEntry).all()}
+
+   def save(self, session):
+      """
+      write entries changed since last save
+      """
+      if not self._dirty:
+         return
+      rows = [self._entries[name].to_dict() for name in self._dirty]
+      self._dirty.clear()
+      session.execute(PLDNSEntry.__table__.insert().prefix_with("OR REPLACE"),
+                      rows)
+
+   def delete(self, session, names):
+      """
+      delete entries of names
+      """
+      if not names:
+         return
+      for name in names:
+         self._entries.pop(name, None)
+         self._dirty.discard(name)
+      table = PLDNSEntry.__table__
+      session.execute(table.delete().where(table.c.name == bindparam("name")),
+                      [{"name": name} for name in names])
+
+   def get(self, name):
+      """
+      @return cached address of name, or None
+      """
+      entry = self._entries.get(name)
+      return entry.addr if entry else None
+
+   def expires(self, entry):
+      """
+      @return datetime at which entry must be refreshed
+      """
+      if entry.failures:
+         delay = min(self.MAX_RETRY, self.RETRY * 2 ** min(entry.failures-1, 32))
+      else:
+         delay = min(self.MAX_TTL, max(self.MIN_TTL, entry.ttl or 0))
+      return entry.resolved_at + timedelta(seconds=delay)
+
+   def expiry(self, name):
+      """
+      @return datetime at which name must be looked up again, None if it
+              is not cached
+      """
+      entry = self._entries.get(name)
+      return self.expires(entry) if entry else None
+
+   def due(self, names, now=None):
+      """
+      @return names that are not cached or whose entry expired
+      """
+      now = now or datetime.utcnow()
+      def is_due(name):
+         entry = self._entries.get(name)
+         return entry is None or self.expires(entry) <= now
+
+      return [name for name in names if is_due(name)]
+
+   def record(self, name, answer, now=None):
+      """
+      Update name entry from a resolver DNSAnswer
+
+      @return the cached address of name
+      """
+      now   = now or datetime.utcnow()
+      entry = self._entries.get(name)
+      if answer.status in ["timeout", "error"]:
+         # keep previous answer, retry on next refresh
+         return entry.addr if entry else None
+
+      if entry is None:
+         entry = PLDNSEntry(name=name, failures=0)
+         self._entries[name] = entry
+
+      entry.resolved_at = now
+      if answer.status == "ok":
+         entry.addr     = answer.addr
+         entry.ttl      = answer.ttl
+         entry.failures = 0
+      else:
+         # name does not exist (anymore)
+         entry.addr      = None
+         entry.ttl       = answer.ttl
+         entry.failures  = (entry.failures or 0) + 1
+
+      self._dirty.add(name)
+      return entry.addr
+
+## SQLite connection pragmas
+SQLITE_PRAGMAS = ["cache_size=-16384",    # 16MB page cache
+                  "mmap_size=268435456",  # 256MB memory-mapped I/O
+                  "busy_timeout=5000",
+                 ]
+## pragmas of the daemon (writer) connections only: switching to WAL writes
+## the database, an unprivileged reader would fail with "attempt to write a
+## readonly database"
+SQLITE_WRITER_PRAGMAS = ["journal_mode=WAL",   # readers don't block writers
+                         "synchronous=NORMAL", # safe with WAL, no fsync 
+                                               # per commit
+                        ]
+## pragmas of read-only connections
+SQLITE_READER_PRAGMAS = ["query_only=ON"]
+
+## process-wide engines and session factories, by (database location, 
+## read-only)
+_engines = {}
+
+def _pragmas(pragmas):
+   """
+   @return a "connect" event listener that sets pragmas
+   """
+   def set_pragmas(dbapi_connection, connection_record):
+      cursor = dbapi_connection.cursor()
+      for pragma in pragmas:
+         cursor.execute("PRAGMA "+pragma)
+      cursor.close()
+   return set_pragmas
+
+def get_engine(db_loc, readonly=False):
+   """
+   Returns the process-wide (engine, sessionmaker) of database db_loc.
+
+   The schema is created on first call, and again only if models were 
+   declared since then.
+
+   @param readonly open the database read-only and never create the 
+                   schema. A WAL database can only be read while its -wal 
+                   and -shm files exist (the daemon runs) and are readable,
+                   or if the database dir is writable.
+   """
+   key = (db_loc, readonly)
+   if key not in _engines:
+      # keep one connection per thread open for the process lifetime
+      if readonly:
+         engine  = create_engine('sqlite:///file:'+db_loc+'?mode=ro&uri=true',
+                                 poolclass=SingletonThreadPool)
+         pragmas = SQLITE_PRAGMAS + SQLITE_READER_PRAGMAS
+      else:
+         engine  = create_engine('sqlite:////'+db_loc, 
+                                 poolclass=SingletonThreadPool)
+         pragmas = SQLITE_WRITER_PRAGMAS + SQLITE_PRAGMAS
+      event.listen(engine, "connect", _pragmas(pragmas))
+      _engines[key] = [engine, sessionmaker(engine, expire_on_commit=False),
+                       0]
+
+   entry = _engines[key]
+   if not readonly and entry[2] != len(Base.metadata.tables):
+      Base.metadata.create_all(entry[0])
+      entry[2] = len(Base.metadata.tables)
+
+   return entry[0], entry[1]
+
 @contextmanager
-def session_scope(daemon, db_loc):
+def session_scope(daemon, db_loc, readonly=False):
    """
    Provide a transactional scope around database operations.
+
+   @param readonly see get_engine()
    """
    daemon.root()
 
-   engine = create_engine('sqlite:////'+db_loc)
-   Base.metadata.create_all(engine)
-   session = sessionmaker(engine)()
-   session.expire_on_commit = False
+   try:
+      session = get_engine(db_loc, readonly=readonly)[1]()
+   except Exception as e:
+      daemon.drop_privileges()
+      raise PLNodePoolException("Database error: {}".format(e))
 
    try:
       yield session
       session.commit()
-   except:
+   except Exception as e:
       session.rollback()
-      raise PLNodePoolException("Database error")
+      raise PLNodePoolException("Database error: {}".format(e))
    finally:
       session.close()
-      engine.dispose()
 
       daemon.drop_privileges()
 
@@ -226,114 +480,288 @@ class PLNodePool(object):
    PLNodePool
 
    """
+   ## indexed node attributes
+   INDEXES = ["id", "addr", "name"]
 
-   def __init__(self, daemon, rawfile=None):
+   def __init__(self, daemon, rawfile=None, db_loc=None):
       """
       @param raw_file contains copypaste of nodes listed in slice from PL website
+      @param db_loc database location, defaults to the package database
       """
       self.daemon = daemon
       self.pool   = []
-      self.db_loc = resource_filename(__name__, 'deploypl.sqlite')
+      ## nodes changed since last update(): id -> (node, changed attributes)
+      self._dirty = {}
+      ## node indexes: attribute value -> nodes
+      self._index = {attribute : {} for attribute in PLNodePool.INDEXES}
+      ## state buckets: state -> {id: node}
+      self._buckets = {state : {} for state in PLNodeState}
+      ## node dictionaries as of last update(), by id. Replaced, never
+      ## modified, so that it can be read from other threads
+      self.snapshot = {}
+      self.db_loc = db_loc or resource_filename(__name__, 'deploypl.sqlite')
+      self.dnscache = PLDNSCache()
       
       self._merge(rawfile)
 
    def _merge(self, rawfile):
       """
-      Load nodes from database, parse nodes from raw-nodes file,
-      Add new nodes found from file to database nodes, update self.pool,
-      and add new nodes to the database.
+      Load nodes from database, merge nodes from raw-nodes file if it 
+      changed since last merge, update self.pool.
       """
-      filepool = self._load_raw(rawfile)
       with session_scope(self.daemon, self.db_loc) as session:
 
          # Load & merge node pools
-         dbpool   = self._load_db(session)
-         newnodes = self._merge_pools(dbpool, filepool)
+         self.dnscache.load(session)
+         pool = self._load_db(session)
+         if rawfile:
+            pool = self._merge_raw(session, pool, rawfile)
 
-         # Save new nodes to db
-         session.add_all(newnodes)
+      if not pool:
+         raise PLNodePoolException("Empty node pool")
+      self._set_pool(pool)
 
-   def _lookup(self, pool):
+   def _merge_raw(self, session, dbpool, rawfile):
       """
-      Resolve names of node from pool
+      Merge raw-nodes file into database nodes, unless file size, mtime
+      and content did not change since last merge.
 
+      @return merged node pool
       """
-      if not pool:
-         return []
+      try:
+         stat   = os.stat(rawfile)
+         record = session.query(PLRawFile).filter_by(path=rawfile).first()
+         if (record and record.size == stat.st_size 
+                    and record.mtime == stat.st_mtime):
+            self.daemon.debug("raw nodes file unchanged")
+            return dbpool
+
+         digest = self._digest(rawfile)
+         if not record or record.digest != digest:
+            filenodes = self._load_raw(rawfile)
+            dbpool    = self._merge_pools(session, dbpool, filenodes)
+         else:
+            self.daemon.debug("raw nodes file content unchanged")
+      except IOError as e:
+         self.daemon.error("cannot read raw nodes file: {}".format(e))
+         return dbpool
+
+      session.merge(PLRawFile(path=rawfile, size=stat.st_size, 
+                              mtime=stat.st_mtime, digest=digest))
+      return dbpool
+
+   def _digest(self, rawfile):
+      sha1 = hashlib.sha1()
+      with open(rawfile, 'rb') as f:
+         for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha1.update(chunk)
+      return sha1.hexdigest()
 
-      # Queries
-      self.daemon.debug("Performing {} DNS lookups".format(len(pool)))
-      names    = [node.name for node in pool]
-      resolver = AsyncResolver(names)
-      res      = resolver.resolveA()
+   def _lookup(self, pool):
+      """
+      Set addresses of nodes from pool from the DNS cache, without blocking.
+      Names that are not cached are resolved by refresh_dns().
 
-      # Filter out invalid addresses
+      """
       for node in pool:
-         addr = res[node.name]
+         addr = self.dnscache.get(node.name)
          if addr and is_valid_ipv4_address(addr):
             node.addr = addr
 
-      validpool = list(filter(lambda n: n.addr != None, pool))
-      self.daemon.debug("Received {} valid DNS responses".format(len(validpool)))
+      return pool
 
-      return validpool
+   async def refresh_dns(self, intensity=100):
+      """
+      Resolve node names whose DNS cache entry is missing or expired,
+      update node addresses that changed.
+
+      @return number of names looked up
+      """
+      names = self.dnscache.due([node.name for node in self.pool])
+      if not names:
+         return 0
+
+      self.daemon.debug("Performing {} DNS lookups".format(len(names)))
+      answers = await AsyncResolver(names, intensity=intensity).resolve_async()
+
+      changed = 0
+      for name, answer in answers.items():
+         addr = self.dnscache.record(name, answer)
+         node = self._find("name", name)
+         if node is None or node.addr == addr:
+            continue
+         if addr is None and answer.status in ["timeout", "error"]:
+            continue
+
+         changed += 1
+         values = {"addr": addr}
+         if addr is None:
+            values["state"] = PLNodeState.unreachable
+         self._update_node(node, values)
+
+      self.daemon.debug("Received {} DNS responses, {} addresses changed".format(
+                                                   len(answers), changed))
+      return len(names)
 
    def update(self):
       """
-      update node table with nodes from pool
+      update node table with node attributes changed since last update, 
+      as one executemany UPDATE per set of changed columns, in a single 
+      transaction.
 
       @pre: all node from self.node are already present in the database
       """
+      if not self._dirty and not self.dnscache._dirty:
+         return
+      start = time.time()
+
+      # group nodes by changed columns
+      groups = {}
+      for node, attributes in self._dirty.values():
+         row = {a : getattr(node, a) for a in attributes}
+         row["node_id"] = node.id
+         groups.setdefault(frozenset(attributes), []).append(row)
+
+      table = PLNode.__table__
+      query = table.update().where(table.c.id == bindparam("node_id"))
       with session_scope(self.daemon, self.db_loc) as session:
-         for node in self.pool:
-            session.query(PLNode).filter_by(id=node.id).update(node.to_dict())
+         for rows in groups.values():
+            session.execute(query, rows)
+         self.dnscache.save(session)
+
+      snapshot = dict(self.snapshot)
+      for node, _ in self._dirty.values():
+         snapshot[node.id] = node.to_dict()
+      self.snapshot = snapshot
 
-      self.daemon.debug("database updated")
+      count = len(self._dirty)
+      self._dirty = {}
+      self.daemon.debug("database updated: {} nodes in {:.3f}s".format(
+                                             count, time.time() - start))
 
-   def _merge_pools(self, dbpool, filepool):
+   def _mark(self, node, attributes):
       """
-      Merge node pools, returns nodes that were not present in db
+      Mark node attributes as changed since last update
       """
-      if not dbpool and not filepool:
-         raise PLNodePoolException("Empty node pool")
+      if not attributes:
+         return
+      if node.id in self._dirty:
+         self._dirty[node.id][1].update(attributes)
+      else:
+         self._dirty[node.id] = (node, set(attributes))
 
-      # Add new file nodes to db nodes
-      newnodes = []
-      for filenode in filepool:
-         if filenode not in dbpool:
-            newnodes.append(filenode)
+   def _merge_pools(self, session, dbpool, filenodes):
+      """
+      Merge raw file nodes into database nodes:
+         insert new nodes, update authority changes with a single batched 
+         upsert, delete nodes that are no longer in boot state, along with
+         their rows in NODE_TABLES and their DNS entry.
+
+      @param filenodes {id: (name, authority)} of boot nodes from file
+      @return merged node pool
+      """
+      dbids    = {node.id for node in dbpool}
+      newnodes = [PLNode(name, auth) for i, (name, auth) in filenodes.items()
+                                       if i not in dbids]
+      changed  = [n for n in dbpool if n.id in filenodes 
+                                  and n.authority != filenodes[n.id][1]]
+      removed  = [n for n in dbpool if n.id not in filenodes]
 
-      self.daemon.debug("read {} node entries from db and {} from file".format(
-                                                            len(dbpool), 
-                                                            len(newnodes)))  
       # Lookup newnodes addresses
       newnodes = self._lookup(newnodes)    
-      
-      # Add newnodes to pool
-      self.pool = dbpool + newnodes
-      return newnodes
+      for node in changed:
+         # written by the upsert below, not by the ORM flush
+         session.expunge(node)
+         node.authority = filenodes[node.id][1]
+
+      table = PLNode.__table__
+      if newnodes or changed:
+         rows  = [dict(node.to_dict(), id=node.id) for node in newnodes+changed]
+         query = sqlite_insert(table)
+         query = query.on_conflict_do_update(index_elements=[table.c.id],
+                           set_={"authority": query.excluded.authority})
+         session.execute(query, rows)
+      if removed:
+         rows = [{"node_id": n.id} for n in removed]
+         for name in ["node"] + NODE_TABLES:
+            # tables of modules that are not loaded are left alone
+            other = Base.metadata.tables.get(name)
+            if other is not None:
+               session.execute(other.delete().where(
+                                 other.c.id == bindparam("node_id")), rows)
+         self.dnscache.delete(session, [n.name for n in removed])
+
+      self.daemon.debug("read {} node entries from db and {} from file: "
+                        "{} new, {} authority changes, {} removed".format(
+                                 len(dbpool), len(filenodes), len(newnodes),
+                                 len(changed), len(removed)))
+
+      return [n for n in dbpool if n.id in filenodes] + newnodes
+
+   def _set_pool(self, pool):
+      """
+      Replace self.pool and rebuild node indexes
+      """
+      self.pool = pool
+      for attribute, index in self._index.items():
+         index.clear()
+         for node in pool:
+            self._index_node(node, attribute)
+
+      self.snapshot = {node.id : node.to_dict() for node in pool}
+
+      for bucket in self._buckets.values():
+         bucket.clear()
+      for node in pool:
+         self._buckets[node.state][node.id] = node
+         node._state_listener = self._move_node
+
+   def _move_node(self, node, old, new):
+      """
+      PLNode state listener, move node to its new state bucket
+      """
+      self._buckets[old].pop(node.id, None)
+      self._buckets[new][node.id] = node
+
+   def _index_node(self, node, attribute):
+      value = getattr(node, attribute)
+      if value is not None:
+         self._index[attribute].setdefault(value, []).append(node)
+
+   def _unindex_node(self, node, attribute, value):
+      nodes = self._index[attribute].get(value, [])
+      if node in nodes:
+         nodes.remove(node)
+      if not nodes:
+         self._index[attribute].pop(value, None)
+
+   def _find(self, attribute, value):
+      """
+      @return the node whose indexed 'attribute' is 'value', or None
+      """
+      nodes = self._index[attribute].get(value)
+      return nodes[0] if nodes else None
 
    def _load_raw(self, rawfile):
       """
       Load nodes from rawfile
-      """
-      pool = []
-      if not rawfile:
-         return pool
 
-      # Load nodes from file
+      @return {id: (name, authority)} of nodes in boot state
+      """
+      nodes = {}
       with open(rawfile, 'r') as f:
-         # Keep 3-tuples
-         rawnodes = map(str.split, f.readlines())
-         rawnodes = [x for x in rawnodes if x]
+         for line in f:
+            # Keep 3-tuples
+            fields = line.split()
+            if len(fields) < 3:
+               continue
 
-         for name, auth, state in rawnodes:
             # Keep nodes with boot state
+            name, auth, state = fields[:3]
             if state == "boot":
-               node = PLNode(name, auth)
-               pool.append(node)
+               nodes[node_id(name)] = (name, auth)
 
-      return pool
+      return nodes
 
    def _load_db(self, session):
       """
@@ -361,19 +789,26 @@ class PLNodePool(object):
 
       # count attributes
       for a in attributes:
-         counterdict[a] = Counter([node[a] for node in pooldicts]).most_common()
+         counterdict[a] = most_common([node[a] for node in pooldicts])
 
       if string:
-         status_str = self._status_tostr(counterdict)
-         if not status_str:
-            return "No {} node found.\n".format(str(min_state) 
-                                                if min_state else "reachable")
-         else:
-            return status_str
+         return self._status_string(counterdict, min_state)
 
       return counterdict
 
-   def _status_tostr(self, status, spaced=False):
+   @staticmethod
+   def _status_string(counterdict, min_state):
+      """
+      convert status to string, or to a "no node" message
+      """
+      status_str = PLNodePool._status_tostr(counterdict)
+      if not status_str:
+         return "No {} node found.\n".format(str(min_state) 
+                                             if min_state else "reachable")
+      return status_str
+
+   @staticmethod
+   def _status_tostr(status, spaced=False):
       """
       convert status to string
       """
@@ -393,10 +828,13 @@ class PLNodePool(object):
       return "\n".join([str(node) for node in self.pool])
 
    def _filter_eq(self, state):
-      return list(filter(lambda n: n.state == state, self.pool))
+      return list(self._buckets[state].values())
 
    def _filter_ge(self, state):
-      return list(filter(lambda n: n.state >= state, self.pool)) 
+      pool = []
+      for s in PLNodeState_ge[state]:
+         pool.extend(self._buckets[s].values())
+      return pool
 
    def _set(self, attribute, attributelist):
       """
@@ -405,17 +843,31 @@ class PLNodePool(object):
       """
       assert len(self.pool) == len(attributelist)
       for i, value in enumerate(attributelist):
-         self.pool[i].update({attribute: value})
+         self._update_node(self.pool[i], {attribute: value})
 
    def _set_node(self, addr, attribute, value):
       """
       Set 'attribute' value of node with addr 'addr' to 'value'.
       
       """
-      for node in self.pool:
-         if node.addr == addr:
-            node.update({attribute: value})
-            break
+      node = self._find("addr", addr)
+      if node is not None:
+         self._update_node(node, {attribute: value})
+
+   def _update_node(self, node, values):
+      """
+      Update node from values dictionary, the change is written to the
+      database on next update().
+      """
+      indexed = {a : getattr(node, a) for a in self._index if a in values}
+      changed = node.update(values)
+      self._mark(node, changed)
+
+      # keep indexes up to date
+      for attribute, old in indexed.items():
+         if attribute in changed:
+            self._unindex_node(node, attribute, old)
+            self._index_node(node, attribute)
 
    def _update_pool(self, dictlist, min_state=None, state=None):
       """
@@ -432,7 +884,7 @@ class PLNodePool(object):
 
       assert len(dictlist) == len(pool)
       for i, d in enumerate(dictlist):
-         pool[i].update(d)
+         self._update_node(pool[i], d)
 
    def _get(self, attribute, min_state=None, state=None):
       """
@@ -448,6 +900,83 @@ class PLNodePool(object):
 
       return [getattr(node, attribute) for node in pool]
 
+class PLNodeStatus(object):
+   """
+   PLNodeStatus
+
+      Read-only node pool status, counted by the database with GROUP BY 
+      queries. Does not read raw nodes file nor perform DNS lookups, nor
+      write the database: it opens it read-only (see get_engine()).
+   """
+
+   def __init__(self, daemon, db_loc=None):
+      """
+      @param db_loc database location, defaults to the package database
+      """
+      self.daemon = daemon
+      self.db_loc = db_loc or resource_filename(__name__, 'deploypl.sqlite')
+
+      with session_scope(self.daemon, self.db_loc,
+                         readonly=True) as session:
+         empty = session.query(func.count(PLNode.id)).scalar() == 0
+      if empty:
+         raise PLNodePoolException("Empty node pool")
+
+   def _query(self, session, columns, min_state=None, state=None):
+      query = session.query(*columns)
+      if min_state != None:
+         query = query.filter(PLNode.state.in_(PLNodeState_ge[min_state]))
+      elif state != None:
+         query = query.filter(PLNode.state == state)
+      return query
+
+   def status(self, min_state=None, string=False):
+      """
+      @param min_state consider only node with state >= min_state
+      @param string return status as a string
+
+      @return node state count as a list, like PLNodePool.status()
+      """
+      counterdict = {}
+      with session_scope(self.daemon, self.db_loc,
+                         readonly=True) as session:
+         for a in PLNode.columns():
+            column = getattr(PLNode, a)
+            count  = func.count(PLNode.id)
+            query  = self._query(session, [column, count], min_state=min_state)
+            # ties ordered like most_common()
+            query  = query.group_by(column).order_by(count.desc(), 
+                                                     column.isnot(None), column)
+            counterdict[a] = [(value, n) for value, n in query]
+
+      if string:
+         return PLNodePool._status_string(counterdict, min_state)
+
+      return counterdict
+
+   def top(self, n=10, sort="availability"):
+      """
+      @return the n best nodes by sort, as scores.top_row() dictionaries
+      """
+      # scores models are declared on top of this module
+      from deployer.scores import top_scores
+      with session_scope(self.daemon, self.db_loc,
+                         readonly=True) as session:
+         return top_scores(session, n=n, sort=sort)
+
+   def _get(self, attribute, min_state=None, state=None):
+      """
+      @param min_state consider only node with state >= min_state
+
+      @return a list of nodes 'attribute'
+      """
+      column = getattr(PLNode, attribute)
+      with session_scope(self.daemon, self.db_loc,
+                         readonly=True) as session:
+         query = self._query(session, [column], min_state=min_state, 
+                                                state=state)
+         return [value for value, in query.filter(column != None)]
+
 class PLNodePoolException(Exception):
    """
    PLNodePoolException(Exception)
@@ -0,0 +1,138 @@
+"""
+packages.py
+
+   Per-node yum package manifests
+
+@author: K.Edeline
+"""
+import re
+import shlex
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, DateTime, Integer, Text
+
+from deployer.node import Base, session_scope
+
+_not_installed = re.compile(r"^package (\S+) is not installed$", re.MULTILINE)
+
+def rpm_query(pkgs):
+   """
+   @return the command line that checks which of pkgs are installed
+   """
+   return "rpm -q {}".format(" ".join(shlex.quote(p) for p in pkgs))
+
+def rpm_missing(pkgs, stdout):
+   """
+   @return the set of pkgs that rpm_query() output reports as missing
+   """
+   return set(_not_installed.findall(stdout)) & set(pkgs)
+
+def yum_install(pkgs):
+   """
+   @return the command line that installs pkgs
+   """
+   return "yum install -y --nogpgcheck {}".format(
+                              " ".join(shlex.quote(p) for p in sorted(pkgs)))
+
+class PLNodePackages(Base):
+   """
+   PLNodePackages
+
+      last known state of the wanted packages on a node
+   """
+   ## SQLAlchemy attributes
+   __tablename__ = "packages"
+   id           = Column(Integer, primary_key=True)
+   ## space-separated package names
+   installed    = Column(Text)
+   missing      = Column(Text)
+   checked_at   = Column(DateTime)
+   installed_at = Column(DateTime)
+
+   def to_dict(self):
+      return {k : getattr(self, k)
+               for k in PLNodePackages.__table__.columns.keys()}
+
+class PLPackages(object):
+   """
+   PLPackages
+
+      Package manifests of nodes, loaded from and saved to the database
+   """
+
+   def __init__(self):
+      ## node id -> PLNodePackages
+      self._entries = {}
+      self._dirty   = set()
+      ## ids of nodes to check again whatever their last check
+      self._stale   = set()
+
+   def load(self, session):
+      """
+      Load node manifests from database
+      """
+      self._entries = {e.id : e for e in session.query(PLNodePackages).all()}
+
+   def save(self, daemon, db_loc):
+      """
+      Write manifests changed since last save to database
+      """
+      if not self._dirty:
+         return
+      rows = [self._entries[i].to_dict() for i in self._dirty]
+      self._dirty.clear()
+      with session_scope(daemon, db_loc) as session:
+         session.execute(PLNodePackages.__table__.insert()
+                                             .prefix_with("OR REPLACE"), rows)
+
+   def missing(self, node):
+      """
+      @return the set of packages last found missing on node
+      """
+      entry = self._entries.get(node.id)
+      if entry is None or not entry.missing:
+         return set()
+      return set(entry.missing.split())
+
+   def due(self, node, pkgs, period, now=None):
+      """
+      @return True if the packages of node must be checked: never checked,
+              checked more than period seconds ago, checked for other
+              packages than pkgs, or marked stale
+      """
+      now   = now or datetime.utcnow()
+      entry = self._entries.get(node.id)
+      if entry is None or entry.checked_at is None or node.id in self._stale:
+         return True
+      if entry.checked_at + timedelta(seconds=period) <= now:
+         return True
+      known = set((entry.installed or "").split() +
+                  (entry.missing or "").split())
+      return known != set(pkgs)
+
+   def forget(self, node):
+      """
+      Check node packages on next install, e.g. when it just became usable
+      """
+      self._stale.add(node.id)
+
+   def record(self, node, installed, missing, install=False, now=None):
+      """
+      Record the packages found on node by a check, or by an install 
+
+      @param install True if packages were just installed
+      """
+      now   = now or datetime.utcnow()
+      entry = self._entries.get(node.id)
+      if entry is None:
+         entry = PLNodePackages(id=node.id)
+         self._entries[node.id] = entry
+
+      if install:
+         entry.installed_at = now
+      entry.installed  = " ".join(sorted(installed))
+      entry.missing    = " ".join(sorted(missing))
+      entry.checked_at = now
+      self._dirty.add(node.id)
+      self._stale.discard(node.id)
@@ -7,40 +7,112 @@ ping.py
 
 """
 import re
+import asyncio
 import subprocess
 
 _pingopt_count = "-c"
 _pingopt_deadline = "-w"
 _pingopt_quiet = "-q"
+_pingopt_period = "-i"
 
 regex1 = re.compile(r'PING ([a-zA-Z0-9.\-]+) \(')
 regex2 = re.compile(r'(\d+) packets transmitted, (\d+) received')
 regex3 = re.compile(r'(\d+.\d+)/(\d+.\d+)/(\d+.\d+)/(\d+.\d+)')
 
-def ping_process(dipaddr, progname='ping', deadline=5, quiet=True, period=None, count=1):
+def ping_argv(dipaddr, progname='ping', deadline=5, quiet=True, period=None, count=1):
    """
-   return a ping subprocess.Popen
+   return the ping command line as a list
 
    """
-   ping_argv = [progname]
+   argv = [progname]
    if quiet:
-      ping_argv += [_pingopt_quiet]
+      argv += [_pingopt_quiet]
    if period is not None:
-      ping_argv += [_pingopt_period, str(period)]
+      argv += [_pingopt_period, str(period)]
    if count is not None:
-      ping_argv += [_pingopt_count, str(count)]
+      argv += [_pingopt_count, str(count)]
    if deadline is not None:
-      ping_argv += [_pingopt_deadline, str(deadline)]
-   ping_argv += [str(dipaddr)]
+      argv += [_pingopt_deadline, str(deadline)]
+   argv += [str(dipaddr)]
+
+   return argv
+
+def ping_process(dipaddr, progname='ping', deadline=5, quiet=True, period=None, count=1):
+   """
+   return a ping subprocess.Popen
 
+   """
+   argv = ping_argv(dipaddr, progname=progname, deadline=deadline, 
+                    quiet=quiet, period=period, count=count)
    # Run subprocess
    try:
-      p=subprocess.Popen(ping_argv, stdout=subprocess.PIPE)
+      p=subprocess.Popen(argv, stdout=subprocess.PIPE)
    except subprocess.CalledProcessError: 
       pass   
 
    return p
 
+async def ping_async(dipaddr, count=1, **kwargs):
+   """
+   ping dipaddr in an asyncio subprocess
+
+   @return a ping_parse() dictionary, 0 packets received if ping could not 
+           be run or its output could not be parsed
+   """
+   argv = ping_argv(dipaddr, count=count, **kwargs)
+   try:
+      process = await asyncio.create_subprocess_exec(*argv, 
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.DEVNULL)
+      output  = (await process.communicate())[0]
+      return ping_parse(output.decode('utf-8'))
+   except (OSError, PingException):
+      return ping_failed(dipaddr, sent=count or 1)
+
+async def ping_window(addrs, callback, limit=100, prober=ping_async, **kwargs):
+   """
+   Sliding window pinger coroutine, see ping_pool()
+
+   """
+   addrs = iter(addrs)
+
+   async def worker():
+      # workers share the addrs iterator, each one starts a new probe 
+      # as soon as its previous probe completed
+      for addr in addrs:
+         result = await prober(addr, **kwargs)
+         callback(addr, result)
+
+   await asyncio.gather(*[worker() for _ in range(max(1, limit))])
+
+def ping_pool(addrs, callback, limit=100, prober=ping_async, **kwargs):
+   """
+   ping all addresses from addrs, keeping exactly `limit` probes in flight
+   until the last ones. 
+
+   @param callback called as callback(addr, result) as soon as a probe 
+                   completes, result is a ping_parse() dictionary
+   @param prober coroutine function prober(addr, **kwargs) that returns 
+                 a ping_parse() dictionary
+   """
+   loop = asyncio.new_event_loop()
+   asyncio.set_event_loop(loop)
+   try:
+      loop.run_until_complete(ping_window(addrs, callback, limit=limit, 
+                                          prober=prober, **kwargs))
+   finally:
+      asyncio.set_event_loop(None)
+      loop.close()
+
+def ping_failed(dipaddr, sent=1):
+   """
+   return a ping_parse() dictionary for a ping that received no reply
+
+   """
+   return {'host': str(dipaddr), 'sent': sent, 'received': 0, 
+         'minping': 'NaN', 'avgping': 'NaN', 'maxping': 'NaN',
+         'jitter': 'NaN'}
+
 def ping_parse(ping_output):
    """
    Parses the `ping_output` string into a dictionary containing the following
@@ -5,198 +5,696 @@ poller.py
 
 @author: K.Edeline
 """
+import os
 import time
+import shutil
+import asyncio
+import tempfile
+
+from datetime import datetime
+from collections import Counter
+
+from deployer.node import PLNodePool, PLNodeState, session_scope
+from deployer.scheduler import PLScheduler
+from deployer.scores import PLScores
+from deployer.history import PLHistory
+from deployer.packages import PLPackages, rpm_query, rpm_missing, yum_install
+from deployer.sync import PLSync, SYNC_MISMATCH, manifest_digest, diff
+from deployer.sync import write_bundle, sync_command
+from deployer.fanout import fanout_upload
+from deployer.bundle import PLBundleCache
+from deployer.ping import ping_async, PingException
+from deployer.icmp import ICMPProber, icmp_check
+from deployer.metrics import PLMetrics, export
+from deployer.ssh import run_command_async, SSHMasterPool
+from deployer.ssh import run_command
+from deployer.ssh import ssh_result, SSHOutput
+
+class PLStageSlot(object):
+   """
+   PLStageSlot
+
+      concurrency slot of a probing stage, records the time spent waiting
+      for the slot, the time spent in it and the number of probes in flight
+
+      async with PLStageSlot(poller, "ping", node.name):
+         ...
+   """
 
-from deployer.node import PLNodePool, PLNodeState
-from deployer.ping import ping_process, ping_parse
-from deployer.ssh import run_command, download, upload
+   def __init__(self, poller, stage, host):
+      self.poller = poller
+      self.stage  = stage
+      self.host   = host
+      self.start  = None
+
+   async def __aenter__(self):
+      queued = time.time()
+      await self.poller._stages[self.stage].acquire()
+      self.start = time.time()
+
+      metrics = self.poller.cycle
+      metrics.observe("deploypl_stage_wait_seconds", self.start - queued,
+                      stage=self.stage)
+      self._inflight(1)
+      self.poller._spans.setdefault(self.stage, [self.start, self.start])
+      return self
+
+   async def __aexit__(self, exc_type, exc, tb):
+      end = time.time()
+      self.poller._stages[self.stage].release()
+
+      self.poller.cycle.observe("deploypl_stage_seconds", end - self.start,
+                                stage=self.stage)
+      # per host last values, histograms are not split by host
+      self.poller.cycle.set("deploypl_host_stage_seconds", end - self.start,
+                            stage=self.stage, host=self.host)
+      self._inflight(-1)
+      self.poller._spans[self.stage][1] = end
+
+   def _inflight(self, delta):
+      inflight = self.poller._inflight
+      inflight[self.stage] += delta
+      self.poller.cycle.set("deploypl_stage_inflight", inflight[self.stage],
+                            stage=self.stage)
 
 class PLPoller(PLNodePool):
    """
    PLPoller
 
+      Each node walks through the probing stages on its own:
+         ping -> ssh -> profile -> fix
+      and moves to the next stage as soon as its previous probe succeeded.
+      Every stage has its own concurrency limit.
    """
 
+   ## seconds between two database flushes while polling
+   FLUSH_PERIOD   = 1
+   ## seconds between two metrics exports while polling
+   METRICS_PERIOD = 15
+   ## output kept from ping/ssh/profile stage sessions
+   PROBE_OUTPUT   = SSHOutput("headtail", head=4096, tail=4096)
+   ## nodes a full sync needs before its bundle goes through a relay tree
+   FANOUT_MIN     = 16
+
    def __init__(self, daemon, plslice=None, user=None, rawfile=None, 
                       initialdelay=0, period=3600,
-                      threadlimit=10, sshlimit=10):
-      super(PLPoller, self).__init__(daemon, rawfile=rawfile)
+                      threadlimit=10, sshlimit=10, pingmode="process",
+                      sshpersist=600, sshmasters=200,
+                      minperiod=600, maxperiod=604800, db_loc=None,
+                      metricsdir=None, sshoutput=None, bundledir=None,
+                      bundlesize=1 << 30, historydir=None, 
+                      historydays=(7, 90, 730)):
+      super(PLPoller, self).__init__(daemon, rawfile=rawfile, db_loc=db_loc)
 
       self.initialdelay = 0
       self.period  = period
       self.threadlimit = threadlimit
       self.sshlimit = sshlimit
+      self.pingmode = pingmode
+      if pingmode == "icmp":
+         try:
+            icmp_check()
+         except PingException as e:
+            self.daemon.warn("{}, pinging with ping processes".format(
+                             e.value))
+            self.pingmode = "process"
       self.user     = user
       self.slice    = plslice
       self._uptime  = time.time()
 
+      ## per stage concurrency limits
+      self.limits   = {"ping"    : threadlimit,
+                       "ssh"     : sshlimit,
+                       "profile" : sshlimit,
+                       "fix"     : sshlimit,
+                      }
+      self._stages  = None
+      self._pinger  = None
+      ## background DNS refresh of the current cycle
+      self._resolver = None
+
+      ## instrumentation: daemon lifetime and current cycle metrics
+      self.metricsdir = metricsdir
+      self.metrics    = PLMetrics()
+      self.cycle      = PLMetrics(parent=self.metrics)
+      ## last exported metrics, read from other threads
+      self.metrics_snapshot = {}
+      ## node id -> ping result of the current cycle
+      self._pings     = {}
+      self._inflight  = Counter()
+      ## stage -> [first probe start, last probe end] of current cycle
+      self._spans     = {}
+
+      ## ssh master connections, shared by all stages and cycles
+      self.masters  = SSHMasterPool(persist=sshpersist, limit=sshmasters)
+      ## output kept from package management sessions
+      self.sshoutput = sshoutput or SSHOutput("headtail")
+
+      ## when to probe each node
+      self.scheduler = PLScheduler(period=period, minperiod=minperiod,
+                                   maxperiod=maxperiod)
+      ## packages found on nodes
+      self.packages  = PLPackages()
+      ## rolling rtt, loss and availability of nodes
+      self.scores    = PLScores()
+      ## probes of nodes, (raw, hourly, daily) days kept
+      self.history   = PLHistory(historydir or os.path.join(
+                                 os.path.dirname(self.db_loc), "history"),
+                                 raw_days=historydays[0], 
+                                 hourly_days=historydays[1],
+                                 daily_days=historydays[2])
+      ## manifests synced to nodes
+      self.sync      = PLSync()
+      ## compressed bundles of synced directories, by content
+      self.bundles   = PLBundleCache(bundledir, maxsize=bundlesize)
+      with session_scope(self.daemon, self.db_loc) as session:
+         self.scheduler.load(session)
+         self.packages.load(session)
+         self.scores.load(session)
+         self.sync.load(session)
+
+   def close(self):
+      """
+      release resources kept across cycles: ssh masters and their control
+      sockets, temporary bundles
+      """
+      self.masters.close()
+      self.bundles.close()
+
    def uptime(self):
       return time.time() - self._uptime
 
    def run(self):
       self.timer.start()
 
-   def _ping(self):
+   async def _run_command(self, host, cmd, timeout=10, sudo=False, 
+                          output=None):
+      if host is None:
+         # address removed by the background DNS refresh
+         return ssh_result(host, 0, b"", b"", None, ["No address"])
+      return await run_command_async(host, self.slice, cmd, timeout=timeout,
+                                     keyloc=self.daemon.sshkeyloc, sudo=sudo,
+                                     masters=self.masters, 
+                                     output=output or self.PROBE_OUTPUT)
+
+   async def _ping(self, node):
       """
-      ping in subprocess.Popen
+      reachable stage: ping node
 
       """
-      self.daemon.debug("pinging ...")
-      
-      chunk_size = self.threadlimit
-      addrs      = self._get("addr")
-      states     = []
+      async with PLStageSlot(self, "ping", node.name):
+         result = await self._pinger(node.addr)
+
+      # save result
+      self._pings[node.id] = result
+      if result['received'] > 0:
+         rtt = float(result['avgping']) / 1000
+         self.cycle.observe("deploypl_ping_rtt_seconds", rtt)
+         self.cycle.set("deploypl_host_ping_rtt_seconds", rtt, host=node.name)
+         self._update_node(node, {"state": PLNodeState.reachable})
+         return True
+
+      self._update_node(node, {"state": PLNodeState.unreachable})
+      return False
+
+   async def _ssh(self, node, timeout=10):
+      """
+      accessible stage: test if an ssh session can be established
 
-      for i in range(0, len(self.pool), chunk_size):
-         chunk     = addrs[i:i+chunk_size]
-         processes = []
+      """
+      async with PLStageSlot(self, "ssh", node.name):
+         hostdata = await self._run_command(node.addr, 
+                                    "mkdir -p {}".format(self.user),
+                                    timeout=timeout)
 
-         # Run a bunch of pings
-         for addr in chunk:
-            processes.append(ping_process(addr))
+      # if an ssh session was established, update node state
+      if hostdata['status'] != 0:
+         self._timed_out("ssh", hostdata)
+         return False
 
-         # waits for them to complete and update nodes
-         for process in processes:
-            process.wait()
-            ping_output = process.communicate()[0].decode('utf-8')
-            result      = ping_parse(ping_output)
-            answer      = 'received'
-            
-            # save result
-            if result[answer] > 0:
-               states.append(PLNodeState.reachable)
-            else: 
-               states.append(PLNodeState.unreachable)
+      self._update_node(node, {"state": PLNodeState.accessible})
+      return True
 
-      self._set("state", states)
-      self.daemon.debug("ping completed")
+   async def _profile(self, node, timeout=30):
+      """
+      usable stage: get kernel, distrib, ip, vsys, 
 
-   def _run_command(self, hosts, cmd, timeout=10, sudo=False):
-      return run_command(hosts, self.slice, cmd, timeout=timeout,
-                                threads=self.sshlimit,
-                                keyloc=self.daemon.sshkeyloc, sudo=sudo)
+      """
+      async with PLStageSlot(self, "profile", node.name):
+         hostdata = await self._run_command(node.addr, "echo 'magic'; uname -sr; "
+                                           "cat /etc/*-release"
+                                           " | head -n 1; sudo -S ls /vsys/;",
+                                           timeout=timeout)
+      if hostdata['status'] not in [0,1,2,3,4,5]:
+         self._timed_out("profile", hostdata)
+         return False
+
+      # Some info about the node     
+      profile = {}
+      stdout  = hostdata['stdout'].splitlines()
+      try:
+         if "magic" in stdout[0]:
+            profile["kernel"] = stdout[1]
+            profile["os"]     = stdout[2]
+            profile["vsys"]   = ("fd_tuntap.control" in stdout[3])
+      except: pass
+
+      # Update node
+      profile["state"] = PLNodeState.usable
+      self._update_node(node, profile)
+      return True
+
+   async def _fix(self, node, timeout=120):
+      """
+      check for broken packet manager (& fix)
 
-   def _ssh(self, timeout=10):
       """
-      test if an ssh session can be established
+      async with PLStageSlot(self, "fix", node.name):
+         hostdata = await self._run_command(node.addr, 
+                                    "yum install -y --nogpgcheck python",
+                                    sudo=True, timeout=timeout,
+                                    output=self.sshoutput)
+      if hostdata['status'] == 0:
+         stdout = hostdata['stdout']
+         #if "metalink" in stdout:
+         #   self.daemon.debug("yum error") #XXX fix repo ?
+         #   self.daemon.debug(str(hostdata))
+         return True
+
+      self.daemon.debug("yum failed on {}: status {} {}, stderr ({} bytes): "
+                        "{}".format(node.addr, hostdata['status'], 
+                                    hostdata['errors'], 
+                                    hostdata.get('stderr_bytes', 0),
+                                    hostdata['stderr'][-512:].strip()))
+      self._timed_out("fix", hostdata)
+      self._update_node(node, {"state": PLNodeState.accessible})
+      return False
+
+   def _timed_out(self, stage, hostdata):
+      """
+      count failed ssh commands that timed out
+      """
+      if "Timed out" in hostdata['errors']:
+         self.cycle.inc("deploypl_timeouts_total", stage=stage)
 
+   async def _probe(self, node):
       """
+      walk node through the probing stages, stop at first failure
 
-      ## Step 1. Establish ssh session
-      hosts  = self._get("addr", min_state=PLNodeState.reachable)
-      if len(hosts) == 0:
-         self.daemon.debug("no reachable node found, stopping ...")
+      """
+      if node.addr is None and self._resolver is not None:
+         # may be resolved by the background DNS refresh
+         await asyncio.wait([self._resolver])
+      if node.addr is None:
+         # name does not resolve, retry once its DNS entry expires
+         self.scheduler.defer(node, self.dnscache.expiry(node.name))
+         return
+      previous = node.state
+      stages = [("ping",    self._ping),    ("ssh", self._ssh), 
+                ("profile", self._profile), ("fix", self._fix)]
+      try:
+         for name, stage in stages:
+            # address removed by the background DNS refresh
+            if node.addr is None:
+               break
+            ok = await stage(node)
+            self.cycle.inc("deploypl_stage_total", stage=name,
+                           result="ok" if ok else "fail")
+            if not ok:
+               break
+      except Exception as e:
+         self.cycle.inc("deploypl_errors_total", stage=name)
+         self.daemon.error("probing {} failed: {}".format(node.name, e))
+         self._pings.pop(node.id, None)
          return
-      self.daemon.debug("ssh probing {} nodes via PL slice {} ...".format(
-                        len(hosts), self.slice))
-      output = self._run_command(hosts, "mkdir -p {}".format(self.user))
 
-      # if an ssh session was established, update node state
-      for hostdata in output:
-         host = hostdata['host']
-         if hostdata['status'] == 0:
-            self._set_node(host, "state", PLNodeState.accessible)
+      self.scheduler.record(node)
+      if node.state == PLNodeState.usable and previous != PLNodeState.usable:
+         # came back, maybe reinstalled
+         self.packages.forget(node)
+         self.sync.forget(node)
+      ping = self._pings.pop(node.id, None)
+      self.scores.record(node, ping, node.state)
+      self.history.append(node.id, name, node.state, ping=ping)
 
-      self.daemon.debug("ssh probing completed")
+   async def _resolve(self):
+      """
+      refresh node addresses from DNS
 
-   def _profile(self, num_retries=3, timeout=10):
       """
-      get kernel, distrib, ip, vsys, 
-      check for broken packet manager (& fix)
+      start = time.time()
+      try:
+         lookups = await self.refresh_dns()
+      except Exception as e:
+         self.daemon.error("DNS refresh failed: {}".format(e))
+         return
+      if lookups:
+         self.cycle.observe("deploypl_dns_seconds", time.time() - start)
+         self.cycle.inc("deploypl_dns_lookups_total", lookups)
+
+   async def _flusher(self):
       """
+      write node changes to the database as they happen
 
-      ## Step 2. Fingerprinting
-      hosts = self._get("addr", min_state=PLNodeState.accessible)
-      if len(hosts) == 0:
-         self.daemon.debug("no accessible node found, stopping ...")
-         return
+      """
+      last = time.time()
+      while True:
+         await asyncio.sleep(self.FLUSH_PERIOD)
+         self.update()
+         # live metrics of long cycles
+         if time.time() - last >= self.METRICS_PERIOD:
+            self.export_metrics()
+            last = time.time()
+
+   async def _pipeline(self, nodes):
+      """
+      probe nodes concurrently, within per-stage limits
 
-      self.daemon.debug("start profiling {} ssh-accessible nodes".format(len(hosts)))
-      output = self._run_command(hosts, "echo 'magic'; uname -sr; "
-                                        "cat /etc/*-release"
-                                        " | head -n 1; sudo -S ls /vsys/;",
-                                        timeout=30)
-      for hostdata in output:
-         host = hostdata['host']
-         profile = {}
-
-         if hostdata['status'] in [0,1,2,3,4,5]:
-
-            # Some info about the node     
-            stdout = hostdata['stdout'].splitlines()
-            try:
-               if "magic" in stdout[0]:
-                  profile["kernel"] = stdout[1]
-                  profile["os"]     = stdout[2]
-                  profile["vsys"]   = ("fd_tuntap.control" in stdout[3])
-            except: pass
-
-            # Update node
-            for k, d in profile.items():
-               self._set_node(host, k, d)
-            self._set_node(host, "state", PLNodeState.usable)
+      """
+      self._stages = {stage: asyncio.Semaphore(limit) 
+                        for stage, limit in self.limits.items()}
+      prober = None
+      if self.pingmode == "icmp":
+         prober = ICMPProber()
+         self._pinger = prober.ping
+      else:
+         self._pinger = ping_async
+
+      flusher  = asyncio.ensure_future(self._flusher())
+      # resolve expired names in background
+      resolver = self._resolver = asyncio.ensure_future(self._resolve())
+      try:
+         await asyncio.gather(*[self._probe(node) for node in nodes])
+         await resolver
+      finally:
+         self._resolver = None
+         resolver.cancel()
+         flusher.cancel()
+         if prober:
+            prober.close()
+
+   def update(self):
+      """
+      write node and schedule changes to the database
+      """
+      start = time.time()
+      rows  = len(self._dirty)
+      super(PLPoller, self).update()
+      self.scheduler.save(self.daemon, self.db_loc)
+      self.scores.save(self.daemon, self.db_loc)
+      try:
+         self.history.flush()
+      except OSError as e:
+         self.daemon.error("cannot write probe history: {}".format(e))
+      if rows:
+         self.cycle.observe("deploypl_db_flush_seconds", time.time() - start)
+         self.cycle.inc("deploypl_db_flush_rows_total", rows)
+
+   def export_metrics(self, summary=None):
+      """
+      update node gauges, publish metrics snapshot and write them to 
+      metricsdir
 
-         else:
-            self._set_node(host, "state", PLNodeState.accessible)
-
-      ## Step 3. Finding common bugs (repo, ro system, )
-      hosts = self._get("addr", min_state=PLNodeState.usable)
-      if len(hosts) == 0:
-         self.daemon.debug("no usable node found, stopping ...")
-
-      self.daemon.debug("chasing bugs on {} nodes".format(len(hosts)))
-      output = self._run_command(hosts, "yum install -y --nogpgcheck python",
-                                    sudo=True, timeout=120)
-      for hostdata in output:
-         host = hostdata['host']
-
-         if hostdata['status'] == 0:
-            stdout = hostdata['stdout']
-            #if "metalink" in stdout:
-            #   self.daemon.debug("yum error") #XXX fix repo ?
-            #   self.daemon.debug(str(hostdata))
-         else:
-            self.daemon.debug(str(hostdata))
-            self._set_node(host, "state", PLNodeState.accessible)
+      @param summary cycle summary, written along the prometheus textfile
+      """
+      for state, bucket in self._buckets.items():
+         self.metrics.set("deploypl_nodes", len(bucket), state=state.value)
+      # series of nodes that left the pool
+      names = {node.name for node in self.pool}
+      for name in ["deploypl_host_stage_seconds", 
+                   "deploypl_host_ping_rtt_seconds"]:
+         self.metrics.prune(name, "host", names)
+
+      self.metrics_snapshot = {"metrics" : self.metrics.summary(),
+                               "cycle"   : summary or 
+                                           self.metrics_snapshot.get("cycle")}
+      if not self.metricsdir:
+         return
+      try:
+         export(self.metricsdir, self.metrics, cycle=summary)
+      except OSError as e:
+         self.daemon.error("cannot write metrics: {}".format(e))
 
-      self.daemon.debug("node profiling completed")
+   def sleep_time(self, mintime=60):
+      """
+      @return seconds until the next node is due, at least mintime
+      """
+      delta = self.scheduler.next_probe(self.pool) - datetime.utcnow()
+      return min(self.period, max(mintime, delta.total_seconds()))
 
-   def poll(self):
+   def poll(self, nodes=None):
       """
       Poll nodepool, retreive node pool status&profile and
       update database.
+
+      @param nodes nodes to probe, defaults to nodes whose probe is due
       """
       start = time.time()      
-      
-      self._ping()
-      self.update()
-
-      self._ssh()   
-      self.update()
-
-      self._profile()
-      self.update()
+      if nodes is None:
+         nodes = self.scheduler.due(self.pool)
+      # best candidates first, they get the first stage slots
+      nodes = self.scores.rank(nodes)
+      self.daemon.debug("probing {} nodes via PL slice {} ...".format(
+                        len(nodes), self.slice))
+
+      self.cycle  = PLMetrics(parent=self.metrics)
+      self._spans = {}
+      loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(loop)
+      try:
+         loop.run_until_complete(self._pipeline(nodes))
+      finally:
+         asyncio.set_event_loop(None)
+         loop.close()
+         self.update()
+
+      duration = time.time() - start
+      for stage, (first, last) in self._spans.items():
+         self.cycle.set("deploypl_stage_span_seconds", last - first,
+                        stage=stage)
+      self.cycle.inc("deploypl_cycles_total")
+      self.cycle.set("deploypl_cycle_seconds", duration)
+      self.cycle.set("deploypl_cycle_nodes", len(nodes))
+      try:
+         self.history.downsample()
+      except OSError as e:
+         self.daemon.error("cannot downsample probe history: {}".format(e))
+      self.export_metrics(summary={"start"   : datetime.utcfromtimestamp(
+                                                         start).isoformat(),
+                                   "seconds" : round(duration, 3),
+                                   "nodes"   : len(nodes),
+                                   "metrics" : self.cycle.summary()})
 
       ## XXX if reseted or first time
-      self.daemon.debug("polling completed")
+      self.daemon.debug("polling completed in {:.1f}s".format(duration))
 
-      return time.time() - start
+      return duration
 
-   def install_packages(self, pkgs):
+   def install_packages(self, pkgs, timeout=600):
       """
       install_packages
+
+         check which packages are installed on usable nodes with one rpm
+         query per node, then install the missing ones only, on all nodes
+         in parallel. Nodes are checked once per period, or as soon as
+         they become usable or pkgs changes.
         
       @param pkgs list of yum packages         
       """
-      pass
+      pkgs  = sorted(set(pkgs))
+      hosts = {node.addr : node for node in self._filter_ge(PLNodeState.usable)
+                                if node.addr is not None 
+                                and self.packages.due(node, pkgs, self.period)}
+      if not pkgs or not hosts:
+         return
+
+      # host -> yum command line of its missing packages
+      commands = {}
+      def checked(result):
+         node = hosts[result['host']]
+         if result['status'] in [None, 255]:
+            self.cycle.inc("deploypl_package_checks_total", result="fail")
+            return
+         missing = rpm_missing(pkgs, result['stdout'])
+         self.packages.record(node, set(pkgs) - missing, missing)
+         self.cycle.inc("deploypl_package_checks_total", result="ok")
+         if missing:
+            commands[result['host']] = yum_install(missing)
+
+      run_command(list(hosts), self.slice, rpm_query(pkgs), 
+                  keyloc=self.daemon.sshkeyloc, timeout=30, 
+                  threads=self.limits["ssh"], masters=self.masters,
+                  callback=checked)
+
+      def installed(result):
+         node = hosts[result['host']]
+         if result['status'] == 0:
+            self.packages.record(node, set(pkgs), set(), install=True)
+            self.cycle.inc("deploypl_package_installs_total", result="ok")
+            return
+         self.cycle.inc("deploypl_package_installs_total", result="fail")
+         self.daemon.debug("yum failed on {}: status {} {}, stderr: {}".format(
+                           result['host'], result['status'], result['errors'],
+                           result['stderr'][-512:].strip()))
+
+      if commands:
+         self.daemon.debug("installing packages on {} nodes".format(
+                                                            len(commands)))
+         run_command(list(commands), self.slice, commands, 
+                     keyloc=self.daemon.sshkeyloc, timeout=timeout, 
+                     threads=self.limits["fix"], sudo=True, 
+                     masters=self.masters, callback=installed, 
+                     output=self.sshoutput)
+
+      self.packages.save(self.daemon, self.db_loc)
+      self.daemon.debug("packages checked on {} nodes, {} up to date".format(
+                        len(hosts), len(hosts) - len(commands)))
+
+   def distribute(self, localfile, remotefile, hosts=None, seeds=4, 
+                  degree=4, timeout=600):
+      """
+      distribute
+
+         copy localfile to usable nodes through a relay tree seeded
+         with the nodes of lowest ping rtt, see deployer.fanout
 
-   def sync_data(self, dirloc):
+      @param remotefile destination, relative to the slice home directory
+      @param hosts addresses of the nodes to copy to, all usable nodes
+                   if None
+      @return the set of addresses of the nodes that received localfile
+      """
+      wanted   = None if hosts is None else set(hosts)
+      hosts    = {node.addr : node 
+                     for node in self._filter_ge(PLNodeState.usable)
+                     if node.addr is not None 
+                        and (wanted is None or node.addr in wanted)}
+      rtts     = {addr : self.scores.rtt(node) for addr, node in hosts.items()}
+      done     = Counter()
+      received = set()
+      def copied(result):
+         if result['relay_failed'] is not None:
+            self.daemon.debug("relay {} -> {} failed".format(
+                              result['relay_failed'], result['host']))
+         if result['status'] != 0:
+            done["fail"] += 1
+            self.daemon.debug("upload to {} failed: status {} {}".format(
+                              result['host'], result['status'], 
+                              result['errors']))
+         else:
+            done["relay" if result['relay'] is not None else "direct"] += 1
+            received.add(result['host'])
+
+      fanout_upload(list(hosts), self.slice, localfile, remotefile, rtts=rtts,
+                    keyloc=self.daemon.sshkeyloc, seeds=seeds, degree=degree,
+                    threads=self.limits["fix"], timeout=timeout, 
+                    callback=copied, output=self.sshoutput)
+      for kind, count in done.items():
+         self.cycle.inc("deploypl_fanout_total", count, result=kind)
+      self.daemon.debug("{} distributed to {} nodes: {} direct, {} relayed, "
+                        "{} failed".format(localfile, len(hosts), 
+                        done["direct"], done["relay"], done["fail"]))
+      return received
+
+   def sync_data(self, dirloc, timeout=300):
       """
       sync_data
 
+         send the files of dirloc that changed since the last sync of each
+         usable node, as one tar stream per node. Up to date nodes only
+         check their manifest marker, once per period or as soon as they
+         become usable, nodes that do not hold the manifest recorded for 
+         them get the whole directory.
+
       @dirloc location of directory to be rsynced to all nodes
       """
-      pass
+      if not dirloc or not os.path.isdir(dirloc):
+         return
+      remotedir = os.path.basename(os.path.normpath(dirloc))
+      manifest  = self.sync.scan(dirloc)
+      digest    = manifest_digest(manifest)
+      hosts = {node.addr : node for node in self._filter_ge(PLNodeState.usable)
+                                if node.addr is not None and self.sync.due(
+                                    node, remotedir, digest, self.period)}
+      if not hosts:
+         return
+
+      workdir   = tempfile.mkdtemp(prefix="deploypl-sync-")
+
+      # base digest -> (command line, bundle path), shared by all nodes
+      # synced from the same manifest
+      deltas = {}
+      def delta(base):
+         if base not in deltas:
+            changed, removed = diff(self.sync.manifest(base), manifest)
+            bundle = None
+            if base is None:
+               bundle = self.bundles.get([dirloc])
+            elif changed:
+               bundle = os.path.join(workdir, "{}.tar.gz".format(base))
+               write_bundle(dirloc, changed, bundle)
+            deltas[base] = (sync_command(remotedir, digest, base=base, 
+                                         removed=removed, 
+                                         bundle=bundle is not None), bundle)
+         return deltas[base]
+
+      mismatch = set()
+      def synced(result):
+         node = hosts[result['host']]
+         base = self.sync.base(node, remotedir)
+         if result['status'] == 0:
+            kind = "uptodate" if base == digest else "delta"
+            if result['host'] in mismatch or base is None:
+               kind = "full"
+            self.sync.record(node, remotedir, digest, manifest)
+            self.cycle.inc("deploypl_sync_total", result=kind)
+            return
+         if (result['status'] == SYNC_MISMATCH 
+               and result['host'] not in mismatch):
+            mismatch.add(result['host'])
+            return
+         self.cycle.inc("deploypl_sync_total", result="fail")
+         self.daemon.debug("sync failed on {}: status {} {}, stderr: {}".format(
+                           result['host'], result['status'], result['errors'],
+                           result['stderr'][-512:].strip()))
+
+      def sync(hosts, bases):
+         commands, bundles = {}, {}
+         for host, base in bases.items():
+            commands[host], bundles[host] = delta(base)
+
+         # the whole directory goes through a relay tree when many nodes
+         # need it, nodes it did not reach get it on standard input
+         full = [host for host, base in bases.items() if base is None]
+         if len(full) >= self.FANOUT_MIN:
+            bundle = bundles[full[0]]
+            remote = ".deploypl-" + os.path.basename(bundle)
+            for host in self.distribute(bundle, remote, hosts=full,
+                                        timeout=timeout):
+               commands[host] = sync_command(remotedir, digest, bundle=remote)
+               bundles[host]  = None
+
+         for bundle in bundles.values():
+            if bundle is not None:
+               self.cycle.inc("deploypl_sync_bytes_total", 
+                              os.path.getsize(bundle))
+         run_command(hosts, self.slice, commands, 
+                     keyloc=self.daemon.sshkeyloc, timeout=timeout, 
+                     threads=self.limits["fix"], masters=self.masters, 
+                     callback=synced, output=self.sshoutput, stdin=bundles)
+
+      try:
+         sync(list(hosts), {host : self.sync.base(node, remotedir)
+                              for host, node in hosts.items()})
+         if mismatch:
+            self.daemon.debug("{} nodes out of sync, sending {}".format(
+                              len(mismatch), dirloc))
+            sync(list(mismatch), {host : None for host in mismatch})
+      finally:
+         shutil.rmtree(workdir, ignore_errors=True)
+
+      self.sync.save(self.daemon, self.db_loc)
+      self.daemon.debug("{} synced to {} nodes from {} manifests".format(
+                        dirloc, len(hosts), len(deltas)))
 
 
 class PLPollerException(Exception):
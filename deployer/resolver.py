@@ -1,54 +1,282 @@
 """
 resolver.py
 
-   Asynchronous dns resolver (adns wrapper)
+   Asynchronous dns resolver (asyncio, UDP, TCP for truncated answers)
 
 @author: K.Edeline
 """
+import random
 import socket
-import adns
+import struct
+import asyncio
+
+from collections import namedtuple
+
+RR_A      = 1
+RR_CNAME  = 5
+CLASS_IN  = 1
+
+RCODE_NOERROR  = 0
+RCODE_NXDOMAIN = 3
+
+FLAG_TC = 0x0200
+
+## status: "ok", "nxdomain", "nodata", "timeout" or "error"
+DNSAnswer = namedtuple("DNSAnswer", ["addr", "ttl", "status"])
+
+_header = struct.Struct("!HHHHHH")
+_rr     = struct.Struct("!HHIH")
+
+def nameservers(resolvconf="/etc/resolv.conf"):
+    """ Returns IPv4 nameservers from resolv.conf """
+    servers = []
+    try:
+        with open(resolvconf, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if (len(fields) >= 2 and fields[0] == "nameserver"
+                        and is_valid_ipv4_address(fields[1])):
+                    servers.append(fields[1])
+    except IOError:
+        pass
+    return servers or ["127.0.0.1"]
+
+def dns_query(qid, name, qtype=RR_A):
+    """ Returns a recursive DNS query packet """
+    qname = b"".join(bytes([len(label)]) + label
+                     for label in name.rstrip(".").encode("idna").split(b"."))
+    return (_header.pack(qid, 0x0100, 1, 0, 0, 0) + qname + b"\x00"
+            + struct.pack("!HH", qtype, CLASS_IN))
+
+def _read_name(data, offset):
+    """ Returns (name, offset after name), follows compression pointers """
+    labels = []
+    end    = None
+    jumps  = 0
+    while True:
+        length = data[offset]
+        if length & 0xc0 == 0xc0:
+            if jumps > 16:
+                raise ValueError("DNS name compression loop")
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3f) << 8) | data[offset + 1]
+            jumps += 1
+        elif length == 0:
+            offset += 1
+            break
+        else:
+            labels.append(data[offset + 1:offset + 1 + length])
+            offset += 1 + length
+
+    name = b".".join(labels).decode("ascii", "replace").lower()
+    return name, (end if end is not None else offset)
+
+def dns_parse(data):
+    """
+    Parses a DNS response
+
+    Returns (qid, rcode, qname, records), records being a list of
+    (name, type, ttl, value) where value is an address for A records,
+    a name for CNAME records.
+    """
+    qid, flags, qdcount, ancount, _, _ = _header.unpack_from(data)
+    offset  = _header.size
+    qname   = None
+    for _ in range(qdcount):
+        qname, offset = _read_name(data, offset)
+        offset += 4
+
+    records = []
+    for _ in range(ancount):
+        name, offset = _read_name(data, offset)
+        rtype, _, ttl, rdlength = _rr.unpack_from(data, offset)
+        offset += _rr.size
+        if rtype == RR_A and rdlength == 4:
+            records.append((name, rtype, ttl,
+                            socket.inet_ntoa(data[offset:offset + 4])))
+        elif rtype == RR_CNAME:
+            records.append((name, rtype, ttl, _read_name(data, offset)[0]))
+        offset += rdlength
+
+    return qid, flags & 0x0f, qname, records
+
+def dns_truncated(data):
+    """ Returns True if the DNS response has its TC (truncated) bit set """
+    return bool(struct.unpack_from("!H", data, 2)[0] & FLAG_TC)
+
+def _min_ttl(ttl, record):
+    return record[2] if ttl is None else min(ttl, record[2])
+
+class _DNSProtocol(asyncio.DatagramProtocol):
+    def __init__(self, pending):
+        self.pending = pending
+
+    def datagram_received(self, data, addr):
+        if len(data) < _header.size:
+            return
+        qid   = struct.unpack_from("!H", data)[0]
+        query = self.pending.get(qid)
+        if query is None:
+            return
+        future, server = query
+        if addr[0] == server and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        pass
 
 class AsyncResolver(object):
-    def __init__(self, hosts, intensity=100):
+    def __init__(self, hosts, intensity=100, servers=None, port=53,
+                 timeout=2, retries=2, max_cname=8):
         """
         hosts: a list of hosts to resolve
         intensity: how many hosts to resolve at once
+        servers: nameservers addresses, defaults to resolv.conf ones
+        timeout: seconds before a query is sent again
+        retries: number of times a query is sent again
+        max_cname: CNAME chain depth limit
         """
         self.hosts = hosts
         self.intensity = intensity
-        self.adns = adns.init()
+        self.servers = servers or nameservers()
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.max_cname = max_cname
+
+        self._transport = None
+        self._pending = {}
 
     def resolveA(self):
-        """ Resolves hosts and returns a dictionary of { 'host': 'ip' }. """
-        resolved_hosts = {}
-        active_queries = {}
-        host_queue = self.hosts[:]
-
-        def collect_results():
-            for query in self.adns.completed():
-                answer = query.check()
-                host = active_queries[query]
-                del active_queries[query]
-                if answer[0] == 0:
-                    ip = answer[3][0]
-                    resolved_hosts[host] = ip
-                elif answer[0] == 101: # CNAME
-                    query = self.adns.submit(answer[1], adns.rr.A)
-                    active_queries[query] = host
-                else:
-                    resolved_hosts[host] = None
-
-        def finished_resolving():
-            return len(resolved_hosts) == len(self.hosts)
-
-        while not finished_resolving():
-            while host_queue and len(active_queries) < self.intensity:
-                host = host_queue.pop()
-                query = self.adns.submit(host, adns.rr.A)
-                active_queries[query] = host
-            collect_results()
-
-        return resolved_hosts
+        """
+        Resolves hosts and returns a dictionary of { 'host': 'ip' },
+        'ip' is None for hosts that could not be resolved.
+        """
+        return {host: answer.addr for host, answer in self.resolve().items()}
+
+    def resolve(self):
+        """ Resolves hosts and returns a dictionary of { 'host': DNSAnswer } """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.resolve_async())
+        finally:
+            loop.close()
+
+    async def resolve_async(self):
+        """ resolve() coroutine """
+        loop = asyncio.get_event_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+                                lambda: _DNSProtocol(self._pending),
+                                family=socket.AF_INET)
+        semaphore = asyncio.Semaphore(max(1, self.intensity))
+
+        async def resolve_one(host):
+            async with semaphore:
+                return host, await self._resolve(host)
+
+        try:
+            results = await asyncio.gather(*[resolve_one(host)
+                                             for host in self.hosts])
+        finally:
+            self._transport.close()
+            self._transport = None
+
+        return dict(results)
+
+    async def _resolve(self, host):
+        """ Resolves host A record, following CNAME chains """
+        if is_valid_ipv4_address(host):
+            return DNSAnswer(host, 0, "ok")
+
+        name = host.rstrip(".").lower()
+        ttl  = None
+        hops = 0
+        while True:
+            response = await self._query(name)
+            if response is None:
+                return DNSAnswer(None, None, "timeout")
+            rcode, records = response
+            if rcode == RCODE_NXDOMAIN:
+                return DNSAnswer(None, None, "nxdomain")
+            if rcode != RCODE_NOERROR:
+                return DNSAnswer(None, None, "error")
+
+            # follow the chain within the answer section
+            queried = name
+            while True:
+                match = [r for r in records if r[0] == name]
+                addrs = [r for r in match if r[1] == RR_A]
+                if addrs:
+                    return DNSAnswer(addrs[0][3], _min_ttl(ttl, addrs[0]), "ok")
+                cnames = [r for r in match if r[1] == RR_CNAME]
+                if not cnames:
+                    break
+                hops += 1
+                if hops > self.max_cname:
+                    return DNSAnswer(None, None, "error")
+                ttl  = _min_ttl(ttl, cnames[0])
+                name = cnames[0][3]
+
+            if name == queried:
+                return DNSAnswer(None, ttl, "nodata")
+            # chain ends on a name without A record: query it
+
+    async def _query(self, name):
+        """ Returns (rcode, records) of an A query, None on timeout """
+        loop = asyncio.get_event_loop()
+        for attempt in range(self.retries + 1):
+            server = self.servers[attempt % len(self.servers)]
+            qid    = random.randrange(0x10000)
+            while qid in self._pending:
+                qid = random.randrange(0x10000)
+
+            future = loop.create_future()
+            self._pending[qid] = (future, server)
+            try:
+                self._transport.sendto(dns_query(qid, name),
+                                       (server, self.port))
+                data = await asyncio.wait_for(future, self.timeout)
+                if dns_truncated(data):
+                    # incomplete answer, ask again over TCP
+                    data = await self._query_tcp(server, name)
+                    if data is None or dns_truncated(data):
+                        continue
+                _, rcode, qname, records = dns_parse(data)
+                if qname != name:
+                    continue
+                return rcode, records
+            except asyncio.TimeoutError:
+                continue
+            except (ValueError, IndexError, struct.error):
+                # malformed response
+                continue
+            finally:
+                del self._pending[qid]
+
+        return None
+
+    async def _query_tcp(self, server, name):
+        """ Returns the response to an A query sent over TCP, None on failure """
+        qid   = random.randrange(0x10000)
+        query = dns_query(qid, name)
+
+        async def exchange():
+            reader, writer = await asyncio.open_connection(server, self.port)
+            try:
+                writer.write(struct.pack("!H", len(query)) + query)
+                length = struct.unpack("!H", await reader.readexactly(2))[0]
+                return await reader.readexactly(length)
+            finally:
+                writer.close()
+
+        try:
+            data = await asyncio.wait_for(exchange(), self.timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return None
+        if len(data) < _header.size or struct.unpack_from("!H", data)[0] != qid:
+            return None
+        return data
 
 def is_valid_ipv4_address(address):
     try:
@@ -63,4 +291,3 @@ def is_valid_ipv4_address(address):
         return False
 
     return True
-
@@ -0,0 +1,160 @@
+"""
+scheduler.py
+
+   Adaptive per-node probe scheduler
+
+@author: K.Edeline
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, DateTime, Integer, Float
+
+from deployer.node import Base, PLNodeState, session_scope
+
+## PLNode.last_seen of nodes that were never seen
+NEVER = datetime(1, 1, 1, 0, 0)
+
+class PLNodeSchedule(Base):
+   """
+   PLNodeSchedule
+
+      per-node probing history
+   """
+   ## SQLAlchemy attributes
+   __tablename__ = "schedule"
+   id         = Column(Integer, primary_key=True)
+   next_probe = Column(DateTime)
+   interval   = Column(Integer)
+   ## number of consecutive probes that ended in last_state
+   streak     = Column(Integer)
+   ## decaying count of state changes
+   flaps      = Column(Float)
+   last_state = Column(PLNodeState.as_type("last_state"))
+
+   def to_dict(self):
+      return {k : getattr(self, k)
+               for k in PLNodeSchedule.__table__.columns.keys()}
+
+class PLScheduler(object):
+   """
+   PLScheduler
+
+      Decides when each node must be probed again:
+         - stable nodes are rechecked every `period` seconds,
+         - flapping nodes more often,
+         - dead nodes with exponential backoff, starting from the time
+           they were last seen,
+      intervals are bounded by [minperiod, maxperiod].
+   """
+
+   ## flaps decay factor per probe, node is flapping above threshold
+   FLAP_DECAY     = 0.5
+   FLAP_THRESHOLD = 1
+
+   def __init__(self, period=86400, minperiod=600, maxperiod=604800):
+      self.period    = period
+      self.minperiod = min(minperiod, period)
+      self.maxperiod = max(maxperiod, period)
+
+      ## node id -> PLNodeSchedule
+      self._entries  = {}
+      self._dirty    = set()
+
+   def load(self, session):
+      """
+      Load node schedules from database
+      """
+      self._entries = {e.id : e for e in session.query(PLNodeSchedule).all()}
+
+   def save(self, daemon, db_loc):
+      """
+      Write schedules changed since last save to database
+      """
+      if not self._dirty:
+         return
+      rows = [self._entries[i].to_dict() for i in self._dirty]
+      self._dirty.clear()
+      with session_scope(daemon, db_loc) as session:
+         session.execute(PLNodeSchedule.__table__.insert()
+                                             .prefix_with("OR REPLACE"), rows)
+
+   def due(self, pool, now=None):
+      """
+      @return nodes from pool that must be probed now
+      """
+      now = now or datetime.utcnow()
+      def is_due(node):
+         entry = self._entries.get(node.id)
+         return entry is None or entry.next_probe <= now
+
+      return [node for node in pool if is_due(node)]
+
+   def next_probe(self, pool):
+      """
+      @return datetime of the next probe of a node from pool
+      """
+      dates = [self._entries[n.id].next_probe
+                  for n in pool if n.id in self._entries]
+      if len(dates) < len(pool):
+         return datetime.utcnow()
+      return min(dates, default=datetime.utcnow())
+
+   def record(self, node, now=None):
+      """
+      Record the final state of a node probe and schedule its next probe
+      """
+      now   = now or datetime.utcnow()
+      entry = self._entries.get(node.id)
+      if entry is None:
+         entry = PLNodeSchedule(id=node.id, streak=0, flaps=0.0)
+         self._entries[node.id] = entry
+
+      changed = (entry.last_state is not None
+                  and entry.last_state != node.state)
+      entry.flaps  = entry.flaps * self.FLAP_DECAY + (1 if changed else 0)
+      if changed or entry.last_state is None:
+         entry.streak = 1
+      else:
+         entry.streak += 1
+      entry.last_state = node.state
+      entry.interval   = self._interval(node, entry, now)
+      entry.next_probe = now + timedelta(seconds=entry.interval)
+
+      self._dirty.add(node.id)
+
+   def defer(self, node, until=None, now=None):
+      """
+      Schedule the next probe of a node that could not be probed, at
+      until, within [minperiod, maxperiod] from now
+      """
+      now   = now or datetime.utcnow()
+      entry = self._entries.get(node.id)
+      if entry is None:
+         entry = PLNodeSchedule(id=node.id, streak=0, flaps=0.0)
+         self._entries[node.id] = entry
+
+      delay = (until - now).total_seconds() if until else 0
+      entry.interval   = int(min(self.maxperiod, max(self.minperiod, delay)))
+      entry.next_probe = now + timedelta(seconds=entry.interval)
+      self._dirty.add(node.id)
+
+   def _interval(self, node, entry, now):
+      """
+      @return seconds until next probe of node
+      """
+      if entry.flaps >= self.FLAP_THRESHOLD:
+         # flapping node, recheck often
+         interval = self.period / (1 + entry.flaps)
+
+      elif node.state == PLNodeState.unreachable:
+         # dead node, exponential backoff
+         interval = self.period * 2 ** min(entry.streak - 1, 32)
+         if node.last_seen and node.last_seen > NEVER:
+            dead = (now - node.last_seen).total_seconds()
+            interval = max(interval, dead / 2)
+
+      else:
+         interval = self.period
+
+      return int(min(self.maxperiod, max(self.minperiod, interval)))
+
@@ -0,0 +1,225 @@
+"""
+scores.py
+
+   Per-node probe measurements and rolling scores
+
+      Every probe of a node updates exponentially weighted moving averages
+      of the node rtt, jitter, loss and availability (fraction of probes
+      that found the node usable). Nodes are ranked by these scores, 
+      probes themselves are kept by deployer.history.
+
+@author: K.Edeline
+"""
+import math
+import heapq
+
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, Float, Index
+
+from deployer.node import Base, PLNode, PLNodeState, session_scope
+
+## rankings, best nodes first
+SORTS = ["availability", "rtt"]
+
+def ping_ms(value):
+   """
+   @return a ping_parse() time as a float, None if there is none
+   """
+   try:
+      value = float(value)
+   except (TypeError, ValueError):
+      return None
+   return None if math.isnan(value) else value
+
+def _sort_key(sort):
+   """
+   @return the key that orders (id, score dictionary) best first,
+           unmeasured nodes last, ties by id
+   """
+   def rtt(item):
+      return (item[1]["rtt"] is None, item[1]["rtt"] or 0, item[0])
+   if sort == "rtt":
+      return rtt
+   if sort == "availability":
+      return lambda item: (-(item[1]["availability"] or 0),) + rtt(item)
+   raise PLScoresException("unknown sort {}".format(sort))
+
+class PLNodeScore(Base):
+   """
+   PLNodeScore
+
+      rolling scores of a node
+   """
+   ## SQLAlchemy attributes
+   __tablename__ = "scores"
+   id           = Column(Integer, primary_key=True)
+   ## ms, of probes that got replies
+   rtt          = Column(Float)
+   jitter       = Column(Float)
+   ## fractions
+   loss         = Column(Float)
+   availability = Column(Float)
+   probes       = Column(Integer)
+   updated_at   = Column(DateTime)
+
+   __table_args__ = (Index("scores_rtt", "rtt"),
+                     Index("scores_availability", "availability"))
+
+   def to_dict(self):
+      return {k : getattr(self, k)
+               for k in PLNodeScore.__table__.columns.keys()}
+
+class PLScores(object):
+   """
+   PLScores
+
+      Node scores, loaded from and saved to the database. Rankings are 
+      computed when scores are loaded, updated with the scores changed 
+      when they are saved, and read from other threads through the 
+      `ranking` reference.
+   """
+
+   ## weight of the last probe in rolling scores
+   ALPHA = 0.2
+
+   def __init__(self):
+      ## sort -> [(node id, score dictionary)], best first
+      self.ranking   = {sort : [] for sort in SORTS}
+
+      ## node id -> PLNodeScore
+      self._entries  = {}
+      self._dirty    = set()
+
+   def load(self, session):
+      """
+      Load node scores from database
+      """
+      self._entries = {e.id : e for e in session.query(PLNodeScore).all()}
+      self._rank()
+
+   def save(self, daemon, db_loc):
+      """
+      Write scores changed since last save to database
+      """
+      if not self._dirty:
+         return
+      changed = {i : self._entries[i].to_dict() for i in self._dirty}
+      self._dirty.clear()
+      with session_scope(daemon, db_loc) as session:
+         session.execute(PLNodeScore.__table__.insert()
+                                          .prefix_with("OR REPLACE"), 
+                         list(changed.values()))
+      self._rank(changed)
+
+   def _rank(self, changed=None):
+      """
+      @param changed {id: score dictionary} of the scores changed since 
+                     last ranking, merged into the rankings. None sorts 
+                     all scores again
+      """
+      if changed is None:
+         scores = [(i, e.to_dict()) for i, e in self._entries.items()]
+         self.ranking = {sort : sorted(scores, key=_sort_key(sort))
+                           for sort in SORTS}
+         return
+
+      ranking = {}
+      for sort in SORTS:
+         key   = _sort_key(sort)
+         kept  = (item for item in self.ranking[sort] 
+                       if item[0] not in changed)
+         ranking[sort] = list(heapq.merge(kept, sorted(changed.items(), 
+                                          key=key), key=key))
+      self.ranking = ranking
+
+   def _average(self, old, value):
+      if value is None:
+         return old
+      if old is None:
+         return value
+      return (1 - self.ALPHA) * old + self.ALPHA * value
+
+   def record(self, node, ping, state, now=None):
+      """
+      Record a probe of node
+
+      @param ping ping_parse() dictionary, None if node was not pinged
+      @param state node state at the end of the probe
+      """
+      now   = now or datetime.utcnow()
+      entry = self._entries.get(node.id)
+      if entry is None:
+         entry = PLNodeScore(id=node.id, probes=0)
+         self._entries[node.id] = entry
+
+      ping     = ping or {}
+      sent     = ping.get('sent', 0)
+      received = ping.get('received', 0)
+
+      entry.rtt          = self._average(entry.rtt, 
+                                 ping_ms(ping.get('avgping')))
+      entry.jitter       = self._average(entry.jitter, 
+                                 ping_ms(ping.get('jitter')))
+      entry.loss         = self._average(entry.loss,
+                                 1 - received / sent if sent else None)
+      entry.availability = self._average(entry.availability,
+                                 1.0 if state == PLNodeState.usable else 0.0)
+      entry.probes      += 1
+      entry.updated_at   = now
+      self._dirty.add(node.id)
+
+   def rtt(self, node):
+      """
+      @return the rolling rtt of node (ms), None if it is unknown
+      """
+      entry = self._entries.get(node.id)
+      return None if entry is None else entry.rtt
+
+   def rank(self, nodes, sort="availability"):
+      """
+      @return nodes, best first
+      """
+      key = _sort_key(sort)
+      def score(node):
+         entry = self._entries.get(node.id)
+         return key((node.id, entry.to_dict() if entry is not None else
+                     {"rtt" : None, "availability" : None}))
+      return sorted(nodes, key=score)
+
+def top_scores(session, n=10, sort="availability"):
+   """
+   @return the n best nodes of the database, as top() rows
+   """
+   if sort not in SORTS:
+      raise PLScoresException("unknown sort {}".format(sort))
+   query = session.query(PLNode, PLNodeScore).join(PLNodeScore,
+                                                 PLNode.id == PLNodeScore.id)
+   rtt   = [PLNodeScore.rtt.is_(None), PLNodeScore.rtt, PLNodeScore.id]
+   if sort == "rtt":
+      query = query.order_by(*rtt)
+   else:
+      query = query.order_by(PLNodeScore.availability.desc(), *rtt)
+   return [top_row(node.id, node.to_dict(), score.to_dict())
+              for node, score in query.limit(n)]
+
+def top_row(nodeid, node, score):
+   """
+   @return the description of a ranked node
+   """
+   row = {k : score[k] for k in ["rtt", "jitter", "loss", "availability",
+                                 "probes"]}
+   row.update({"id" : nodeid, "name" : node["name"], "addr" : node["addr"],
+               "state" : node["state"]})
+   return row
+
+class PLScoresException(Exception):
+   """
+   PLScoresException(Exception)
+   """
+
+   def __init__(self, value):
+      self.value = value
+
+   def __str__(self):
+      return repr(self.value)
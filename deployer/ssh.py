@@ -1,163 +1,945 @@
 """
 ssh.py
 
-   psshlib wrappers
-      Each session is opened with subprocess.Popen
-      useful functions: run_command, download, upload
+   asyncio ssh/scp executor
+      Each session is an asyncio subprocess, SSHExecutor runs them with
+      bounded concurrency, per-session and global timeouts.
+      useful functions: run_command, download, upload, and their _iter
+      forms that yield each host result as soon as it completes
+
+   SSHMasterPool keeps persistent multiplexed master connections, sessions
+   of all these functions reuse them when a pool is given.
 
 @author: K.Edeline
 """
 
 import os
 import time
+import shlex
+import signal
+import shutil
+import hashlib
+import itertools
+import asyncio
+import tempfile
+import functools
+import subprocess
+
+from collections import OrderedDict, Counter, deque
+
+def ssh_result(host, index, outputbuffer, errorbuffer, exitstatus, failures,
+               captures=None):
+   """
+   Build a task result dictionary
+
+   @param captures (stdout, stderr) SSHCapture, their details are added
+                   to the result
+   """
+   error  = ', '.join(failures)  
+   tstamp = time.asctime().split()[3] # Current time
+   result = {"tstamp": tstamp, "index": index, "host": host, 
+             "stdout": outputbuffer.decode('utf8', 'replace'), 
+             "stderr" : errorbuffer.decode('utf8', 'replace'),
+             "status" : exitstatus, "errors": error,
+             "truncated": False,
+            }
+   for capture in captures or []:
+      result.update(capture.details())
+      result["truncated"] |= capture.truncated
+   return result
+
+class SSHOutput(object):
+   """
+   SSHOutput
 
-from psshlib import psshutil
-from psshlib.manager import Manager, FatalError
-from psshlib.task import Task
+      How session output is kept in result dictionaries, per stream:
+         full     everything
+         headtail the first `head` and last `tail` bytes
+         spool    everything to spooldir/<host>.<time>-<seq>.<stream>, 
+                  headtail in the result, "<stream>_path" gives the file
+         digest   nothing, "<stream>_sha1" gives the output digest
 
-class SSHCmdTask(Task):
+      Results say if some output was left out ("truncated") and the
+      size of each stream ("<stream>_bytes").
+   """
+   MODES = ["full", "headtail", "spool", "digest"]
 
-   def report(self, n):
+   def __init__(self, mode="full", head=4096, tail=4096, spooldir=None):
+      if mode not in SSHOutput.MODES:
+         raise SSHException("unknown output mode {}".format(mode))
+      if mode == "spool" and not spooldir:
+         raise SSHException("spool output mode requires a spooldir")
+      self.mode     = mode
+      self.head     = head
+      self.tail     = tail
+      self.spooldir = spooldir
+      ## spool files of sessions started within the same second
+      self._seq     = itertools.count()
+
+   def captures(self, host):
+      """
+      @return new (stdout, stderr) SSHCapture of a host session, every 
+              session gets its own spool files
       """
-         Store a status report after the Task completes.
+      prefix = None
+      if self.mode == "spool":
+         prefix = os.path.join(self.spooldir, "{}.{}-{}".format(host, 
+                        time.strftime("%Y%m%dT%H%M%S"), next(self._seq)))
+      return [SSHCapture(stream, mode=self.mode, head=self.head, 
+                         tail=self.tail, 
+                         path=prefix and "{}.{}".format(prefix, stream))
+              for stream in ["stdout", "stderr"]]
+
+class SSHCapture(object):
+   """
+   SSHCapture
+
+      bounded capture of one session output stream
+   """
+
+   def __init__(self, stream, mode="full", head=4096, tail=4096, path=None):
+      self.stream    = stream
+      self.mode      = mode
+      self.head      = head
+      self.tail      = tail
+      self.size      = 0
 
+      self._head     = bytearray()
+      self._tail     = bytearray()
+      self._sha1     = hashlib.sha1() if mode == "digest" else None
+      self._path     = path
+      self._file     = open(path, 'wb') if path else None
+
+   def feed(self, data):
+      self.size += len(data)
+      if self.mode == "full":
+         self._head += data
+         return
+      if self._file is not None:
+         self._file.write(data)
+      if self._sha1 is not None:
+         self._sha1.update(data)
+         return
+
+      # head/tail ring buffers
+      room = self.head - len(self._head)
+      if room > 0:
+         self._head += data[:room]
+         data        = data[room:]
+      if data:
+         self._tail += data
+         if len(self._tail) > self.tail:
+            del self._tail[:len(self._tail) - self.tail]
+
+   def close(self):
+      if self._file is not None:
+         self._file.close()
+         self._file = None
+
+   @property
+   def truncated(self):
+      """
+      True if some output is not in value()
       """
-      error  = ', '.join(self.failures)  
-      tstamp = time.asctime().split()[3] # Current time
-      host   = self.pretty_host
-      self.result = {"tstamp": tstamp, "index": n, "host": host, 
-                     "stdout": self.outputbuffer.decode('utf8'), 
-                     "stderr" : self.errorbuffer.decode('utf8'),
-                     "status" : self.exitstatus, "errors": error,
-                     }
+      return self.size > len(self._head) + len(self._tail)
+
+   def value(self):
+      """
+      @return captured bytes
+      """
+      skipped = self.size - len(self._head) - len(self._tail)
+      if skipped <= 0 or self.mode == "digest":
+         return bytes(self._head + self._tail)
+      return bytes(self._head + "\n[... {} bytes ...]\n".format(skipped)
+                                    .encode('ascii') + self._tail)
+
+   def details(self):
+      details = {"{}_bytes".format(self.stream) : self.size}
+      if self._sha1 is not None:
+         details["{}_sha1".format(self.stream)] = self._sha1.hexdigest()
+      if self._path is not None:
+         details["{}_path".format(self.stream)] = self._path
+      return details
 
-class SSHArgs:
-   def __init__(self,d):
-      ## don't use self.__dict__ here
-      self._dict = d
+class SSHMasterPool(object):
+   """
+   SSHMasterPool
 
-   def __getattr__(self,key):
+      One persistent ssh master connection (ControlMaster) per host, 
+      opened by the first session to the host within its job slot, later
+      sessions to the host are multiplexed over its master.
+
+      Masters exit by themselves after `persist` idle seconds 
+      (ControlPersist). At most `limit` masters are open at once: the
+      least recently used idle master is stopped to make room for a new 
+      one, sessions run without master when all masters are busy.
+
+      A known master is checked (ssh -O check) before it is reused, unless
+      it has sessions running or was opened or checked in the last 
+      `recheck` seconds. A session that fails to connect (status 255) 
+      evicts the master it ran over.
+
+      options = await masters.acquire(host, user, keyloc=keyloc)
       try:
-         return self._dict[key]
-      except KeyError as err:
-         raise AttributeError(key)
-      
-def upload(hosts, loginname, localdirs, remotedir, timeout=10, 
-           threads=50, port=None, recursive=False, keyloc=None):
-
-   opts = SSHArgs({'verbose': None, 'askpass': None, 'options': None, 
-                   'errdir': None, 'timeout': timeout, 'recursive': recursive, 
-                   'user': loginname, 'par': threads, 'extra': None, 
-                   'outdir': None, 'host_strings': None})
-   manager = Manager(opts)
-   
-   for host in hosts:
-      cmd = ['scp', '-qC', '-o', 'StrictHostKeyChecking=no']
-      if opts.options:
-         for opt in opts.options:
-             cmd += ['-o', opt]
+         ... ssh_command(host, user, cmdline, options=options) ...
+      finally:
+         masters.release(host, user)
+   """
+
+   def __init__(self, controldir=None, persist=600, limit=200, recheck=5):
+      """
+      @param controldir control sockets directory, defaults to a temporary
+                        directory removed by close()
+      """
+      self._temporary = controldir is None
+      if self._temporary:
+         controldir = tempfile.mkdtemp(prefix="deploypl-ssh-")
+      self.controldir = controldir
+      self.persist    = persist
+      self.limit      = limit
+      self.recheck    = recheck
+
+      ## (loginname, host, port) -> last use timestamp, LRU first
+      self._masters   = OrderedDict()
+      ## (loginname, host, port) -> last time the master was opened or 
+      ## checked
+      self._checked   = {}
+      ## (loginname, host, port) -> sessions running over the master
+      self._sessions  = Counter()
+      ## (loginname, host, port) -> future done when the master opened, 
+      ## checked or exited by a session is ready
+      self._opening   = {}
+
+   def path(self, host, loginname, port=None):
+      """
+      control socket path, kept short for sun_path
+      """
+      key = "{}@{}:{}".format(loginname, host, port).encode('utf8')
+      return os.path.join(self.controldir, hashlib.sha1(key).hexdigest()[:20])
+
+   def options(self, host, loginname, port=None):
+      """
+      ssh -o options that multiplex a session over host master
+      """
+      return ['ControlMaster=no', 
+              'ControlPath={}'.format(self.path(host, loginname, port))]
+
+   def _expired(self, key):
+      """
+      @return True if the master exited after persist idle seconds
+      """
+      return (not self._sessions[key] 
+               and time.time() - self._masters[key] >= self.persist)
+
+   def _touch(self, key):
+      self._masters[key] = time.time()
+      self._masters.move_to_end(key)
+
+   def _control_command(self, key, command):
+      loginname, host, port = key
+      cmd = ['ssh', '-o', 'ControlPath={}'.format(self.path(host, loginname, port)),
+             '-O', command]
+      if loginname:
+         cmd += ['-l', loginname]
+      cmd.append(host)
+      return cmd
+
+   def _control(self, key, command):
+      """
+      send a control command (check, stop, exit) to a master, without
+      waiting for its outcome
+
+      @return the control process, None if it could not be started
+      """
+      try:
+         # reaped by subprocess on next Popen
+         return subprocess.Popen(self._control_command(key, command), 
+                                 stdin=subprocess.DEVNULL, 
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL)
+      except OSError:
+         return None
+
+   async def _control_async(self, key, command, timeout=10):
+      """
+      send a control command (check, stop, exit) to a master
+
+      @return True if the master accepted it
+      """
+      return await _run_quiet(self._control_command(key, command), timeout)
+
+   def _room(self, key):
+      """
+      forget expired masters, choose the least recently used idle masters
+      to stop to leave room for the master of key
+
+      @return (True if the master of key can be opened, keys to stop)
+      """
+      for other in [k for k in self._masters if self._expired(k)]:
+         self._forget(other)
+      stop = []
+      used = set(self._masters) | set(self._opening)
+      used.discard(key)
+      while len(used) >= self.limit:
+         idle = [k for k in self._masters 
+                   if not self._sessions[k] and k not in self._opening]
+         if not idle:
+            return False, stop
+         self._forget(idle[0])
+         used.discard(idle[0])
+         stop.append(idle[0])
+      return True, stop
+
+   def _master_command(self, host, loginname, port=None, keyloc=None):
+      cmd = ['ssh', '-fN', '-o', 'BatchMode=yes',
+             '-o', 'StrictHostKeyChecking=no',
+             '-o', 'ControlMaster=auto',
+             '-o', 'ControlPath={}'.format(self.path(host, loginname, port)),
+             '-o', 'ControlPersist={}'.format(self.persist)]
       if keyloc:
          cmd.extend(['-i', keyloc])
+      if loginname:
+         cmd += ['-l', loginname]
       if port:
-         cmd += ['-P', port]
-      if opts.recursive:
-         cmd.append('-r')
-      if opts.extra:
-         cmd.extend(opts.extra)
-      cmd.extend(localdirs)
-      cmd.append('%s@%s:%s' % (loginname, host, remotedir))
-
-      t = SSHCmdTask(host, port, loginname, cmd, opts)
-      manager.add_task(t)   
-
-   # run tasks
+         cmd += ['-p', port]
+      cmd.append(host)
+      return cmd
+
+   async def acquire(self, host, loginname, port=None, keyloc=None, 
+                     timeout=10):
+      """
+      open host master if it is not running, and count a session over it
+      until release()
+
+      @return ssh -o options of a session multiplexed over host master,
+              None if there is no room for the master or it cannot be 
+              opened, the session must then run on its own
+      """
+      key = (loginname, host, port)
+      while key in self._opening:
+         # opened, checked or exited by another session
+         await asyncio.wait([self._opening[key]])
+      if key in self._masters and self._expired(key):
+         self._forget(key)
+
+      known = key in self._masters
+      if known and (self._sessions[key] 
+                    or time.time() - self._checked[key] < self.recheck):
+         # in use, or checked moments ago
+         self._touch(key)
+         self._sessions[key] += 1
+         return self.options(host, loginname, port)
+      if not known:
+         room, stop = self._room(key)
+         if not room:
+            return None
+      opening = asyncio.get_event_loop().create_future()
+      self._opening[key] = opening
+      try:
+         if known and not await self._control_async(key, 'check', timeout):
+            # master died, its path is reused by a new one
+            self._forget(key)
+            known = False
+            room, stop = self._room(key)
+            if not room:
+               return None
+         if not known:
+            for other in stop:
+               await self._control_async(other, 'exit', timeout)
+            cmd = self._master_command(host, loginname, port=port, 
+                                       keyloc=keyloc)
+            # ssh -f goes to background once authenticated
+            if not await _run_quiet(cmd, timeout):
+               return None
+         self._checked[key] = time.time()
+         self._touch(key)
+         self._sessions[key] += 1
+         return self.options(host, loginname, port)
+      finally:
+         del self._opening[key]
+         opening.set_result(None)
+
+   def release(self, host, loginname, port=None):
+      """
+      end a session counted by acquire()
+      """
+      key = (loginname, host, port)
+      self._sessions[key] -= 1
+      if self._sessions[key] <= 0:
+         del self._sessions[key]
+      if key in self._masters:
+         self._touch(key)
+
+   async def evict(self, host, loginname, port=None, timeout=10):
+      """
+      forget host master after a session over it failed to connect, the
+      next session opens a new one once it exited
+      """
+      key = (loginname, host, port)
+      if key not in self._masters or key in self._opening:
+         return
+      self._forget(key)
+      if self._sessions[key]:
+         # still used by other sessions
+         return
+      exiting = asyncio.get_event_loop().create_future()
+      self._opening[key] = exiting
+      try:
+         await self._control_async(key, 'exit', timeout)
+      finally:
+         del self._opening[key]
+         exiting.set_result(None)
+
+   def _forget(self, key):
+      self._masters.pop(key, None)
+      self._checked.pop(key, None)
+
+   def close(self, timeout=10):
+      """
+      exit all masters, remove the control sockets directory if it is
+      temporary
+      """
+      processes = [self._control(key, 'exit') for key in self._masters]
+      deadline  = time.time() + timeout
+      for process in processes:
+         if process is None:
+            continue
+         try:
+            process.wait(max(0, deadline - time.time()))
+         except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+      self._masters.clear()
+      self._checked.clear()
+      self._sessions.clear()
+      if self._temporary:
+         shutil.rmtree(self.controldir, ignore_errors=True)
+
+async def _run_quiet(cmd, timeout):
+   """
+   run cmd without input nor output, kill it after timeout seconds
+
+   @return True if it exited with status 0
+   """
+   try:
+      process = await asyncio.create_subprocess_exec(*cmd, 
+                                    stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.DEVNULL, 
+                                    stderr=subprocess.DEVNULL,
+                                    start_new_session=True)
+   except OSError:
+      return False
+   try:
+      return await asyncio.wait_for(process.wait(), timeout) == 0
+   except asyncio.TimeoutError:
+      return False
+   finally:
+      # timed out or cancelled
+      if process.returncode is None:
+         _kill(process)
+         await process.wait()
+
+def _kill(process):
+   """
+   kill process and the processes it started, process must lead its own
+   session (start_new_session)
+   """
+   try:
+      os.killpg(process.pid, signal.SIGKILL)
+   except ProcessLookupError:
+      pass
+   # process.wait() returns once output pipes are closed, and they may be
+   # held open by children of process, or by the master of a multiplexed
+   # session: close our end
+   transport = getattr(process, "_transport", None)
+   if transport is not None:
+      for fd in [1, 2]:
+         pipe = transport.get_pipe_transport(fd)
+         if pipe is not None:
+            pipe.close()
+
+async def _drain(stream, capture):
+   while True:
+      data = await stream.read(65536)
+      if not data:
+         break
+      capture.feed(data)
+
+async def _multiplexed(host, build, masters, loginname, port=None, 
+                       keyloc=None, timeout=10, index=0, output=None, 
+                       stdin=None):
+   """
+   _execute() the command line build(options), multiplexed over host
+   master when one can be opened, the master is opened within timeout
+
+   @param build function that returns the command line of a session
+                given its ssh -o options, None for no master
+   """
+   start   = time.time()
+   options = await masters.acquire(host, loginname, port=port, 
+                                   keyloc=keyloc, timeout=timeout)
    try:
-      manager.run()
-   except FatalError:
-      return []
-   
-   # return result
-   return [t.result for t in manager.done]
-
-def download(hosts, loginname, remotedir, localdir, keyloc=None, localfile=".", timeout=10, threads=100, port=None, recursive=False):
-   opts = SSHArgs({'verbose': None, 'askpass': None, 'options': None, 
-                   'errdir': None, 'timeout': timeout, 'recursive': recursive, 
-                   'user': loginname, 'par': threads, 'extra': None, 
-                   'outdir': None, 'host_strings': None, 'localdir': None})
+      result = await _execute(host, build(options), 
+                              timeout=max(0, timeout - (time.time() - start)),
+                              index=index, output=output, stdin=stdin)
+   finally:
+      if options is not None:
+         masters.release(host, loginname, port)
+   if options is not None and result["status"] == 255:
+      # ssh error, the master may be dead
+      await masters.evict(host, loginname, port, timeout=timeout)
+   return result
+
+def _session(host, build, masters, loginname, port=None, keyloc=None):
+   """
+   @return the executor job command of a session: its command line, or
+           a coroutine function that opens host master first if masters
+           pool is given
+   """
+   if masters is None:
+      return build(None)
+   return functools.partial(_multiplexed, host, build, masters, loginname,
+                            port=port, keyloc=keyloc)
+
+async def _execute(host, cmd, timeout=10, index=0, output=None, stdin=None):
+   """
+   Run cmd in an asyncio subprocess, kill it after timeout seconds
+
+   @param output SSHOutput, defaults to full output
+   @param stdin path of a file fed to cmd standard input
+   @return a result dictionary
+   """
+   # forwarded to the remote host by ssh_command() SendEnv
+   env      = dict(os.environ, PSSH_NODENUM=str(index), PSSH_HOST=str(host))
+   output   = output or SSHOutput()
+   captures = []
+   infile   = None
+   try:
+      captures.extend(output.captures(host))
+      if stdin is not None:
+         infile = open(stdin, 'rb')
+      process = await asyncio.create_subprocess_exec(*cmd, 
+                                       stdin=infile or subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE, 
+                                       stderr=subprocess.PIPE, env=env,
+                                       start_new_session=True)
+   except OSError as e:
+      for capture in captures:
+         capture.close()
+      return ssh_result(host, index, b"", b"", None, [str(e)])
+   finally:
+      # the child has its own descriptor
+      if infile is not None:
+         infile.close()
+
+   failures = []
+   tasks    = [asyncio.ensure_future(_drain(process.stdout, captures[0])),
+               asyncio.ensure_future(_drain(process.stderr, captures[1])),
+               asyncio.ensure_future(process.wait())]
+   try:
+      _, pending = await asyncio.wait(tasks, timeout=timeout)
+      if pending:
+         failures.append("Timed out")
+   finally:
+      # timed out or cancelled
+      if not all(task.done() for task in tasks):
+         _kill(process)
+         for task in tasks:
+            task.cancel()
+         await process.wait()
+      for capture in captures:
+         capture.close()
+
+   for task in tasks[:2]:
+      if task.done() and not task.cancelled() and task.exception():
+         failures.append(str(task.exception()))
+
+   return ssh_result(host, index, captures[0].value(), captures[1].value(),
+                     process.returncode, failures, captures=captures)
+
+class SSHExecutor(object):
+   """
+   SSHExecutor
+
+      Runs (host, command) jobs as asyncio subprocesses:
+         - at most `limit` commands run at once, jobs are pulled from
+           their iterator as slots free up, and command lines given as a
+           coroutine function (see _session()) are built in their slot,
+         - each command is killed after `timeout` seconds,
+         - commands still running `deadline` seconds after run() started
+           are killed, jobs that did not start are not started,
+         - cancel() kills running commands and stops starting new ones,
+         - output is kept as told by `output` (SSHOutput).
+
+      Every job gets a result dictionary (see ssh_result()), jobs that 
+      did not complete are reported with "Timed out" or "Cancelled" errors.
+      Results are available as soon as each job completes, through a 
+      callback or run_iter().
+
+      executor = SSHExecutor(limit=100, timeout=10)
+      results  = executor.run_sync(jobs)
+      for result in executor.run_iter(jobs):
+         ...
+   """
+
+   def __init__(self, limit=100, timeout=10, deadline=None, output=None):
+      self.limit     = max(1, limit)
+      self.timeout   = timeout
+      self.deadline  = deadline
+      self.output    = output
+      self.cancelled = False
+
+      ## running commands: index -> future
+      self._running  = {}
+
+   def cancel(self):
+      """
+      kill running commands, do not start new ones.
+      Must be called from the event loop thread (loop.call_soon_threadsafe)
+      """
+      self.cancelled = True
+      for future in self._running.values():
+         future.cancel()
+
+   async def run(self, jobs, callback=None):
+      """
+      @param jobs iterable of (host, command), or of (host, command, 
+                  stdin file path), command being a command line list or
+                  a coroutine function called as command(timeout=, 
+                  index=, output=, stdin=) that returns a result 
+                  dictionary
+      @param callback called as callback(result) as soon as a job completes,
+                      results are then not kept
+      @return list of result dictionaries in completion order, 
+              None if callback is given
+      """
+      results = []
+      report  = callback or results.append
+      loop    = asyncio.get_event_loop()
+      end     = None if self.deadline is None else loop.time() + self.deadline
+      jobs    = iter(enumerate(jobs))
+
+      async def worker():
+         for index, job in jobs:
+            host, cmd = job[:2]
+            stdin     = job[2] if len(job) > 2 else None
+            timeout = self.timeout
+            if end is not None:
+               timeout = min(timeout, end - loop.time())
+            if self.cancelled:
+               report(ssh_result(host, index, b"", b"", None, 
+                                 ["Cancelled"]))
+               continue
+            if timeout <= 0:
+               report(ssh_result(host, index, b"", b"", None, 
+                                 ["Timed out"]))
+               continue
+
+            if callable(cmd):
+               session = cmd(timeout=timeout, index=index, 
+                             output=self.output, stdin=stdin)
+            else:
+               session = _execute(host, cmd, timeout=timeout, index=index,
+                                  output=self.output, stdin=stdin)
+            future = asyncio.ensure_future(session)
+            self._running[index] = future
+            try:
+               result = await future
+            except asyncio.CancelledError:
+               if not self.cancelled:
+                  raise
+               result = ssh_result(host, index, b"", b"", None, ["Cancelled"])
+            finally:
+               del self._running[index]
+            report(result)
+
+      await asyncio.gather(*[worker() for _ in range(self.limit)])
+      return None if callback else results
+
+   def run_sync(self, jobs, callback=None):
+      """
+      run() in a new event loop
+      """
+      loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(loop)
+      try:
+         return loop.run_until_complete(self.run(jobs, callback=callback))
+      finally:
+         asyncio.set_event_loop(None)
+         loop.close()
+
+   def run_iter(self, jobs):
+      """
+      run() in a new event loop, yield results as soon as jobs complete.
+      Closing the generator early cancels the remaining jobs.
+      """
+      loop    = asyncio.new_event_loop()
+      asyncio.set_event_loop(loop)
+      results = deque()
+      wakeup  = [None]
+      def report(result):
+         results.append(result)
+         if wakeup[0] is not None and not wakeup[0].done():
+            wakeup[0].set_result(None)
+
+      task = loop.create_task(self.run(jobs, callback=report))
+      try:
+         while True:
+            while results:
+               yield results.popleft()
+            if task.done():
+               break
+            wakeup[0] = loop.create_future()
+            loop.run_until_complete(asyncio.wait([wakeup[0], task],
+                                    return_when=asyncio.FIRST_COMPLETED))
+         task.result()
+      finally:
+         if not task.done():
+            self.cancel()
+            loop.run_until_complete(task)
+         asyncio.set_event_loop(None)
+         loop.close()
+
+def scp_command(host, loginname, sources, target, keyloc=None, port=None, 
+                recursive=False, options=None, upload=True):
+   """
+   Build the scp command line that copies local sources to host target 
+   directory (upload), or host sources to local target (download)
+   """
+   cmd = ['scp', '-qC', '-o', 'StrictHostKeyChecking=no']
+   if options:
+      for opt in options:
+         cmd += ['-o', opt]
+   if keyloc:
+      cmd.extend(['-i', keyloc])
+   if port:
+      cmd += ['-P', port]
+   if recursive:
+      cmd.append('-r')
+
+   if upload:
+      cmd.extend(sources)
+      cmd.append('%s@%s:%s' % (loginname, host, target))
+   else:
+      cmd.extend(['%s@%s:%s' % (loginname, host, source) 
+                     for source in sources])
+      cmd.append(target)
+   return cmd
+
+def extract_command(remotedir):
+   """
+   Build the command line that extracts a tar.gz read from standard input
+   into remotedir
+   """
+   return "mkdir -p {0} && tar xzf - -C {0}".format(shlex.quote(remotedir))
+
+def _upload_jobs(hosts, loginname, localdirs, remotedir, timeout=10, 
+                 port=None, recursive=False, keyloc=None, masters=None):
+   def jobs():
+      for host in hosts:
+         def build(options, host=host):
+            return scp_command(host, loginname, localdirs, remotedir,
+                               keyloc=keyloc, port=port, 
+                               recursive=recursive, options=options)
+         yield host, _session(host, build, masters, loginname, port=port,
+                              keyloc=keyloc)
+   return jobs()
+
+def _download_jobs(hosts, loginname, remotedir, localdir, keyloc=None, 
+                   localfile=".", timeout=10, port=None, recursive=False, 
+                   masters=None):
    # create directory
    for host in hosts:
       dirname = "%s/%s" % (localdir, host)
       if not os.path.exists(dirname):
          os.mkdir(dirname)
 
-   manager = Manager(opts)
-   for host in hosts:
-      cmd = ['scp', '-qC', '-o', 'StrictHostKeyChecking=no']
-      if opts.options:
-         for opt in opts.options:
-             cmd += ['-o', opt]
-      if keyloc:
-         cmd.extend(['-i', keyloc])
-      if port:
-         cmd += ['-P', port]
-      if opts.recursive:
-         cmd.append('-r')
-      if opts.extra:
-         cmd.extend(opts.extra)
-      cmd.append('%s@%s:%s' % (loginname, host, remotedir))
+   def jobs():
+      for host in hosts:
+         localpath = "%s/%s/%s" % (localdir, host, localfile)
+         def build(options, host=host, localpath=localpath):
+            return scp_command(host, loginname, [remotedir], localpath,
+                               keyloc=keyloc, port=port, 
+                               recursive=recursive, options=options, 
+                               upload=False)
+         yield host, _session(host, build, masters, loginname, port=port,
+                              keyloc=keyloc)
+   return jobs()
 
-      localpath = "%s/%s/%s" % (localdir, host, localfile)
-      cmd.append(localpath)
+def upload(hosts, loginname, localdirs, remotedir, timeout=10, 
+           threads=50, port=None, recursive=False, keyloc=None, masters=None,
+           deadline=None, callback=None, output=None, cache=None):
+   """
+   Copy localdirs to remotedir of all hosts
 
-      t = SSHCmdTask(host, port, loginname, cmd, opts)
-      manager.add_task(t)
+   @param callback called as callback(result) as soon as a host completes
+   @param cache PLBundleCache, localdirs are then compressed once into a
+                bundle streamed to every host, instead of one scp each
+   @return list of result dictionaries, None if callback is given
+   """
+   if cache is not None:
+      return run_command(hosts, loginname, extract_command(remotedir), 
+                         keyloc=keyloc, timeout=timeout, threads=threads, 
+                         port=port, masters=masters, deadline=deadline, 
+                         callback=callback, output=output, 
+                         stdin=cache.get(localdirs))
+   jobs = _upload_jobs(hosts, loginname, localdirs, remotedir, 
+                       timeout=timeout, port=port, recursive=recursive, 
+                       keyloc=keyloc, masters=masters)
+   executor = SSHExecutor(limit=threads, timeout=timeout, deadline=deadline,
+                          output=output)
+   return executor.run_sync(jobs, callback=callback)
 
-   # run tasks
-   try:
-      manager.run()
-   except FatalError:
-      return [] 
+def upload_iter(hosts, loginname, localdirs, remotedir, timeout=10, 
+                threads=50, port=None, recursive=False, keyloc=None, 
+                masters=None, deadline=None, output=None, cache=None):
+   """
+   upload() that yields result dictionaries as soon as hosts complete
+   """
+   if cache is not None:
+      return run_command_iter(hosts, loginname, extract_command(remotedir), 
+                              keyloc=keyloc, timeout=timeout, 
+                              threads=threads, port=port, masters=masters, 
+                              deadline=deadline, output=output, 
+                              stdin=cache.get(localdirs))
+   jobs = _upload_jobs(hosts, loginname, localdirs, remotedir, 
+                       timeout=timeout, port=port, recursive=recursive, 
+                       keyloc=keyloc, masters=masters)
+   executor = SSHExecutor(limit=threads, timeout=timeout, deadline=deadline,
+                          output=output)
+   return executor.run_iter(jobs)
+
+def download(hosts, loginname, remotedir, localdir, keyloc=None, localfile=".",
+             timeout=10, threads=100, port=None, recursive=False, 
+             masters=None, deadline=None, callback=None, output=None):
+   """
+   Copy remotedir of all hosts to localdir/host/localfile
+
+   @param callback called as callback(result) as soon as a host completes
+   @return list of result dictionaries, None if callback is given
+   """
+   jobs = _download_jobs(hosts, loginname, remotedir, localdir, 
+                         keyloc=keyloc, localfile=localfile, timeout=timeout,
+                         port=port, recursive=recursive, masters=masters)
+   executor = SSHExecutor(limit=threads, timeout=timeout, deadline=deadline,
+                          output=output)
+   return executor.run_sync(jobs, callback=callback)
+
+def download_iter(hosts, loginname, remotedir, localdir, keyloc=None, 
+                  localfile=".", timeout=10, threads=100, port=None, 
+                  recursive=False, masters=None, deadline=None, 
+                  output=None):
+   """
+   download() that yields result dictionaries as soon as hosts complete
+   """
+   jobs = _download_jobs(hosts, loginname, remotedir, localdir, 
+                         keyloc=keyloc, localfile=localfile, timeout=timeout,
+                         port=port, recursive=recursive, masters=masters)
+   executor = SSHExecutor(limit=threads, timeout=timeout, deadline=deadline,
+                          output=output)
+   return executor.run_iter(jobs)
+
+def ssh_command(host, loginname, cmdline, keyloc=None, port=None, 
+                sudo=False, options=None, extra=None):
+   """
+   Build the ssh command line that runs cmdline on host
+   """
+   cmd = ['ssh', host, '-o', 'NumberOfPasswordPrompts=1',
+          '-o', 'StrictHostKeyChecking=no',
+          '-o', 'SendEnv=PSSH_NODENUM PSSH_HOST']
+   if keyloc:
+      cmd.extend(['-i', keyloc])
+   if options:
+      for opt in options:
+         cmd += ['-o', opt]
+   if loginname:
+      cmd += ['-l', loginname]
+   if port:
+      cmd += ['-p', port]
+   if extra:
+      cmd.extend(extra)
+   if cmdline:
+      _command = ""
+      if sudo:
+         _command = 'sudo -S '
+      cmd.append(_command+cmdline)
 
-   return [t.result for t in manager.done]
+   return cmd
+
+def _command_jobs(hosts, loginname, cmdline, keyloc=None, timeout=10, 
+                  port=None, sudo=False, masters=None, stdin=None):
+   def jobs():
+      for host in hosts:
+         # one command line for all hosts, or one per host
+         hostcmd = cmdline[host] if isinstance(cmdline, dict) else cmdline
+         hostin  = stdin.get(host) if isinstance(stdin, dict) else stdin
+         def build(options, host=host, hostcmd=hostcmd):
+            return ssh_command(host, loginname, hostcmd, keyloc=keyloc, 
+                               port=port, sudo=sudo, options=options)
+         yield host, _session(host, build, masters, loginname, port=port,
+                              keyloc=keyloc), hostin
+   return jobs()
 
 def run_command(hosts, loginname, cmdline, keyloc=None, timeout=10, 
-                                  threads=100, port=None, sudo=False):
-   opts=SSHArgs({'send_input': None, 'par': threads, 'verbose': None, 
-                 'inline_stdout': None, 'extra': None, 'askpass': None, 
-                 'errdir': None, 'print_out': None, 'options': None, 
-                 'user': loginname, 'timeout': timeout, 'inline': True, 
-                 'host_strings': None, 'outdir': None})
-
-   manager = Manager(opts)
-   for host in hosts:
-      cmd = ['ssh', host, '-o', 'NumberOfPasswordPrompts=1',
-             '-o', 'StrictHostKeyChecking=no',
-             '-o', 'SendEnv=PSSH_NODENUM PSSH_HOST']
-      if keyloc:
-         cmd.extend(['-i', keyloc])
-      if opts.options:
-         for opt in opts.options:
-            cmd += ['-o', opt]
-      if loginname:
-         cmd += ['-l', loginname]
-      if port:
-         cmd += ['-p', port]
-      if opts.extra:
-         cmd.extend(opts.extra)
-      if cmdline:
-         _command = ""
-         if sudo:
-            _command = 'sudo -S '
-         cmd.append(_command+cmdline)
-
-      t = SSHCmdTask(host, port, loginname, cmd, opts, None)
-      manager.add_task(t)
-
-   # run tasks
-   try:
-      manager.run()
-   except FatalError:
-      return []
-   
-   return [t.result for t in manager.done]
+                   threads=100, port=None, sudo=False, masters=None,
+                   deadline=None, callback=None, output=None, stdin=None):
+   """
+   Run cmdline on all hosts
+
+   @param cmdline command line, or {host: command line}
+   @param stdin path of a file fed to cmdline, or {host: path}
+   @param callback called as callback(result) as soon as a host completes
+   @return list of result dictionaries, None if callback is given
+   """
+   jobs = _command_jobs(hosts, loginname, cmdline, keyloc=keyloc, 
+                        timeout=timeout, port=port, sudo=sudo, masters=masters,
+                        stdin=stdin)
+   executor = SSHExecutor(limit=threads, timeout=timeout, deadline=deadline,
+                          output=output)
+   return executor.run_sync(jobs, callback=callback)
+
+def run_command_iter(hosts, loginname, cmdline, keyloc=None, timeout=10, 
+                     threads=100, port=None, sudo=False, masters=None,
+                     deadline=None, output=None, stdin=None):
+   """
+   run_command() that yields result dictionaries as soon as hosts complete
+
+      for result in run_command_iter(hosts, user, "uname -r"):
+         ...
+   """
+   jobs = _command_jobs(hosts, loginname, cmdline, keyloc=keyloc, 
+                        timeout=timeout, port=port, sudo=sudo, masters=masters,
+                        stdin=stdin)
+   executor = SSHExecutor(limit=threads, timeout=timeout, deadline=deadline,
+                          output=output)
+   return executor.run_iter(jobs)
+
+async def run_command_async(host, loginname, cmdline, keyloc=None, timeout=10,
+                            port=None, sudo=False, index=0, masters=None,
+                            output=None):
+   """
+   Run cmdline on a single host in an asyncio subprocess
+
+   @return a result dictionary, same format as run_command() items
+   """
+   def build(options):
+      return ssh_command(host, loginname, cmdline, keyloc=keyloc, port=port,
+                         sudo=sudo, options=options)
+   if masters is None:
+      return await _execute(host, build(None), timeout=timeout, index=index, 
+                            output=output)
+   return await _multiplexed(host, build, masters, loginname, port=port,
+                             keyloc=keyloc, timeout=timeout, index=index,
+                             output=output)
+
+class SSHException(Exception):
+   """
+   SSHException(Exception)
+   """
+
+   def __init__(self, value):
+      self.value = value
+
+   def __str__(self):
+      return repr(self.value)
 
@@ -0,0 +1,286 @@
+"""
+sync.py
+
+   Content-hashed delta synchronization of a directory to nodes
+
+      A manifest maps every file of the directory to its SHA-1 and mode.
+      The manifest last synced to each node is kept in the database, and
+      a marker file in the remote directory holds its digest, so that a
+      node only receives the files that changed since its last sync, as
+      one tar stream:
+
+         cd dir && test "$(cat .deploypl-manifest)" = <base> || exit 3
+         tar xzf - && rm -f <removed> && echo <digest> > .deploypl-manifest
+
+      Up to date nodes only check the marker, nodes whose marker does not
+      match (reinstalled, modified) exit with SYNC_MISMATCH and get the
+      whole directory, as a bundle (see deployer.bundle) extracted from
+      the login directory. Remote files that the bundle does not hold are
+      then removed, before the marker is written.
+
+@author: K.Edeline
+"""
+import os
+import json
+import stat
+import shlex
+import hashlib
+import tarfile
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, DateTime, Integer, String, Text
+
+from deployer.node import Base, session_scope
+
+## remote file holding the digest of the synced manifest
+MARKER = ".deploypl-manifest"
+
+## exit status of a sync command whose base manifest is not on the node
+SYNC_MISMATCH = 3
+
+def _file_digest(path, blocksize=65536):
+   sha1 = hashlib.sha1()
+   with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(blocksize), b""):
+         sha1.update(block)
+   return sha1.hexdigest()
+
+def file_entry(path, st, stats=None):
+   """
+   @param st os.lstat() of path
+   @param stats {path: (size, mtime, sha1)} cache, files are only hashed
+                again when their size or mtime change
+   @return the manifest entry of file path, "sha1 mode"
+   """
+   cached = None if stats is None else stats.get(path)
+   if cached is None or cached[:2] != (st.st_size, st.st_mtime):
+      cached = (st.st_size, st.st_mtime, _file_digest(path))
+      if stats is not None:
+         stats[path] = cached
+   return "{} {:o}".format(cached[2], st.st_mode & 0o7777)
+
+def scan_manifest(dirloc, stats=None):
+   """
+   @param stats see file_entry()
+   @return the manifest of the regular files of directory dirloc,
+           {path: "sha1 mode"}
+   """
+   manifest = {}
+   for root, dirs, files in os.walk(dirloc):
+      dirs.sort()
+      for name in files:
+         if name == MARKER and root == dirloc:
+            continue
+         path = os.path.join(root, name)
+         st   = os.lstat(path)
+         if stat.S_ISREG(st.st_mode):
+            manifest[os.path.relpath(path, dirloc)] = file_entry(path, st, 
+                                                                 stats)
+   return manifest
+
+def manifest_digest(manifest):
+   """
+   @return the digest of a manifest
+   """
+   sha1 = hashlib.sha1()
+   for path in sorted(manifest):
+      sha1.update("{}\0{}\n".format(path, manifest[path]).encode('utf8'))
+   return sha1.hexdigest()
+
+def diff(old, new):
+   """
+   @return (changed or new paths, removed paths) from manifest old to new
+   """
+   changed = sorted(p for p, v in new.items() if old.get(p) != v)
+   removed = sorted(p for p in old if p not in new)
+   return changed, removed
+
+def write_bundle(dirloc, paths, bundle):
+   """
+   Write paths of dirloc to the tar.gz file bundle
+   """
+   def reset(info):
+      info.uid = info.gid = 0
+      info.uname = info.gname = ""
+      return info
+
+   with tarfile.open(bundle, "w:gz") as tar:
+      for path in paths:
+         tar.add(os.path.join(dirloc, path), arcname=path, recursive=False,
+                 filter=reset)
+
+def sync_command(remotedir, digest, base=None, removed=(), bundle=True):
+   """
+   @param remotedir remote directory, relative to the login directory
+   @param digest digest of the manifest being synced
+   @param base digest of the manifest the delta applies to, None for a
+               full sync, whose bundle holds remotedir itself
+   @param removed paths to remove
+   @param bundle True if a tar.gz bundle is fed to standard input, or the
+                 path of a bundle already copied to the node, relative to
+                 the login directory, removed once extracted
+   @return the command line that applies a delta to remotedir
+   """
+   source    = "-" if bundle is True else shlex.quote(bundle or "-")
+   marker    = shlex.quote(os.path.join(remotedir, MARKER))
+   # paths extracted by a full sync, other files are removed
+   files     = shlex.quote(remotedir+".deploypl-files")
+   remotedir = shlex.quote(remotedir)
+   # a sync that fails half-way leaves no marker, next one is full
+   if base is None:
+      steps = ["mkdir -p {}".format(remotedir), "rm -f {}".format(marker)]
+      if bundle:
+         steps.append("tar xzvf {} > {}".format(source, files))
+      else:
+         steps.append(": > {}".format(files))
+      steps.append("find {} -type f | grep -vxFf {} "
+                   "| xargs -r -d '\\n' rm -f --".format(remotedir, files))
+      steps.append("rm -f {}".format(files))
+      if bundle is not True and bundle:
+         steps.append("rm -f {}".format(source))
+      steps.append("echo {} > {}".format(digest, marker))
+      return " && ".join(steps)
+
+   check = ('cd {} 2>/dev/null && test "$(cat {} 2>/dev/null)" = {} '
+            '|| exit {}'.format(remotedir, MARKER, base, SYNC_MISMATCH))
+   if base == digest:
+      return check
+
+   steps = ["rm -f {}".format(MARKER)]
+   if bundle:
+      steps.append("tar xzf -")
+   if removed:
+      steps.append("rm -f -- {}".format(
+                           " ".join(shlex.quote(p) for p in removed)))
+   steps.append("echo {} > {}".format(digest, MARKER))
+   return check + "; " + " && ".join(steps)
+
+class PLNodeSync(Base):
+   """
+   PLNodeSync
+
+      manifest last synced to a node
+   """
+   ## SQLAlchemy attributes
+   __tablename__ = "syncs"
+   id        = Column(Integer, primary_key=True)
+   remotedir = Column(String(1024))
+   digest    = Column(String(40))
+   synced_at = Column(DateTime)
+
+   def to_dict(self):
+      return {k : getattr(self, k)
+               for k in PLNodeSync.__table__.columns.keys()}
+
+class PLSyncManifest(Base):
+   """
+   PLSyncManifest
+
+      manifests synced to at least one node, by digest
+   """
+   ## SQLAlchemy attributes
+   __tablename__ = "syncmanifests"
+   digest   = Column(String(40), primary_key=True)
+   ## json {path: "sha1 mode"}
+   manifest = Column(Text)
+
+class PLSync(object):
+   """
+   PLSync
+
+      Local manifest of synced directories, and manifests synced to
+      nodes, loaded from and saved to the database
+   """
+
+   def __init__(self):
+      ## node id -> PLNodeSync
+      self._entries   = {}
+      ## digest -> manifest
+      self._manifests = {}
+      ## local path -> (size, mtime, digest), see file_entry()
+      self._stats     = {}
+      self._dirty     = set()
+      ## ids of nodes to check again whatever their last sync
+      self._stale     = set()
+
+   def load(self, session):
+      """
+      Load synced manifests from database
+      """
+      self._entries   = {e.id : e for e in session.query(PLNodeSync).all()}
+      self._manifests = {m.digest : json.loads(m.manifest)
+                           for m in session.query(PLSyncManifest).all()}
+
+   def save(self, daemon, db_loc):
+      """
+      Write syncs recorded since last save to database, and drop the
+      manifests no node refers to anymore
+      """
+      if not self._dirty:
+         return
+      rows = [self._entries[i].to_dict() for i in self._dirty]
+      self._dirty.clear()
+
+      used = {e.digest for e in self._entries.values()}
+      for digest in set(self._manifests) - used:
+         del self._manifests[digest]
+      with session_scope(daemon, db_loc) as session:
+         session.execute(PLNodeSync.__table__.insert()
+                                          .prefix_with("OR REPLACE"), rows)
+         table = PLSyncManifest.__table__
+         session.execute(table.delete().where(table.c.digest.notin_(used)))
+         session.execute(table.insert().prefix_with("OR IGNORE"),
+                         [{"digest" : d, "manifest" : json.dumps(m)}
+                            for d, m in self._manifests.items()])
+
+   def scan(self, dirloc):
+      """
+      @return the manifest of directory dirloc, {path: "sha1 mode"}
+      """
+      return scan_manifest(dirloc, stats=self._stats)
+
+   def base(self, node, remotedir):
+      """
+      @return the digest of the manifest last synced to node remotedir,
+              None if it is unknown
+      """
+      entry = self._entries.get(node.id)
+      if (entry is None or entry.remotedir != remotedir
+            or entry.digest not in self._manifests):
+         return None
+      return entry.digest
+
+   def due(self, node, remotedir, digest, period, now=None):
+      """
+      @return True if node remotedir must be synced: it does not hold 
+              manifest digest, its marker was last checked more than 
+              period seconds ago, or it is marked stale
+      """
+      now   = now or datetime.utcnow()
+      entry = self._entries.get(node.id)
+      return (self.base(node, remotedir) != digest or node.id in self._stale
+               or entry.synced_at + timedelta(seconds=period) <= now)
+
+   def forget(self, node):
+      """
+      Check node marker on next sync, e.g. when it just became usable
+      """
+      self._stale.add(node.id)
+
+   def manifest(self, digest):
+      """
+      @return the manifest of digest, an empty one if digest is None
+      """
+      return self._manifests[digest] if digest is not None else {}
+
+   def record(self, node, remotedir, digest, manifest, now=None):
+      """
+      Record that manifest was synced to node remotedir
+      """
+      self._manifests[digest] = manifest
+      self._entries[node.id]  = PLNodeSync(id=node.id, remotedir=remotedir,
+                                          digest=digest,
+                                          synced_at=now or datetime.utcnow())
+      self._dirty.add(node.id)
+      self._stale.discard(node.id)
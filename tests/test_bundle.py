@@ -0,0 +1,112 @@
+"""
+test_bundle.py
+
+   bundle cache hits, misses, eviction and directory checks
+
+@author: K.Edeline
+"""
+import os
+import time
+import unittest
+
+from deployer.bundle import PLBundleCache, PLBundleCacheException
+
+from tests.util import TempDirTestCase
+
+class BundleCacheTest(TempDirTestCase):
+
+   def setUp(self):
+      super(BundleCacheTest, self).setUp()
+      self.cachedir = os.path.join(self.dir, "cache")
+      self.local    = os.path.join(self.dir, "exp")
+      os.mkdir(self.local)
+      self.write("a.txt", "a"*1000)
+
+   def write(self, name, content):
+      path = os.path.join(self.local, name)
+      with open(path, 'w') as f:
+         f.write(content)
+      # a different mtime at each write
+      os.utime(path, (time.time(), time.time() + len(content)))
+
+   def test_hit_and_miss(self):
+      cache = PLBundleCache(self.cachedir)
+      path  = cache.get([self.local])
+      self.assertEqual(oct(os.stat(self.cachedir).st_mode & 0o777), "0o700")
+      self.assertTrue(os.path.exists(path+".sha1"))
+      inode = os.stat(path).st_ino
+
+      # hit, in this and a new cache
+      self.assertEqual(cache.get([self.local]), path)
+      self.assertEqual(PLBundleCache(self.cachedir).get([self.local]), path)
+      self.assertEqual(os.stat(path).st_ino, inode)
+
+      # the key changes with the content
+      self.write("a.txt", "b"*1001)
+      other = cache.get([self.local])
+      self.assertNotEqual(other, path)
+      self.assertEqual(cache.key([self.local]),
+                       os.path.basename(other)[:-len(".tar.gz")])
+
+   def test_corrupted(self):
+      cache = PLBundleCache(self.cachedir)
+      path  = cache.get([self.local])
+      with open(path, 'r+b') as f:
+         f.truncate(10)
+      # checked again in a new cache, and rebuilt
+      self.assertEqual(PLBundleCache(self.cachedir).get([self.local]), path)
+      self.assertGreater(os.path.getsize(path), 10)
+
+      # interrupted write
+      os.remove(path+".sha1")
+      PLBundleCache(self.cachedir).get([self.local])
+      self.assertTrue(os.path.exists(path+".sha1"))
+
+   def test_eviction(self):
+      cache   = PLBundleCache(self.cachedir)
+      bundles = []
+      for i in range(4):
+         self.write("a.txt", str(i)*1000)
+         bundles.append(cache.get([self.local]))
+         # last use times in order
+         os.utime(bundles[-1], (i, i))
+      size = os.path.getsize(bundles[0])
+
+      # room for two, the least recently used go first
+      cache.maxsize = 2 * size + 10
+      os.utime(bundles[0], (10, 10))
+      cache.evict(keep=bundles[3])
+      self.assertEqual([os.path.exists(b) for b in bundles],
+                       [True, False, False, True])
+      self.assertEqual(sorted(os.listdir(self.cachedir)),
+                       sorted(os.path.basename(name) for b in [bundles[0],
+                              bundles[3]] for name in [b, b+".sha1"]))
+
+   def test_unsafe_dir(self):
+      os.mkdir(self.cachedir)
+      os.chmod(self.cachedir, 0o755)
+      with self.assertRaises(PLBundleCacheException):
+         PLBundleCache(self.cachedir)
+
+      os.chmod(self.cachedir, 0o700)
+      link = os.path.join(self.dir, "link")
+      os.symlink(self.cachedir, link)
+      with self.assertRaises(PLBundleCacheException):
+         PLBundleCache(link)
+
+   @unittest.skipUnless(os.getuid() == 0, "needs root to change owner")
+   def test_foreign_dir(self):
+      os.mkdir(self.cachedir, 0o700)
+      os.chown(self.cachedir, 65534, 65534)
+      with self.assertRaises(PLBundleCacheException):
+         PLBundleCache(self.cachedir)
+
+   def test_temporary(self):
+      cache = PLBundleCache()
+      path  = cache.get([self.local])
+      self.assertTrue(os.path.exists(path))
+      cache.close()
+      self.assertFalse(os.path.exists(cache.cachedir))
+
+if __name__ == '__main__':
+   unittest.main()
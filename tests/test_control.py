@@ -0,0 +1,136 @@
+"""
+test_control.py
+
+   control socket round trips between PLControlServer and PLControlClient
+
+@author: K.Edeline
+"""
+import os
+import stat
+import unittest
+
+from deployer.node import PLNodePool, PLNodeState
+from deployer.scores import PLScores
+from deployer.history import PLHistory
+from deployer.control import PLControlServer, PLControlClient
+from deployer.control import PLControlException, control_request
+
+from tests.util import TempDirTestCase
+
+class ControlTest(TempDirTestCase):
+
+   def setUp(self):
+      super(ControlTest, self).setUp()
+      names = ["node{}.example.org".format(i) for i in range(4)]
+      self.pool = PLNodePool(self.daemon, rawfile=self.raw(names),
+                             db_loc=self.db_loc)
+      self.nodes = sorted(self.pool.pool, key=lambda n: n.name)
+      for i, node in enumerate(self.nodes):
+         self.pool._update_node(node, {"addr": "10.0.0.{}".format(i),
+                                       "state": [PLNodeState.usable,
+                                             PLNodeState.reachable][i % 2]})
+      self.pool.update()
+
+      self.pool.scores  = PLScores()
+      self.pool.history = PLHistory(os.path.join(self.dir, "history"))
+      for i, node in enumerate(self.nodes):
+         ping = {"sent": 3, "received": 3, "avgping": 10.0 + i}
+         self.pool.scores.record(node, ping, node.state)
+         self.pool.history.append(node.id, "ping", node.state, ping=ping,
+                                  ts=1000 + i)
+      self.pool.scores.save(self.daemon, self.db_loc)
+      self.pool.history.flush()
+
+      self.path   = os.path.join(self.dir, "control.sock")
+      self.server = PLControlServer(self.path, self.pool, group=os.getgid())
+      self.server.start()
+      self.client = PLControlClient(self.path)
+
+   def tearDown(self):
+      self.server.stop()
+      super(ControlTest, self).tearDown()
+
+   def request(self, **request):
+      return control_request(self.path, request)
+
+   def test_socket(self):
+      st = os.stat(self.path)
+      self.assertTrue(stat.S_ISSOCK(st.st_mode))
+      self.assertEqual(st.st_mode & 0o777, 0o660)
+      self.assertEqual(st.st_gid, os.getgid())
+      self.server.stop()
+      self.assertFalse(os.path.exists(self.path))
+
+   def test_status(self):
+      self.assertEqual(self.client.status(), self.pool.status())
+      self.assertEqual(self.client.status(min_state=PLNodeState.usable),
+                       self.pool.status(min_state=PLNodeState.usable))
+
+   def test_nodes(self):
+      self.assertEqual(sorted(self.client._get("addr",
+                                          min_state=PLNodeState.usable)),
+                       ["10.0.0.0", "10.0.0.2"])
+      self.assertEqual(sorted(self.client._get("name",
+                                          state=PLNodeState.reachable)),
+                       ["node1.example.org", "node3.example.org"])
+      with self.assertRaises(PLControlException):
+         self.client._get("password")
+
+   def test_node(self):
+      node = self.nodes[1]
+      for key in [node.addr, node.name, node.id, str(node.id)]:
+         detail = self.request(cmd="node", key=key)["node"]
+         self.assertEqual(detail["id"], node.id)
+         self.assertEqual(detail["name"], node.name)
+         self.assertEqual(detail["state"], "reachable")
+      with self.assertRaises(PLControlException):
+         self.request(cmd="node", key="10.9.9.9")
+
+      # address changes are seen once flushed
+      self.pool._update_node(node, {"addr": "10.0.1.1"})
+      self.pool.update()
+      self.assertEqual(self.request(cmd="node", key="10.0.1.1")["node"]["id"],
+                       node.id)
+      with self.assertRaises(PLControlException):
+         self.request(cmd="node", key="10.0.0.1")
+
+   def test_top(self):
+      rows = self.client.top(n=2, sort="rtt")
+      self.assertEqual([row["addr"] for row in rows], ["10.0.0.0",
+                                                       "10.0.0.1"])
+      rows = self.client.top(n=4)
+      self.assertEqual([row["availability"] for row in rows],
+                       [1.0, 1.0, 0.0, 0.0])
+      with self.assertRaises(PLControlException):
+         self.client.top(sort="name")
+
+   def test_history(self):
+      node    = self.nodes[2]
+      records = self.request(cmd="history", key=node.name)["history"]
+      self.assertEqual(len(records), 1)
+      self.assertEqual(records[0]["time"], 1002)
+      self.assertEqual(self.request(cmd="history", key=node.addr,
+                                    resolution="hourly")["history"], [])
+      with self.assertRaises(PLControlException):
+         self.request(cmd="history", key=node.addr, resolution="weekly")
+
+   def test_metrics(self):
+      self.assertEqual(self.request(cmd="metrics"), {})
+      self.pool.metrics_snapshot = {"cycle": {"nodes": 4}}
+      self.assertEqual(self.request(cmd="metrics"), {"cycle": {"nodes": 4}})
+
+   def test_unknown(self):
+      with self.assertRaises(PLControlException) as cm:
+         self.request(cmd="reboot")
+      self.assertIn("unknown command", str(cm.exception))
+      # the server still answers
+      self.assertIn("status", self.request(cmd="status"))
+
+   def test_missing_socket(self):
+      # deploypl status then falls back to the database
+      self.server.stop()
+      with self.assertRaises(OSError):
+         self.client.status()
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,150 @@
+"""
+test_executor.py
+
+   ssh executor timeouts, deadline, cancellation and streamed results,
+   against the benchmarks fake ssh(1). Sessions must leave no process 
+   behind.
+
+@author: K.Edeline
+"""
+import os
+import time
+import uuid
+import shutil
+import tempfile
+import asyncio
+import unittest
+
+from deployer.ssh import SSHExecutor, ssh_command, run_command
+from deployer.ssh import run_command_iter
+
+FAKEBIN = os.path.join(os.path.dirname(os.path.dirname(
+                       os.path.abspath(__file__))), "benchmarks", "fakebin")
+
+## mean fake session time of sessions that never end within a test
+FOREVER = "1000000"
+
+class ExecutorTestCase(unittest.TestCase):
+   """
+   test case with the benchmarks fake ssh first in PATH, its sessions are
+   tagged so that they can be found in /proc
+   """
+
+   def setUp(self):
+      self.environ = dict(os.environ)
+      self.token   = uuid.uuid4().hex
+      os.environ["PATH"] = FAKEBIN+os.pathsep+os.environ["PATH"]
+      os.environ["DEPLOYPL_TEST_TOKEN"] = self.token
+      os.environ["BENCH_SSH_LATENCY"]   = FOREVER
+      os.environ["BENCH_SSH_FAIL"]      = "0"
+      self.hosts = ["10.0.0.{}".format(i) for i in range(6)]
+      self.dir   = tempfile.mkdtemp(prefix="deploypl-test-")
+
+   def tearDown(self):
+      os.environ.clear()
+      os.environ.update(self.environ)
+      shutil.rmtree(self.dir, ignore_errors=True)
+
+   def leftovers(self):
+      """
+      @return pids of processes started by the test sessions
+      """
+      tag  = "DEPLOYPL_TEST_TOKEN={}".format(self.token).encode('ascii')
+      pids = []
+      for name in os.listdir("/proc"):
+         if not name.isdigit() or int(name) == os.getpid():
+            continue
+         try:
+            with open(os.path.join("/proc", name, "environ"), 'rb') as f:
+               if tag in f.read().split(b"\0"):
+                  pids.append(int(name))
+         except OSError:
+            continue
+      return pids
+
+   def assertNoLeftovers(self):
+      # killed processes may take a moment to go
+      end = time.time() + 2
+      while self.leftovers() and time.time() < end:
+         time.sleep(0.05)
+      self.assertEqual(self.leftovers(), [])
+
+   def jobs(self):
+      return [(host, ssh_command(host, "user", "true"))
+                  for host in self.hosts]
+
+class ExecutorTest(ExecutorTestCase):
+
+   def test_complete(self):
+      os.environ["BENCH_SSH_LATENCY"] = "0.01"
+      results = run_command(self.hosts, "user", "true", threads=3)
+      self.assertEqual(sorted(r["host"] for r in results), self.hosts)
+      self.assertTrue(all(r["status"] == 0 and not r["errors"]
+                          for r in results))
+      self.assertNoLeftovers()
+
+   def test_timeout(self):
+      start   = time.time()
+      results = run_command(self.hosts, "user", "true", timeout=0.5)
+      self.assertLess(time.time() - start, 3)
+      self.assertEqual(sorted(r["host"] for r in results), self.hosts)
+      self.assertTrue(all(r["errors"] == "Timed out" for r in results))
+      self.assertNoLeftovers()
+
+   def test_deadline(self):
+      # two slots: jobs that did not start are not started
+      start    = time.time()
+      executor = SSHExecutor(limit=2, timeout=10, deadline=0.5)
+      results  = executor.run_sync(self.jobs())
+      self.assertLess(time.time() - start, 3)
+      self.assertEqual(sorted(r["index"] for r in results), list(range(6)))
+      self.assertTrue(all(r["errors"] == "Timed out" for r in results))
+      self.assertNoLeftovers()
+
+   def test_cancel(self):
+      executor = SSHExecutor(limit=2, timeout=10)
+      loop     = asyncio.new_event_loop()
+      try:
+         loop.call_later(0.5, executor.cancel)
+         results = loop.run_until_complete(executor.run(self.jobs()))
+      finally:
+         loop.close()
+      self.assertEqual(sorted(r["index"] for r in results), list(range(6)))
+      self.assertTrue(all(r["errors"] == "Cancelled" for r in results))
+      self.assertNoLeftovers()
+
+class IterTest(ExecutorTestCase):
+
+   def test_streaming(self):
+      # one slot, each session times out after 0.3s
+      start = time.time()
+      times = []
+      for result in run_command_iter(self.hosts, "user", "true", 
+                                     timeout=0.3, threads=1):
+         times.append(time.time() - start)
+         self.assertEqual(result["errors"], "Timed out")
+      self.assertEqual(len(times), 6)
+      # yielded as each completes, not at the end
+      self.assertLess(times[0], 1.0)
+      self.assertGreater(times[-1] - times[0], 1.0)
+      self.assertNoLeftovers()
+
+   def test_close(self):
+      forks   = os.path.join(self.dir, "forks")
+      os.environ["BENCH_FORKS"] = forks
+      start   = time.time()
+      results = run_command_iter(self.hosts, "user", "true", timeout=0.3,
+                                 threads=2)
+      first   = next(results)
+      results.close()
+      self.assertEqual(first["errors"], "Timed out")
+      self.assertLess(time.time() - start, 1.0)
+      # the other sessions are killed, the remaining jobs never start
+      self.assertNoLeftovers()
+      with open(forks) as f:
+         self.assertLess(len(f.readlines()), len(self.hosts))
+      with self.assertRaises(StopIteration):
+         next(results)
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,163 @@
+"""
+test_fanout.py
+
+   relay distribution, against a fake ssh(1) that runs commands in one
+   local directory per host. Sessions opened from a host directory are
+   relay sessions: they are only let in with a key authorized on the
+   target host, and run its forced command.
+
+@author: K.Edeline
+"""
+import os
+import sys
+import stat
+import shutil
+import unittest
+
+from deployer.fanout import fanout_upload, fanout_tree, RELAY_KEY
+
+from tests.util import TempDirTestCase
+
+FAKE_SSH = r"""#!{python}
+import os, re, sys, subprocess
+
+args, host, key, cmd = sys.argv[1:], None, None, None
+while args:
+   arg = args.pop(0)
+   if arg == "-i":
+      key = args.pop(0)
+   elif arg in ("-o", "-l", "-p", "-O"):
+      args.pop(0)
+   elif arg.startswith("-"):
+      pass
+   elif host is None:
+      host = arg
+   else:
+      cmd = arg
+
+root = os.path.realpath(os.environ["FAKE_SSH_ROOT"])
+home = os.path.join(root, host)
+os.makedirs(home, exist_ok=True)
+if os.path.realpath(os.getcwd()).startswith(root + os.sep):
+   # relay session
+   if host in os.environ.get("FAKE_SSH_REFUSE", "").split():
+      sys.exit(255)
+   pub = subprocess.check_output(["ssh-keygen", "-y", "-f", key])
+   pub, cmd = pub.decode().split()[:2], None
+   try:
+      with open(os.path.join(home, ".ssh", "authorized_keys")) as f:
+         lines = f.read().splitlines()
+   except FileNotFoundError:
+      lines = []
+   for line in lines:
+      m = re.match(r'.*command="((?:[^"\\]|\\.)*)" (.*)$', line)
+      if m and m.group(2).split()[:2] == pub:
+         cmd = re.sub(r'\\(.)', r'\1', m.group(1))
+   if cmd is None:
+      sys.exit(255)
+sys.exit(subprocess.call(["sh", "-c", cmd], cwd=home))
+"""
+
+@unittest.skipIf(shutil.which("ssh-keygen") is None, "no ssh-keygen")
+class FanoutTest(TempDirTestCase):
+
+   def setUp(self):
+      super(FanoutTest, self).setUp()
+      bindir = os.path.join(self.dir, "bin")
+      os.mkdir(bindir)
+      ssh = os.path.join(bindir, "ssh")
+      with open(ssh, 'w') as f:
+         f.write(FAKE_SSH.format(python=sys.executable))
+      os.chmod(ssh, os.stat(ssh).st_mode | stat.S_IEXEC)
+
+      self.root    = os.path.join(self.dir, "hosts")
+      self.environ = dict(os.environ)
+      os.environ["PATH"]          = bindir+os.pathsep+os.environ["PATH"]
+      os.environ["FAKE_SSH_ROOT"] = self.root
+      os.environ.pop("FAKE_SSH_REFUSE", None)
+
+      self.hosts = ["10.0.0.{}".format(i) for i in range(12)]
+      self.rtts  = {host : i for i, host in enumerate(self.hosts)}
+      self.local = os.path.join(self.dir, "bundle.bin")
+      with open(self.local, 'wb') as f:
+         f.write(os.urandom(65536))
+
+      # a key of the slice owner, kept by the cleanup
+      self.owner = "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIOwner owner@host"
+      sshdir = os.path.join(self.root, self.hosts[5], ".ssh")
+      os.makedirs(sshdir)
+      with open(os.path.join(sshdir, "authorized_keys"), 'w') as f:
+         f.write(self.owner+"\n")
+
+   def tearDown(self):
+      os.environ.clear()
+      os.environ.update(self.environ)
+      super(FanoutTest, self).tearDown()
+
+   def upload(self):
+      results = fanout_upload(self.hosts, "user", self.local, "dir/bundle.bin",
+                              rtts=self.rtts, seeds=2, degree=2, timeout=30)
+      self.assertEqual(sorted(r['host'] for r in results), sorted(self.hosts))
+      self.assertTrue(all(r['status'] == 0 for r in results),
+                      [(r['host'], r['status'], r['stderr']) for r in results])
+      with open(self.local, 'rb') as f:
+         data = f.read()
+      for host in self.hosts:
+         with open(os.path.join(self.root, host, "dir", "bundle.bin"), 
+                   'rb') as f:
+            self.assertEqual(f.read(), data)
+      return {r['host'] : r for r in results}
+
+   def assertCleanedUp(self):
+      for host in self.hosts:
+         home = os.path.join(self.root, host)
+         self.assertFalse([name for name in os.listdir(home) 
+                                if name.startswith(RELAY_KEY)])
+         keys = os.path.join(home, ".ssh", "authorized_keys")
+         if os.path.exists(keys):
+            with open(keys) as f:
+               self.assertNotIn(RELAY_KEY, f.read())
+      with open(os.path.join(self.root, self.hosts[5], ".ssh",
+                             "authorized_keys")) as f:
+         self.assertEqual(f.read(), self.owner+"\n")
+
+   def test_relay(self):
+      results = self.upload()
+      self.assertEqual({h for h, r in results.items() if r['relay'] is None},
+                       set(self.hosts[:2]))
+      self.assertTrue(all(r['relay_failed'] is None 
+                             for r in results.values()))
+      self.assertCleanedUp()
+
+   def test_refused_relay(self):
+      refused = self.hosts[4]
+      os.environ["FAKE_SSH_REFUSE"] = refused
+      results = self.upload()
+      self.assertIsNone(results[refused]['relay'])
+      self.assertIsNotNone(results[refused]['relay_failed'])
+      self.assertTrue(any(r['relay'] is not None for r in results.values()))
+      self.assertCleanedUp()
+
+class FanoutTreeTest(unittest.TestCase):
+
+   def test_tree(self):
+      hosts = ["h{}".format(i) for i in range(20)]
+      rtts  = {host : 20 - i for i, host in enumerate(hosts)}
+      del rtts["h19"]
+      seeds, children = fanout_tree(hosts, rtts=rtts, seeds=3, degree=4)
+      self.assertEqual(seeds, ["h18", "h17", "h16"])
+
+      parents = {}
+      for host, kids in children.items():
+         self.assertLessEqual(len(kids), 4)
+         for kid in kids:
+            self.assertNotIn(kid, parents)
+            parents[kid] = host
+      self.assertEqual(set(parents) | set(seeds), set(hosts))
+      self.assertFalse(set(parents) & set(seeds))
+      # unknown rtt last
+      self.assertEqual(max(children, key=lambda h: 
+                           (h in parents, h == "h19")), "h19")
+
+if __name__ == '__main__':
+   unittest.main()
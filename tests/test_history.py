@@ -0,0 +1,168 @@
+"""
+test_history.py
+
+@author: K.Edeline
+"""
+import os
+import json
+import calendar
+import unittest
+
+from datetime import datetime
+from unittest import mock
+
+import deployer.history
+
+from deployer.history import PLHistory, RAW
+from deployer.node import PLNodeState
+
+from tests.util import TempDirTestCase
+
+## 2026-10-01 00:00 UTC
+DAY = calendar.timegm(datetime(2026, 10, 1).timetuple())
+
+def ping(sent, received, rtts=None):
+   """
+   @return a ping_parse() dictionary
+   """
+   rtts = [str(v) for v in rtts] if rtts else ['NaN'] * 4
+   return {'host' : "10.0.0.1", 'sent' : sent, 'received' : received,
+           'minping' : rtts[0], 'avgping' : rtts[1], 'maxping' : rtts[2],
+           'jitter' : rtts[3]}
+
+class HistoryTest(TempDirTestCase):
+
+   def setUp(self):
+      super(HistoryTest, self).setUp()
+      self.history = PLHistory(os.path.join(self.dir, "history"), shards=4,
+                               raw_days=1, hourly_days=31, daily_days=366)
+
+   def probes(self):
+      """
+      two hours of probes of node 5, one usable probe with replies and
+      one unreachable probe per hour
+      """
+      for hour in range(2):
+         ts = DAY + hour * 3600
+         self.history.append(5, "fix", PLNodeState.usable, 
+                             ping=ping(3, 3, [10 + hour, 20 + hour, 
+                                              30 + hour, 2]), ts=ts)
+         self.history.append(5, "ping", PLNodeState.unreachable,
+                             ping=ping(3, 0), ts=ts + 60)
+      self.history.append(6, "ssh", PLNodeState.reachable, ts=DAY)
+      self.assertEqual(self.history.flush(), 5)
+
+   def test_format(self):
+      self.probes()
+      records = self.history.scan(5)
+      self.assertEqual(len(records), 4)
+      first = records[0]
+      self.assertEqual((first.node_id, first.time, first.stage, first.state),
+                       (5, DAY, "fix", PLNodeState.usable))
+      self.assertEqual((first.sent, first.received), (3, 3))
+      self.assertEqual((first.rttmin, first.rtt, first.rttmax, first.jitter),
+                       (10, 20, 30, 2))
+      lost = records[1]
+      self.assertEqual((lost.stage, lost.state, lost.sent, lost.received),
+                       ("ping", PLNodeState.unreachable, 3, 0))
+      self.assertEqual((lost.rttmin, lost.rtt, lost.rttmax, lost.jitter),
+                       (None,) * 4)
+      # not pinged
+      other, = self.history.scan(6)
+      self.assertEqual((other.sent, other.received, other.rtt), (0, 0, None))
+      self.assertEqual(len(self.history.scan(5, start=DAY + 60, 
+                                             end=DAY + 3660)), 2)
+
+   def test_partial_record(self):
+      self.probes()
+      path = self.history._path("raw", "20261001", 5 % 4)
+      with open(path, 'ab') as f:
+         f.write(b"\0" * (RAW.size // 2))
+      self.assertEqual(len(self.history.scan(5)), 4)
+
+      # dropped before next append
+      self.history.append(5, "ping", PLNodeState.unreachable, 
+                          ts=DAY + 7200)
+      self.history.flush()
+      self.assertEqual(len(self.history.scan(5)), 5)
+      self.assertEqual(os.path.getsize(path) % RAW.size, 0)
+
+   def test_downsample(self):
+      self.probes()
+      self.assertEqual(self.history.downsample(now=DAY + 3 * 86400), 1)
+      self.assertEqual(self.history.scan(5), [])
+      hourly = self.history.scan(5, resolution="hourly")
+      self.assertEqual([tuple(r) for r in hourly],
+                       [(5, DAY, 2, 1, 1, 6, 3, 20, 10, 30, 2),
+                        (5, DAY + 3600, 2, 1, 1, 6, 3, 21, 11, 31, 2)])
+
+      # hourly into daily, rtt of replied probes only
+      self.assertEqual(self.history.downsample(now=DAY + 70 * 86400), 1)
+      daily, = self.history.scan(5, resolution="daily")
+      self.assertEqual(tuple(daily), (5, DAY, 4, 2, 2, 12, 6, 20.5, 10, 31, 2))
+      other, = self.history.scan(6, resolution="daily")
+      self.assertEqual(tuple(other), (6, DAY, 1, 0, 0, 0, 0, 
+                                      None, None, None, None))
+
+      # expired
+      self.assertEqual(self.history.downsample(now=DAY + 800 * 86400), 1)
+      self.assertEqual(self.history.scan(5, resolution="daily"), [])
+
+   def test_fold_interrupted_before_journal(self):
+      self.probes()
+      write = deployer.history._write
+      def crash(path, *chunks):
+         if path.endswith(".fold.tmp"):
+            raise OSError("crash")
+         write(path, *chunks)
+      with mock.patch("deployer.history._write", crash):
+         with self.assertRaises(OSError):
+            self.history.downsample(now=DAY + 3 * 86400)
+      # probes not folded yet
+      self.assertEqual(len(self.history.scan(5)), 4)
+      self.assertEqual(self.history.scan(5, resolution="hourly"), [])
+
+      self.assertEqual(self.history.downsample(now=DAY + 3 * 86400), 1)
+      self.assertEqual(self.history.scan(5), [])
+      self.assertEqual([r.probes for r in self.history.scan(5, 
+                           resolution="hourly")], [2, 2])
+      self.assertFalse(self.leftovers())
+
+   def test_fold_interrupted_after_journal(self):
+      self.probes()
+      # an hour of aggregates already there
+      self.history.downsample(now=DAY + 3 * 86400)
+      self.history.append(5, "fix", PLNodeState.usable, 
+                          ping=ping(3, 3, [1, 2, 3, 0]), ts=DAY + 86400)
+      self.history.flush()
+
+      def crash(history, resolution, partition):
+         # first target moved in place, then crash
+         with open(history._journal(resolution, partition)) as f:
+            new, path = json.load(f)[0]
+         os.replace(os.path.join(history.directory, new), 
+                    os.path.join(history.directory, path))
+         raise OSError("crash")
+      with mock.patch.object(PLHistory, "_commit", crash):
+         with self.assertRaises(OSError):
+            self.history.downsample(now=DAY + 4 * 86400)
+      self.assertTrue(self.leftovers())
+
+      self.assertEqual(self.history.downsample(now=DAY + 4 * 86400), 1)
+      hourly = self.history.scan(5, resolution="hourly")
+      self.assertEqual([r.probes for r in hourly], [2, 2, 1])
+      self.assertEqual(self.history.scan(5), [])
+      self.assertFalse(self.leftovers())
+      # completing twice does not count twice
+      self.assertEqual(self.history.downsample(now=DAY + 4 * 86400), 0)
+      self.assertEqual(len(self.history.scan(5, resolution="hourly")), 3)
+
+   def leftovers(self):
+      """
+      @return journals and chunk files of unfinished folds
+      """
+      return [name for _, _, names in os.walk(self.history.directory)
+                   for name in names if name.endswith((".fold", ".new"))]
+
+if __name__ == '__main__':
+   unittest.main()
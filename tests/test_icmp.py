@@ -0,0 +1,70 @@
+"""
+test_icmp.py
+
+@author: K.Edeline
+"""
+import socket
+import asyncio
+import unittest
+
+from unittest import mock
+
+from deployer.ping import PingException
+from deployer.icmp import ICMPProber, icmp_batch, icmp_check
+from deployer.poller import PLPoller
+
+from tests.util import TempDirTestCase
+
+def icmp_allowed():
+   try:
+      icmp_check()
+   except PingException:
+      return False
+   return True
+
+def no_icmp(family, kind, proto=0, *args, **kwargs):
+   raise PermissionError(1, "Operation not permitted")
+
+class ICMPTest(unittest.TestCase):
+
+   @unittest.skipUnless(icmp_allowed(), "no ICMP socket allowed")
+   def test_loopback(self):
+      addrs   = ["127.0.0.{}".format(i) for i in range(1, 33)]
+      results = icmp_batch(addrs, count=2, period=0.01, deadline=2)
+      self.assertEqual(sorted(results), sorted(addrs))
+      for addr, result in results.items():
+         self.assertEqual((result['host'], result['sent'], result['received']),
+                          (addr, 2, 2))
+         self.assertGreaterEqual(float(result['minping']), 0)
+
+   def test_no_socket(self):
+      prober = ICMPProber()
+      loop   = asyncio.new_event_loop()
+      try:
+         with mock.patch.object(socket, "socket", no_icmp):
+            result = loop.run_until_complete(prober.ping("127.0.0.1"))
+      finally:
+         prober.close()
+         loop.close()
+      self.assertEqual((result['sent'], result['received']), (1, 0))
+
+class PollerFallbackTest(TempDirTestCase):
+
+   def poller(self):
+      return PLPoller(self.daemon, plslice="slice", user="user", 
+                      rawfile=self.raw(["node1.example.org"]),
+                      db_loc=self.db_loc, pingmode="icmp",
+                      historydir=self.dir, bundledir=self.dir)
+
+   def test_fallback(self):
+      with mock.patch.object(socket, "socket", no_icmp):
+         poller = self.poller()
+      self.assertEqual(poller.pingmode, "process")
+      self.assertTrue(any("ICMP" in m for m in self.daemon.messages))
+
+   @unittest.skipUnless(icmp_allowed(), "no ICMP socket allowed")
+   def test_icmp(self):
+      self.assertEqual(self.poller().pingmode, "icmp")
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,34 @@
+"""
+test_metrics.py
+
+@author: K.Edeline
+"""
+import unittest
+
+from deployer.metrics import PLMetrics
+
+class MetricsTest(unittest.TestCase):
+
+   def test_host_gauges(self):
+      metrics = PLMetrics()
+      cycle   = PLMetrics(parent=metrics)
+      for host, rtt in [("a.example.org", 0.01), ("b.example.org", 0.2)]:
+         cycle.observe("deploypl_ping_rtt_seconds", rtt)
+         cycle.set("deploypl_host_ping_rtt_seconds", rtt, host=host)
+      cycle.set("deploypl_host_ping_rtt_seconds", 0.05, host="a.example.org")
+
+      self.assertEqual(metrics.get("deploypl_host_ping_rtt_seconds", 
+                                   host="a.example.org"), 0.05)
+      self.assertEqual(metrics.get("deploypl_ping_rtt_seconds").count, 2)
+      self.assertIn('deploypl_host_ping_rtt_seconds{host="b.example.org"} 0.2',
+                    metrics.prometheus())
+
+      metrics.prune("deploypl_host_ping_rtt_seconds", "host", 
+                    {"a.example.org"})
+      self.assertIsNone(metrics.get("deploypl_host_ping_rtt_seconds", 
+                                    host="b.example.org"))
+      self.assertEqual(metrics.get("deploypl_host_ping_rtt_seconds", 
+                                   host="a.example.org"), 0.05)
+
+if __name__ == '__main__':
+   unittest.main()
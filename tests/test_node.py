@@ -0,0 +1,346 @@
+"""
+test_node.py
+
+@author: K.Edeline
+"""
+import os
+import unittest
+
+from datetime import datetime
+
+from sqlalchemy import text, event
+
+# declares the tables of NODE_TABLES
+import deployer.poller
+
+from deployer.node import PLNodePool, PLNodeStatus, PLNodeState, PLDNSEntry
+from deployer.node import NODE_TABLES, PLNodePoolException, session_scope
+from deployer.node import get_engine
+from deployer.control import PLControlServer
+
+from tests.util import TempDirTestCase
+
+class MergeTest(TempDirTestCase):
+
+   def pool(self, names, authority="PLE"):
+      return PLNodePool(self.daemon, rawfile=self.raw(names, authority),
+                        db_loc=self.db_loc)
+
+   def count(self, session, table, where):
+      return session.execute(text("SELECT count(*) FROM {} WHERE {}".format(
+                             table, where))).scalar()
+
+   def test_upsert(self):
+      names = ["node{}.example.org".format(i) for i in range(4)]
+      pool  = self.pool(names[:3])
+      node  = pool._find("name", names[0])
+      pool._update_node(node, {"state": PLNodeState.usable, 
+                               "kernel": "4.9"})
+      pool.update()
+
+      # one new node, one authority change, one removed node
+      path = os.path.join(self.dir, "raw-nodes.txt")
+      with open(path, 'w') as f:
+         f.write("{}\tPLE\tboot\t\t\n".format(names[0]))
+         f.write("{}\tPLC\tboot\t\t\n".format(names[1]))
+         f.write("{}\tPLE\tdisabled\t\t\n".format(names[2]))
+         f.write("{}\tPLC\tboot\t\t\n".format(names[3]))
+      pool = PLNodePool(self.daemon, rawfile=path, db_loc=self.db_loc)
+      self.assertEqual(sorted(n.name for n in pool.pool), 
+                       [names[0], names[1], names[3]])
+      self.assertEqual(pool._find("name", names[1]).authority, "PLC")
+      self.assertEqual(pool._find("name", names[3]).authority, "PLC")
+      # changes of nodes kept in the pool are kept
+      node = pool._find("name", names[0])
+      self.assertEqual((node.state, node.kernel, node.authority),
+                       (PLNodeState.usable, "4.9", "PLE"))
+
+      # written to the database
+      status = PLNodeStatus(self.daemon, db_loc=self.db_loc)
+      self.assertEqual(sorted(status._get("name")), 
+                       [names[0], names[1], names[3]])
+      self.assertEqual(dict(status.status()["authority"]), 
+                       {"PLE": 1, "PLC": 2})
+
+   def test_unchanged_file(self):
+      names = ["node1.example.org", "node2.example.org"]
+      path  = self.raw(names)
+      PLNodePool(self.daemon, rawfile=path, db_loc=self.db_loc)
+      PLNodePool(self.daemon, rawfile=path, db_loc=self.db_loc)
+      self.assertIn("raw nodes file unchanged", self.daemon.messages)
+
+      # same content, new mtime
+      st = os.stat(path)
+      os.utime(path, (st.st_atime, st.st_mtime + 10))
+      pool = PLNodePool(self.daemon, rawfile=path, db_loc=self.db_loc)
+      self.assertIn("raw nodes file content unchanged", self.daemon.messages)
+      self.assertEqual(sorted(n.name for n in pool.pool), names)
+
+   def test_removed_node_rows(self):
+      names = ["node1.example.org", "node2.example.org"]
+      pool  = self.pool(names)
+      ids   = {node.name : node.id for node in pool.pool}
+      now   = datetime.utcnow()
+      with session_scope(self.daemon, self.db_loc) as session:
+         for table in NODE_TABLES:
+            for i in ids.values():
+               session.execute(text("INSERT INTO {} (id) VALUES ({})".format(
+                                    table, i)))
+         session.execute(PLDNSEntry.__table__.insert(),
+                         [{"name": name, "addr": "10.0.0.1", "ttl": 3600,
+                           "resolved_at": now, "failures": 0} 
+                              for name in names])
+
+      pool = self.pool(names[:1])
+      self.assertEqual([node.name for node in pool.pool], names[:1])
+      self.assertIsNone(pool.dnscache.get(names[1]))
+      with session_scope(self.daemon, self.db_loc) as session:
+         for table in ["node"] + NODE_TABLES:
+            self.assertEqual(self.count(session, table, 
+                              "id = {}".format(ids[names[1]])), 0, table)
+            self.assertEqual(self.count(session, table, 
+                              "id = {}".format(ids[names[0]])), 1, table)
+         self.assertEqual(self.count(session, "dns", "name = '{}'".format(
+                                     names[1])), 0)
+         self.assertEqual(self.count(session, "dns", "name = '{}'".format(
+                                     names[0])), 1)
+
+class FlushTest(TempDirTestCase):
+
+   def setUp(self):
+      super(FlushTest, self).setUp()
+      names     = ["node{}.example.org".format(i) for i in range(5)]
+      self.pool = PLNodePool(self.daemon, rawfile=self.raw(names),
+                             db_loc=self.db_loc)
+      ## [(set columns, node id)] of each UPDATE node row
+      self.updates = []
+      def record(conn, cursor, statement, parameters, context, executemany):
+         if not statement.startswith("UPDATE node "):
+            return
+         columns = statement.split(" SET ")[1].split(" WHERE ")[0]
+         columns = frozenset(c.split("=")[0] for c in columns.split(", "))
+         rows    = parameters if executemany else [parameters]
+         self.updates.extend((columns, row[-1]) for row in rows)
+      self.engine = get_engine(self.db_loc)[0]
+      self.record = record
+      event.listen(self.engine, "before_cursor_execute", record)
+
+   def tearDown(self):
+      event.remove(self.engine, "before_cursor_execute", self.record)
+      super(FlushTest, self).tearDown()
+
+   def test_dirty_rows(self):
+      nodes = sorted(self.pool.pool, key=lambda n: n.name)
+      self.pool._update_node(nodes[0], {"kernel": "4.9"})
+      self.pool._update_node(nodes[1], {"kernel": "4.9", "vsys": True})
+      self.pool._update_node(nodes[1], {"kernel": "3.10"})
+      # no change
+      self.pool._update_node(nodes[2], {"kernel": nodes[2].kernel})
+      self.pool.update()
+
+      self.assertEqual(sorted(self.updates, key=lambda u: u[1]),
+                       sorted([(frozenset(["kernel"]), nodes[0].id),
+                               (frozenset(["kernel", "vsys"]), nodes[1].id)],
+                              key=lambda u: u[1]))
+      status = PLNodeStatus(self.daemon, db_loc=self.db_loc)
+      self.assertEqual(dict(status.status()["kernel"]),
+                       {"4.9": 1, "3.10": 1, nodes[2].kernel: 3})
+      self.assertEqual(self.pool.snapshot[nodes[1].id]["kernel"], "3.10")
+
+      # nothing left to write
+      del self.updates[:]
+      self.pool.update()
+      self.assertEqual(self.updates, [])
+
+class IndexTest(TempDirTestCase):
+
+   def pool(self, names):
+      return PLNodePool(self.daemon, rawfile=self.raw(names),
+                        db_loc=self.db_loc)
+
+   def assertIndexed(self, pool):
+      """
+      indexes hold the current id, addr and name of every node of pool
+      """
+      expected = {attribute : {} for attribute in PLNodePool.INDEXES}
+      for node in pool.pool:
+         for attribute, index in expected.items():
+            value = getattr(node, attribute)
+            if value is not None:
+               index.setdefault(value, []).append(node.id)
+      indexed = {attribute : {value : [node.id for node in nodes]
+                              for value, nodes in index.items()}
+                 for attribute, index in pool._index.items()}
+      self.assertEqual(indexed, expected)
+
+   def test_state_and_addr(self):
+      names = ["node{}.example.org".format(i) for i in range(4)]
+      pool  = self.pool(names)
+      for i, node in enumerate(pool.pool):
+         pool._update_node(node, {"addr": "10.0.0.{}".format(i)})
+      self.assertIndexed(pool)
+
+      node = pool._find("name", names[1])
+      pool._update_node(node, {"state": PLNodeState.usable})
+      self.assertIndexed(pool)
+
+      # the old address no longer finds it
+      old = node.addr
+      pool._update_node(node, {"addr": "10.0.1.1"})
+      self.assertIsNone(pool._find("addr", old))
+      self.assertIs(pool._find("addr", "10.0.1.1"), node)
+      self.assertIs(pool._find("id", node.id), node)
+      pool._set_node("10.0.1.1", "addr", None)
+      self.assertIsNone(pool._find("addr", "10.0.1.1"))
+      self.assertIndexed(pool)
+
+   def test_merge_and_removal(self):
+      names = ["node{}.example.org".format(i) for i in range(4)]
+      pool  = self.pool(names)
+      ids   = {node.name : node.id for node in pool.pool}
+
+      pool  = self.pool(names[1:] + ["node9.example.org"])
+      self.assertIndexed(pool)
+      self.assertIsNone(pool._find("name", names[0]))
+      self.assertIsNone(pool._find("id", ids[names[0]]))
+      self.assertEqual(pool._find("name", names[1]).id, ids[names[1]])
+      self.assertIsNotNone(pool._find("name", "node9.example.org"))
+
+class BucketTest(TempDirTestCase):
+
+   def pool(self, names):
+      return PLNodePool(self.daemon, rawfile=self.raw(names),
+                        db_loc=self.db_loc)
+
+   def assertBucketed(self, pool):
+      """
+      state buckets hold every node of pool under its current state
+      """
+      for state in PLNodeState:
+         self.assertEqual(sorted(pool._buckets[state]),
+                          sorted(n.id for n in pool.pool if n.state == state))
+         self.assertEqual(sorted(n.id for n in pool._filter_ge(state)),
+                          sorted(n.id for n in pool.pool if n.state >= state))
+
+   def test_state_changes(self):
+      names = ["node{}.example.org".format(i) for i in range(6)]
+      pool  = self.pool(names)
+      self.assertBucketed(pool)
+
+      states = [PLNodeState.usable, PLNodeState.accessible, 
+                PLNodeState.reachable]
+      pool._set("state", [states[i % 3] for i in range(len(pool.pool))])
+      self.assertBucketed(pool)
+
+      # only usable nodes, in bucket order
+      usable = pool._filter_eq(PLNodeState.usable)
+      pool._update_pool([{"state": PLNodeState.unreachable}] * len(usable),
+                        state=PLNodeState.usable)
+      self.assertEqual(pool._filter_eq(PLNodeState.usable), [])
+      self.assertBucketed(pool)
+
+      # unchanged state, address change
+      node = pool.pool[0]
+      pool._update_node(node, {"state": node.state, "addr": "10.0.0.1"})
+      self.assertBucketed(pool)
+      self.assertEqual(pool._get("addr", state=node.state).count("10.0.0.1"),
+                       1)
+
+   def test_merge_and_removal(self):
+      names = ["node{}.example.org".format(i) for i in range(4)]
+      pool  = self.pool(names)
+      for node in pool.pool:
+         pool._update_node(node, {"state": PLNodeState.usable})
+      pool.update()
+
+      # states are kept, removed nodes leave their bucket
+      pool = self.pool(names[2:] + ["node9.example.org"])
+      self.assertBucketed(pool)
+      self.assertEqual(sorted(n.name for n in 
+                              pool._filter_eq(PLNodeState.usable)), names[2:])
+      self.assertEqual([n.name for n in 
+                        pool._filter_eq(PLNodeState.unreachable)],
+                       ["node9.example.org"])
+
+class StatusTest(TempDirTestCase):
+
+   def test_ties(self):
+      names = ["node{}.example.org".format(i) for i in range(8)]
+      pool  = PLNodePool(self.daemon, rawfile=self.raw(names),
+                         db_loc=self.db_loc)
+      # every value of every column counted twice, kernel None included
+      states  = [PLNodeState.usable, PLNodeState.unreachable,
+                 PLNodeState.reachable, PLNodeState.accessible]
+      kernels = [None, "4.9", "3.10", "2.6"]
+      for i, node in enumerate(sorted(pool.pool, key=lambda n: n.name)):
+         pool._update_node(node, {"state": states[i % 4], 
+                                  "kernel": kernels[(i + 1) % 4],
+                                  "authority": ["PLE", "PLC"][i % 2],
+                                  "vsys": i % 2 == 0})
+      pool.update()
+
+      status = pool.status()
+      self.assertEqual(status, PLNodeStatus(self.daemon, 
+                                            db_loc=self.db_loc).status())
+      self.assertEqual(status["kernel"], [(None, 2), ("2.6", 2), ("3.10", 2),
+                                          ("4.9", 2)])
+      self.assertEqual([v for v, _ in status["state"]],
+                       sorted(states, key=lambda s: s.value))
+      self.assertEqual(status["vsys"], [(False, 4), (True, 4)])
+
+      control = PLControlServer(None, pool).status()["status"]
+      self.assertEqual(control["state"], [(s.value, n) 
+                                            for s, n in status["state"]])
+      self.assertEqual(control["kernel"], status["kernel"])
+
+class ReadOnlyTest(TempDirTestCase):
+
+   def pool(self):
+      names = ["node{}.example.org".format(i) for i in range(4)]
+      return PLNodePool(self.daemon, rawfile=self.raw(names),
+                        db_loc=self.db_loc)
+
+   def test_reader(self):
+      self.pool()
+      with session_scope(self.daemon, self.db_loc) as session:
+         mode = session.execute(text("PRAGMA journal_mode")).scalar()
+      self.assertEqual(mode, "wal")
+
+      status = PLNodeStatus(self.daemon, db_loc=self.db_loc)
+      self.assertEqual(dict(status.status()["state"]), 
+                       {PLNodeState.unreachable : 4})
+      # read-only sessions do not write
+      with self.assertRaises(PLNodePoolException):
+         with session_scope(self.daemon, self.db_loc, 
+                            readonly=True) as session:
+            session.execute(text("DELETE FROM node"))
+      self.assertEqual(status.status()["state"], 
+                       [(PLNodeState.unreachable, 4)])
+
+   def test_missing(self):
+      # reports the error, does not create the database
+      with self.assertRaises(PLNodePoolException) as cm:
+         PLNodeStatus(self.daemon, db_loc=self.db_loc)
+      self.assertIn("unable to open database file", str(cm.exception))
+      self.assertFalse(os.path.exists(self.db_loc))
+
+   @unittest.skipUnless(os.getuid() == 0, "needs root to switch user")
+   def test_unprivileged(self):
+      # the daemon keeps its writer connection open
+      self.pool()
+      os.chmod(self.dir, 0o755)
+      pid = os.fork()
+      if pid == 0:
+         try:
+            os.setgid(65534)
+            os.setuid(65534)
+            status = PLNodeStatus(self.daemon, db_loc=self.db_loc).status()
+            os._exit(0 if dict(status["state"]) == 
+                           {PLNodeState.unreachable : 4} else 1)
+         except BaseException:
+            os._exit(2)
+      _, code = os.waitpid(pid, 0)
+      self.assertEqual(code, 0)
+
+if __name__ == '__main__':
+   unittest.main()
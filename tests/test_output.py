@@ -0,0 +1,100 @@
+"""
+test_output.py
+
+   session output capture modes, against a fake ssh(1) that prints a
+   large known stdout and a short stderr
+
+@author: K.Edeline
+"""
+import os
+import stat
+import hashlib
+import unittest
+
+from deployer.ssh import SSHOutput, run_command
+
+from tests.util import TempDirTestCase
+
+FAKE_SSH = """#!/bin/sh
+seq 1 20000
+echo oops >&2
+"""
+
+EXPECTED = "".join("{}\n".format(i) for i in range(1, 20001))
+
+class OutputTest(TempDirTestCase):
+
+   def setUp(self):
+      super(OutputTest, self).setUp()
+      bindir = os.path.join(self.dir, "bin")
+      os.mkdir(bindir)
+      ssh = os.path.join(bindir, "ssh")
+      with open(ssh, 'w') as f:
+         f.write(FAKE_SSH)
+      os.chmod(ssh, os.stat(ssh).st_mode | stat.S_IEXEC)
+
+      self.environ = dict(os.environ)
+      os.environ["PATH"] = bindir+os.pathsep+os.environ["PATH"]
+
+   def tearDown(self):
+      os.environ.clear()
+      os.environ.update(self.environ)
+      super(OutputTest, self).tearDown()
+
+   def run_one(self, output):
+      results = run_command(["10.0.0.1"], "user", "true", output=output)
+      self.assertEqual(len(results), 1)
+      self.assertEqual(results[0]["status"], 0)
+      return results[0]
+
+   def test_full(self):
+      result = self.run_one(SSHOutput("full"))
+      self.assertEqual(result["stdout"], EXPECTED)
+      self.assertEqual(result["stderr"], "oops\n")
+      self.assertEqual(result["stdout_bytes"], len(EXPECTED))
+      self.assertFalse(result["truncated"])
+
+   def test_headtail(self):
+      result = self.run_one(SSHOutput("headtail", head=100, tail=50))
+      skipped = len(EXPECTED) - 150
+      self.assertEqual(result["stdout"], EXPECTED[:100]
+                       + "\n[... {} bytes ...]\n".format(skipped)
+                       + EXPECTED[-50:])
+      self.assertEqual(result["stdout_bytes"], len(EXPECTED))
+      # stderr fits
+      self.assertEqual(result["stderr"], "oops\n")
+      self.assertTrue(result["truncated"])
+
+   def test_spool(self):
+      spooldir = os.path.join(self.dir, "spool")
+      os.mkdir(spooldir)
+      output  = SSHOutput("spool", head=100, tail=50, spooldir=spooldir)
+      first   = self.run_one(output)
+      second  = self.run_one(output)
+
+      self.assertTrue(first["truncated"])
+      self.assertEqual(first["stdout"], second["stdout"])
+      # each session has its own files
+      paths = [first["stdout_path"], first["stderr_path"],
+               second["stdout_path"], second["stderr_path"]]
+      self.assertEqual(len(set(paths)), 4)
+      self.assertEqual(sorted(os.listdir(spooldir)),
+                       sorted(os.path.basename(p) for p in paths))
+      for result in [first, second]:
+         with open(result["stdout_path"]) as f:
+            self.assertEqual(f.read(), EXPECTED)
+         with open(result["stderr_path"]) as f:
+            self.assertEqual(f.read(), "oops\n")
+
+   def test_digest(self):
+      result = self.run_one(SSHOutput("digest"))
+      self.assertEqual(result["stdout"], "")
+      self.assertEqual(result["stdout_sha1"],
+                       hashlib.sha1(EXPECTED.encode('ascii')).hexdigest())
+      self.assertEqual(result["stdout_bytes"], len(EXPECTED))
+      self.assertEqual(result["stderr_sha1"],
+                       hashlib.sha1(b"oops\n").hexdigest())
+      self.assertTrue(result["truncated"])
+
+if __name__ == '__main__':
+   unittest.main()
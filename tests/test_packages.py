@@ -0,0 +1,49 @@
+"""
+test_packages.py
+
+@author: K.Edeline
+"""
+import unittest
+
+from datetime import datetime, timedelta
+
+from deployer.node import PLNode
+from deployer.packages import PLPackages, rpm_missing
+
+class PackagesTest(unittest.TestCase):
+
+   def setUp(self):
+      self.node     = PLNode("node1.example.org", "PLE")
+      self.packages = PLPackages()
+      self.now      = datetime(2026, 1, 1)
+
+   def test_rpm_missing(self):
+      stdout = ("python-2.7.5-1.x86_64\n"
+                "package tcpdump is not installed\n")
+      self.assertEqual(rpm_missing(["python", "tcpdump"], stdout), 
+                       {"tcpdump"})
+
+   def test_due(self):
+      pkgs = ["python", "tcpdump"]
+      self.assertTrue(self.packages.due(self.node, pkgs, 3600, now=self.now))
+
+      self.packages.record(self.node, {"python"}, {"tcpdump"}, now=self.now)
+      later = self.now + timedelta(seconds=60)
+      self.assertFalse(self.packages.due(self.node, pkgs, 3600, now=later))
+      # package list changed
+      self.assertTrue(self.packages.due(self.node, ["python"], 3600, 
+                                        now=later))
+      # period elapsed
+      later = self.now + timedelta(seconds=3600)
+      self.assertTrue(self.packages.due(self.node, pkgs, 3600, now=later))
+
+   def test_forget(self):
+      pkgs = ["python"]
+      self.packages.record(self.node, {"python"}, set(), now=self.now)
+      self.packages.forget(self.node)
+      self.assertTrue(self.packages.due(self.node, pkgs, 3600, now=self.now))
+      self.packages.record(self.node, {"python"}, set(), now=self.now)
+      self.assertFalse(self.packages.due(self.node, pkgs, 3600, now=self.now))
+
+if __name__ == '__main__':
+   unittest.main()
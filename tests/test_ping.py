@@ -0,0 +1,45 @@
+"""
+test_ping.py
+
+@author: K.Edeline
+"""
+import random
+import asyncio
+import unittest
+
+from deployer.ping import ping_pool, ping_failed
+
+class PingPoolTest(unittest.TestCase):
+
+   def run_pool(self, addrs, limit):
+      inflight, peak, results = [0], [0], []
+      async def prober(addr, **kwargs):
+         inflight[0] += 1
+         peak.append(inflight[0])
+         await asyncio.sleep(random.uniform(0, 0.01))
+         inflight[0] -= 1
+         return ping_failed(addr)
+      def callback(addr, result):
+         # probes in flight when this one completed
+         results.append((addr, result, inflight[0]))
+      ping_pool(addrs, callback, limit=limit, prober=prober)
+      return max(peak), results
+
+   def test_limit(self):
+      addrs = ["10.0.0.{}".format(i) for i in range(50)]
+      peak, results = self.run_pool(addrs, 5)
+      self.assertEqual(peak, 5)
+      self.assertEqual(sorted(addr for addr, _, _ in results), sorted(addrs))
+      self.assertTrue(all(result['host'] == addr 
+                             for addr, result, _ in results))
+      # window kept full until the last addresses are probed
+      for i, (_, _, inflight) in enumerate(results):
+         self.assertEqual(inflight, min(4, len(addrs) - i - 1))
+
+   def test_fewer_addrs(self):
+      peak, results = self.run_pool(["10.0.0.1", "10.0.0.2"], 100)
+      self.assertEqual(peak, 2)
+      self.assertEqual(len(results), 2)
+
+if __name__ == '__main__':
+   unittest.main()
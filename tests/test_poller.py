@@ -0,0 +1,58 @@
+"""
+test_poller.py
+
+@author: K.Edeline
+"""
+import os
+import unittest
+
+from datetime import datetime
+
+from deployer.poller import PLPoller
+from deployer.resolver import DNSAnswer
+
+from tests.util import TempDirTestCase
+
+class NXDomainPoller(PLPoller):
+   """
+   poller whose DNS refresh finds that no name exists
+   """
+
+   async def refresh_dns(self, intensity=100):
+      names = self.dnscache.due([node.name for node in self.pool])
+      for name in names:
+         self.dnscache.record(name, DNSAnswer(None, None, "nxdomain"))
+      return len(names)
+
+class PollerTest(TempDirTestCase):
+
+   def poller(self, names, **kwargs):
+      return NXDomainPoller(self.daemon, rawfile=self.raw(names),
+                            db_loc=self.db_loc, plslice="slice", user="user",
+                            historydir=os.path.join(self.dir, "history"),
+                            bundledir=os.path.join(self.dir, "bundles"),
+                            **kwargs)
+
+   def test_unresolved_node_backoff(self):
+      poller = self.poller(["nx.example.org"], period=86400)
+      node   = poller.pool[0]
+      self.assertEqual(poller.scheduler.due(poller.pool), [node])
+
+      poller.poll()
+      self.assertIsNone(node.addr)
+      # not due again before its DNS entry expires
+      self.assertEqual(poller.scheduler.due(poller.pool), [])
+      self.assertGreaterEqual(poller.sleep_time(), poller.scheduler.minperiod)
+      expiry = poller.dnscache.expiry(node.name)
+      self.assertEqual(poller.scheduler.due(poller.pool, now=expiry), [node])
+
+   def test_unresolved_node_backoff_persists(self):
+      poller = self.poller(["nx.example.org"], period=86400)
+      poller.poll()
+      poller = self.poller(["nx.example.org"], period=86400)
+      self.assertEqual(poller.scheduler.due(poller.pool), [])
+      self.assertGreater(poller.scheduler.next_probe(poller.pool),
+                         datetime.utcnow())
+
+if __name__ == '__main__':
+   unittest.main()
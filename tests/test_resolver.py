@@ -0,0 +1,170 @@
+"""
+test_resolver.py
+
+   AsyncResolver against a stub DNS server on the loopback, UDP and TCP
+   on the same port
+
+@author: K.Edeline
+"""
+import socket
+import struct
+import threading
+import unittest
+
+from deployer.resolver import AsyncResolver, DNSAnswer, FLAG_TC, _read_name
+
+## name -> ("A", addr) | ("CNAME", target) | "NX" | "DROP" | "TC",
+## "TC" names get a truncated UDP answer and their TCP_ZONE answer
+ZONE = {
+   "a.test"    : ("A", "10.1.1.1"),
+   "c1.test"   : ("CNAME", "c2.test"),
+   "c2.test"   : ("CNAME", "a.test"),
+   "far.test"  : ("CNAME", "b.test"),
+   "b.test"    : ("A", "10.2.2.2"),
+   "loop.test" : ("CNAME", "loop2.test"),
+   "loop2.test": ("CNAME", "loop.test"),
+   "nx.test"   : "NX",
+   "drop.test" : "DROP",
+   "big.test"  : "TC",
+   "tcpnx.test": "TC",
+   "tcpfail.test": "TC",
+}
+TCP_ZONE = {
+   "big.test"  : ("A", "10.3.3.3"),
+   "tcpnx.test": "NX",
+   # connection closed without an answer
+   "tcpfail.test": "DROP",
+}
+
+def encode(name):
+   return b"".join(bytes([len(label)]) + label 
+                   for label in name.encode().split(b".")) + b"\0"
+
+def answer(query, zone):
+   """
+   @return the response to query, None if it is dropped
+   """
+   qid          = struct.unpack_from("!H", query)[0]
+   name, offset = _read_name(query, 12)
+   question     = query[12:offset + 4]
+   entry        = zone.get(name, "NX")
+   if entry == "DROP":
+      return None
+   if entry == "NX":
+      return struct.pack("!HHHHHH", qid, 0x8183, 1, 0, 0, 0) + question
+   if entry == "TC":
+      return struct.pack("!HHHHHH", qid, 0x8180 | FLAG_TC, 1, 0, 0, 0) \
+               + question
+
+   # whole chain in the answer section, except for far.test
+   records, count = b"", 0
+   while True:
+      kind, value = zone[name]
+      if kind == "A":
+         records += encode(name) + struct.pack("!HHIH", 1, 1, 300, 4) \
+                      + socket.inet_aton(value)
+         count   += 1
+         break
+      target   = encode(value)
+      records += encode(name) + struct.pack("!HHIH", 5, 1, 60, 
+                                            len(target)) + target
+      count   += 1
+      if name == "far.test":
+         break
+      name = value
+      if count > 16:
+         break
+   return struct.pack("!HHHHHH", qid, 0x8180, 1, count, 0, 0) \
+            + question + records
+
+class StubDNS(object):
+   """
+   StubDNS
+
+      answers ZONE over UDP and TCP_ZONE over TCP
+   """
+
+   def __init__(self):
+      while True:
+         self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+         self.udp.bind(("127.0.0.1", 0))
+         self.port = self.udp.getsockname()[1]
+         self.tcp  = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+         try:
+            self.tcp.bind(("127.0.0.1", self.port))
+            break
+         except OSError:
+            self.udp.close()
+            self.tcp.close()
+      self.tcp.listen(16)
+      self.tcp_queries = []
+      for target in [self._serve_udp, self._serve_tcp]:
+         threading.Thread(target=target, daemon=True).start()
+
+   def close(self):
+      self.udp.close()
+      self.tcp.close()
+
+   def _serve_udp(self):
+      while True:
+         try:
+            query, addr = self.udp.recvfrom(512)
+         except OSError:
+            return
+         response = answer(query, ZONE)
+         if response is not None:
+            self.udp.sendto(response, addr)
+
+   def _serve_tcp(self):
+      while True:
+         try:
+            conn, _ = self.tcp.accept()
+         except OSError:
+            return
+         with conn:
+            length = struct.unpack("!H", conn.recv(2))[0]
+            query  = b""
+            while len(query) < length:
+               query += conn.recv(length - len(query))
+            self.tcp_queries.append(_read_name(query, 12)[0])
+            response = answer(query, TCP_ZONE)
+            if response is not None:
+               conn.sendall(struct.pack("!H", len(response)) + response)
+
+class ResolverTest(unittest.TestCase):
+
+   def setUp(self):
+      self.server = StubDNS()
+
+   def tearDown(self):
+      self.server.close()
+
+   def resolve(self, names):
+      return AsyncResolver(names, servers=["127.0.0.1"], port=self.server.port,
+                           timeout=0.3, retries=1).resolve()
+
+   def test_answers(self):
+      answers = self.resolve(["a.test", "c1.test", "far.test", "loop.test",
+                              "nx.test", "drop.test", "1.2.3.4"])
+      self.assertEqual(answers["a.test"], DNSAnswer("10.1.1.1", 300, "ok"))
+      # lowest ttl of the chain
+      self.assertEqual(answers["c1.test"], DNSAnswer("10.1.1.1", 60, "ok"))
+      self.assertEqual(answers["far.test"], DNSAnswer("10.2.2.2", 60, "ok"))
+      self.assertEqual(answers["loop.test"].status, "error")
+      self.assertEqual(answers["nx.test"], DNSAnswer(None, None, "nxdomain"))
+      self.assertEqual(answers["drop.test"], DNSAnswer(None, None, "timeout"))
+      self.assertEqual(answers["1.2.3.4"], DNSAnswer("1.2.3.4", 0, "ok"))
+      self.assertEqual(self.server.tcp_queries, [])
+
+   def test_truncated(self):
+      answers = self.resolve(["big.test", "tcpnx.test", "tcpfail.test"])
+      self.assertEqual(answers["big.test"], DNSAnswer("10.3.3.3", 300, "ok"))
+      self.assertEqual(answers["tcpnx.test"], 
+                       DNSAnswer(None, None, "nxdomain"))
+      # never taken for an empty answer
+      self.assertEqual(answers["tcpfail.test"], 
+                       DNSAnswer(None, None, "timeout"))
+      self.assertIn("big.test", self.server.tcp_queries)
+
+if __name__ == '__main__':
+   unittest.main()
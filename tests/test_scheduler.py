@@ -0,0 +1,78 @@
+"""
+test_scheduler.py
+
+@author: K.Edeline
+"""
+import unittest
+
+from datetime import datetime, timedelta
+
+from deployer.node import PLNode, PLNodeState, session_scope
+from deployer.scheduler import PLScheduler
+
+from tests.util import TempDirTestCase
+
+NOW = datetime(2026, 1, 1)
+
+def node(i, state=PLNodeState.usable):
+   n = PLNode("node{}.example.org".format(i), "PLE")
+   n.state = state
+   return n
+
+class SchedulerTest(TempDirTestCase):
+
+   def setUp(self):
+      super(SchedulerTest, self).setUp()
+      self.scheduler = PLScheduler(period=3600, minperiod=600, 
+                                   maxperiod=86400)
+
+   def test_due(self):
+      pool = [node(i) for i in range(3)]
+      self.assertEqual(self.scheduler.due(pool, now=NOW), pool)
+      self.scheduler.record(pool[0], now=NOW)
+      self.assertEqual(self.scheduler.due(pool, now=NOW), pool[1:])
+      later = NOW + timedelta(seconds=3600)
+      self.assertEqual(self.scheduler.due(pool, now=later), pool)
+
+   def test_next_probe(self):
+      pool = [node(i) for i in range(2)]
+      # nodes never probed are due now
+      self.scheduler.record(pool[0], now=NOW)
+      self.assertGreater(self.scheduler.next_probe(pool), NOW)
+      self.scheduler.record(pool[1], now=NOW - timedelta(seconds=600))
+      self.assertEqual(self.scheduler.next_probe(pool), 
+                       NOW + timedelta(seconds=3000))
+      self.assertEqual(self.scheduler.next_probe(pool[:1]),
+                       NOW + timedelta(seconds=3600))
+
+   def test_backoff(self):
+      dead = node(1, PLNodeState.unreachable)
+      intervals = []
+      for i in range(6):
+         self.scheduler.record(dead, now=NOW)
+         intervals.append(self.scheduler._entries[dead.id].interval)
+      self.assertEqual(intervals, [3600, 7200, 14400, 28800, 57600, 86400])
+
+   def test_flapping(self):
+      flapping = node(1)
+      for i in range(4):
+         flapping.state = [PLNodeState.usable, PLNodeState.unreachable][i % 2]
+         self.scheduler.record(flapping, now=NOW)
+      entry = self.scheduler._entries[flapping.id]
+      self.assertGreaterEqual(entry.flaps, PLScheduler.FLAP_THRESHOLD)
+      self.assertLess(entry.interval, 3600)
+      self.assertGreaterEqual(entry.interval, 600)
+
+   def test_save_load(self):
+      pool = [node(i) for i in range(2)]
+      self.scheduler.record(pool[0], now=NOW)
+      self.scheduler.save(self.daemon, self.db_loc)
+      loaded = PLScheduler(period=3600, minperiod=600, maxperiod=86400)
+      with session_scope(self.daemon, self.db_loc) as session:
+         loaded.load(session)
+      self.assertEqual(loaded.due(pool, now=NOW), pool[1:])
+      self.assertEqual(loaded._entries[pool[0].id].next_probe,
+                       NOW + timedelta(seconds=3600))
+
+if __name__ == '__main__':
+   unittest.main()
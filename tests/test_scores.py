@@ -0,0 +1,117 @@
+"""
+test_scores.py
+
+   rolling node scores and rankings
+
+@author: K.Edeline
+"""
+import random
+import unittest
+
+from deployer.node import PLNodePool, PLNodeState, PLNodeStatus
+from deployer.node import session_scope
+from deployer.scores import PLScores, top_scores
+
+from tests.util import TempDirTestCase
+
+def ping(rtt, sent=4, received=4, jitter=None):
+   return {"sent": sent, "received": received, "avgping": rtt,
+           "jitter": jitter}
+
+class ScoresTest(TempDirTestCase):
+
+   def setUp(self):
+      super(ScoresTest, self).setUp()
+      names      = ["node{}.example.org".format(i) for i in range(6)]
+      self.pool  = PLNodePool(self.daemon, rawfile=self.raw(names),
+                              db_loc=self.db_loc)
+      self.nodes = sorted(self.pool.pool, key=lambda n: n.name)
+
+   def test_ewma(self):
+      scores = PLScores()
+      node   = self.nodes[0]
+      scores.record(node, ping(10.0, jitter=1.0), PLNodeState.usable)
+      entry  = scores._entries[node.id]
+      self.assertEqual((entry.rtt, entry.jitter, entry.loss,
+                        entry.availability, entry.probes),
+                       (10.0, 1.0, 0.0, 1.0, 1))
+
+      scores.record(node, ping(20.0, received=2, jitter=3.0),
+                    PLNodeState.reachable)
+      self.assertAlmostEqual(entry.rtt, 0.8 * 10 + 0.2 * 20)
+      self.assertAlmostEqual(entry.jitter, 0.8 * 1 + 0.2 * 3)
+      self.assertAlmostEqual(entry.loss, 0.2 * 0.5)
+      self.assertAlmostEqual(entry.availability, 0.8)
+      self.assertEqual(entry.probes, 2)
+
+      # not pinged, or no reply: only availability changes
+      rtt, loss = entry.rtt, entry.loss
+      scores.record(node, None, PLNodeState.unreachable)
+      scores.record(node, ping("nan", sent=0, received=0),
+                    PLNodeState.unreachable)
+      self.assertEqual((entry.rtt, entry.loss), (rtt, loss))
+      self.assertAlmostEqual(entry.availability, 0.8 * 0.8 * 0.8)
+      self.assertEqual(entry.probes, 4)
+      self.assertEqual(scores.rtt(node), rtt)
+      self.assertIsNone(scores.rtt(self.nodes[1]))
+
+   def test_ranking(self):
+      scores = PLScores()
+      a, b, c, d, e, _ = self.nodes
+      scores.record(a, ping(50.0), PLNodeState.usable)
+      scores.record(b, ping(10.0), PLNodeState.reachable)
+      scores.record(c, ping(30.0), PLNodeState.usable)
+      scores.record(d, None, PLNodeState.usable)
+      scores.record(e, ping(10.0), PLNodeState.reachable)
+      scores.save(self.daemon, self.db_loc)
+
+      # ties by id
+      b, e = sorted([b, e], key=lambda n: n.id)
+      self.assertEqual([i for i, _ in scores.ranking["rtt"]],
+                       [n.id for n in [b, e, c, a, d]])
+      self.assertEqual([i for i, _ in scores.ranking["availability"]],
+                       [n.id for n in [c, a, d, b, e]])
+      self.assertEqual(scores.rank(self.nodes, sort="rtt")[:3], [b, e, c])
+      # unscored nodes last
+      self.assertEqual(scores.rank(self.nodes)[-1], self.nodes[-1])
+
+      # the database fallback orders nodes the same way
+      status = PLNodeStatus(self.daemon, db_loc=self.db_loc)
+      for sort in ["rtt", "availability"]:
+         self.assertEqual([row["id"] for row in status.top(n=5, sort=sort)],
+                          [i for i, _ in scores.ranking[sort]])
+      self.assertEqual(len(status.top(n=2)), 2)
+
+   def test_incremental(self):
+      # rankings merged with changed scores equal a full sort
+      scores = PLScores()
+      rand   = random.Random(4)
+      for _ in range(20):
+         for node in rand.sample(self.nodes, 3):
+            rtt = rand.choice([None, 10.0, 20.0, 30.0])
+            scores.record(node, ping(rtt) if rtt else None,
+                          rand.choice(list(PLNodeState)))
+         scores.save(self.daemon, self.db_loc)
+         ranking = scores.ranking
+         scores._rank()
+         self.assertEqual(ranking, scores.ranking)
+
+   def test_save_and_load(self):
+      scores = PLScores()
+      for i, node in enumerate(self.nodes[:3]):
+         scores.record(node, ping(10.0 * (i + 1)), PLNodeState.usable)
+      scores.save(self.daemon, self.db_loc)
+      # nothing changed, nothing written
+      ranking = scores.ranking
+      scores.save(self.daemon, self.db_loc)
+      self.assertIs(scores.ranking, ranking)
+
+      loaded = PLScores()
+      with session_scope(self.daemon, self.db_loc) as session:
+         loaded.load(session)
+         rows = top_scores(session, n=10, sort="rtt")
+      self.assertEqual(loaded.ranking, scores.ranking)
+      self.assertEqual([row["rtt"] for row in rows], [10.0, 20.0, 30.0])
+
+if __name__ == '__main__':
+   unittest.main()
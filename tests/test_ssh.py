@@ -0,0 +1,167 @@
+"""
+test_ssh.py
+
+   ssh executor and master pool, against a fake ssh(1) that runs no 
+   command and logs sessions and master connections
+
+@author: K.Edeline
+"""
+import os
+import stat
+import asyncio
+import unittest
+
+from deployer.ssh import SSHMasterPool, run_command, run_command_async
+
+from tests.util import TempDirTestCase
+
+FAKE_SSH = """#!/bin/sh
+host=""; control=""; master=""; path=""
+while [ $# -gt 0 ]; do
+   case "$1" in
+      -O) shift; control="$1" ;;
+      -fN) master=1 ;;
+      -o) shift
+          case "$1" in ControlPath=*) path="${1#ControlPath=}" ;; esac ;;
+      -l|-i|-p) shift ;;
+      -*) ;;
+      *) [ -z "$host" ] && host="$1" ;;
+   esac
+   shift
+done
+case "$control" in
+   check) echo "check $host" >> "$FAKE_SSH_LOG"; [ -e "$path" ]; exit $? ;;
+   exit|stop) rm -f "$path"; echo "exit $host" >> "$FAKE_SSH_LOG"; exit 0 ;;
+esac
+if [ -n "$master" ]; then
+   : > "$path"; echo "master $host" >> "$FAKE_SSH_LOG"; exit 0
+fi
+if [ -n "$path" ] && [ -e "$path" ]; then
+   echo "mux $host" >> "$FAKE_SSH_LOG"
+else
+   echo "direct $host" >> "$FAKE_SSH_LOG"
+fi
+sleep 0.05
+exit ${FAKE_SSH_STATUS:-0}
+"""
+
+class SSHTestCase(TempDirTestCase):
+   """
+   test case with the fake ssh first in PATH
+   """
+
+   def setUp(self):
+      super(SSHTestCase, self).setUp()
+      bindir = os.path.join(self.dir, "bin")
+      os.mkdir(bindir)
+      ssh = os.path.join(bindir, "ssh")
+      with open(ssh, 'w') as f:
+         f.write(FAKE_SSH)
+      os.chmod(ssh, os.stat(ssh).st_mode | stat.S_IEXEC)
+
+      self.log     = os.path.join(self.dir, "ssh.log")
+      self.environ = dict(os.environ)
+      os.environ["PATH"]         = bindir+os.pathsep+os.environ["PATH"]
+      os.environ["FAKE_SSH_LOG"] = self.log
+      self.masters = SSHMasterPool(controldir=os.path.join(self.dir, "ctl"),
+                                   limit=2)
+      os.mkdir(self.masters.controldir)
+
+   def tearDown(self):
+      os.environ.clear()
+      os.environ.update(self.environ)
+      super(SSHTestCase, self).tearDown()
+
+   def events(self):
+      with open(self.log) as f:
+         return [line.split() for line in f]
+
+class MasterPoolTest(SSHTestCase):
+
+   def test_limit(self):
+      hosts   = ["10.0.0.{}".format(i) for i in range(10)]
+      results = run_command(hosts, "user", "true", threads=3, 
+                            masters=self.masters)
+      self.assertEqual(sorted(r['host'] for r in results), sorted(hosts))
+      self.assertTrue(all(r['status'] == 0 for r in results))
+
+      # never more than limit masters open, each host has one session
+      live, peak, sessions = set(), 0, []
+      for event, host in self.events():
+         if event == "master":
+            live.add(host)
+         elif event == "exit":
+            live.discard(host)
+         else:
+            sessions.append(host)
+         peak = max(peak, len(live))
+      self.assertLessEqual(peak, 2)
+      self.assertEqual(sorted(sessions), sorted(hosts))
+      self.assertLessEqual(len(self.masters._masters), 2)
+
+   def run_one(self, loop, status=0):
+      result = loop.run_until_complete(run_command_async("10.0.0.1", "user",
+                                       "true", masters=self.masters))
+      self.assertEqual(result["status"], status)
+
+   def test_reuse_and_check(self):
+      self.masters.recheck = 0
+      loop = asyncio.new_event_loop()
+      try:
+         self.run_one(loop)
+         self.run_one(loop)
+         # master died
+         os.remove(self.masters.path("10.0.0.1", "user"))
+         self.run_one(loop)
+      finally:
+         loop.close()
+      self.assertEqual(self.events(), [["master", "10.0.0.1"], 
+                                       ["mux", "10.0.0.1"],
+                                       ["check", "10.0.0.1"],
+                                       ["mux", "10.0.0.1"],
+                                       ["check", "10.0.0.1"],
+                                       ["master", "10.0.0.1"], 
+                                       ["mux", "10.0.0.1"]])
+      self.assertEqual(dict(self.masters._sessions), {})
+
+   def test_recent(self):
+      # no check of a master used moments ago
+      loop = asyncio.new_event_loop()
+      try:
+         for _ in range(3):
+            self.run_one(loop)
+      finally:
+         loop.close()
+      self.assertEqual(self.events(), [["master", "10.0.0.1"]] 
+                                      + [["mux", "10.0.0.1"]] * 3)
+
+   def test_evict(self):
+      loop = asyncio.new_event_loop()
+      try:
+         self.run_one(loop)
+         # the session fails to connect, its master is replaced
+         os.environ["FAKE_SSH_STATUS"] = "255"
+         self.run_one(loop, status=255)
+         del os.environ["FAKE_SSH_STATUS"]
+         self.run_one(loop)
+      finally:
+         loop.close()
+      events = self.events()
+      self.assertEqual([e for e in events if e[0] != "exit"],
+                       [["master", "10.0.0.1"], ["mux", "10.0.0.1"],
+                        ["mux", "10.0.0.1"], ["master", "10.0.0.1"],
+                        ["mux", "10.0.0.1"]])
+      self.assertIn(["exit", "10.0.0.1"], events)
+
+   def test_close(self):
+      self.masters = SSHMasterPool(limit=2)
+      controldir   = self.masters.controldir
+      hosts = ["10.0.0.{}".format(i) for i in range(2)]
+      run_command(hosts, "user", "true", masters=self.masters)
+      self.masters.close()
+      self.assertEqual(sorted(e for e in self.events() if e[0] == "exit"),
+                       [["exit", host] for host in hosts])
+      self.assertFalse(os.path.exists(controldir))
+
+if __name__ == '__main__':
+   unittest.main()
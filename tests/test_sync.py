@@ -0,0 +1,127 @@
+"""
+test_sync.py
+
+@author: K.Edeline
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from datetime import datetime, timedelta
+
+from deployer.node import PLNode
+from deployer.bundle import PLBundleCache
+from deployer.sync import PLSync, MARKER, SYNC_MISMATCH
+from deployer.sync import scan_manifest, manifest_digest, diff
+from deployer.sync import write_bundle, sync_command
+
+class SyncCommandTest(unittest.TestCase):
+   """
+   runs sync command lines in a local stand-in of the login directory
+   """
+
+   def setUp(self):
+      self.dir    = tempfile.mkdtemp(prefix="deploypl-test-")
+      self.local  = os.path.join(self.dir, "local", "exp")
+      self.home   = os.path.join(self.dir, "home")
+      os.makedirs(os.path.join(self.local, "sub"))
+      os.makedirs(self.home)
+      self.write("a.txt", "a")
+      self.write("sub/b.txt", "b")
+
+   def tearDown(self):
+      shutil.rmtree(self.dir, ignore_errors=True)
+
+   def write(self, path, data, root=None):
+      path = os.path.join(root or self.local, path)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(path, 'w') as f:
+         f.write(data)
+
+   def run_sync(self, cmd, bundle=None):
+      with open(bundle or os.devnull, 'rb') as stdin:
+         return subprocess.call(["sh", "-c", cmd], cwd=self.home, 
+                                stdin=stdin)
+
+   def remote(self):
+      return scan_manifest(os.path.join(self.home, "exp"))
+
+   def marker(self):
+      with open(os.path.join(self.home, "exp", MARKER)) as f:
+         return f.read().strip()
+
+   def full(self):
+      manifest = scan_manifest(self.local)
+      digest   = manifest_digest(manifest)
+      bundle   = PLBundleCache(os.path.join(self.dir, "cache")).get(
+                                                               [self.local])
+      status   = self.run_sync(sync_command("exp", digest), bundle)
+      return status, manifest, digest
+
+   def test_full_removes_stale_files(self):
+      self.write("exp/stale.txt", "old", root=self.home)
+      self.write("exp/sub/stale.txt", "old", root=self.home)
+      status, manifest, digest = self.full()
+      self.assertEqual(status, 0)
+      self.assertEqual(self.remote(), manifest)
+      self.assertEqual(self.marker(), digest)
+      self.assertFalse(os.path.exists(os.path.join(self.home,
+                                                   "exp.deploypl-files")))
+
+   def test_full_from_copied_bundle(self):
+      manifest = scan_manifest(self.local)
+      digest   = manifest_digest(manifest)
+      bundle   = PLBundleCache(os.path.join(self.dir, "cache")).get(
+                                                               [self.local])
+      shutil.copy(bundle, os.path.join(self.home, ".deploypl-bundle"))
+      cmd = sync_command("exp", digest, bundle=".deploypl-bundle")
+      self.assertEqual(self.run_sync(cmd), 0)
+      self.assertEqual(self.remote(), manifest)
+      self.assertEqual(self.marker(), digest)
+      self.assertFalse(os.path.exists(os.path.join(self.home,
+                                                   ".deploypl-bundle")))
+
+   def test_delta(self):
+      _, old, base = self.full()
+      self.write("a.txt", "changed")
+      os.remove(os.path.join(self.local, "sub", "b.txt"))
+      manifest = scan_manifest(self.local)
+      digest   = manifest_digest(manifest)
+      changed, removed = diff(old, manifest)
+      self.assertEqual((changed, removed), (["a.txt"], ["sub/b.txt"]))
+
+      bundle = os.path.join(self.dir, "delta.tar.gz")
+      write_bundle(self.local, changed, bundle)
+      cmd = sync_command("exp", digest, base=base, removed=removed)
+      self.assertEqual(self.run_sync(cmd, bundle), 0)
+      self.assertEqual(self.remote(), manifest)
+      self.assertEqual(self.marker(), digest)
+
+      # up to date
+      cmd = sync_command("exp", digest, base=digest)
+      self.assertEqual(self.run_sync(cmd), 0)
+      # marker of another manifest
+      cmd = sync_command("exp", digest, base=base)
+      self.assertEqual(self.run_sync(cmd), SYNC_MISMATCH)
+
+class PLSyncTest(unittest.TestCase):
+
+   def test_due(self):
+      node = PLNode("node1.example.org", "PLE")
+      sync = PLSync()
+      now  = datetime(2026, 1, 1)
+      self.assertTrue(sync.due(node, "exp", "d1", 3600, now=now))
+      sync.record(node, "exp", "d1", {}, now=now)
+      later = now + timedelta(seconds=60)
+      self.assertFalse(sync.due(node, "exp", "d1", 3600, now=later))
+      self.assertTrue(sync.due(node, "exp", "d2", 3600, now=later))
+      self.assertTrue(sync.due(node, "other", "d1", 3600, now=later))
+      self.assertTrue(sync.due(node, "exp", "d1", 3600, 
+                               now=now + timedelta(seconds=3600)))
+      sync.forget(node)
+      self.assertTrue(sync.due(node, "exp", "d1", 3600, now=later))
+
+if __name__ == '__main__':
+   unittest.main()
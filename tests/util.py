@@ -0,0 +1,65 @@
+"""
+util.py
+
+   Test helpers: a daemon stand-in and throwaway node pools
+
+@author: K.Edeline
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+class TestDaemon(object):
+   """
+   TestDaemon
+
+      the daemon interface used by the node pool, keeps log messages
+   """
+   sshkeyloc = None
+
+   def __init__(self):
+      self.messages = []
+
+   def _log(self, msg):
+      self.messages.append(msg)
+
+   debug = info = warn = error = _log
+
+   def root(self):
+      pass
+
+   def drop_privileges(self):
+      pass
+
+def write_raw(path, names, authority="PLE"):
+   """
+   write a raw-nodes file of nodes in boot state
+   """
+   with open(path, 'w') as f:
+      for name in names:
+         f.write("{}\t{}\tboot\t\t\n".format(name, authority))
+
+class TempDirTestCase(unittest.TestCase):
+   """
+   TempDirTestCase
+
+      test case with a fresh directory and database location in self.dir
+      and self.db_loc
+   """
+
+   def setUp(self):
+      self.dir    = tempfile.mkdtemp(prefix="deploypl-test-")
+      self.db_loc = os.path.join(self.dir, "deploypl.sqlite")
+      self.daemon = TestDaemon()
+
+   def tearDown(self):
+      shutil.rmtree(self.dir, ignore_errors=True)
+
+   def raw(self, names, authority="PLE"):
+      """
+      @return the path of a raw-nodes file of names
+      """
+      path = os.path.join(self.dir, "raw-nodes.txt")
+      write_raw(path, names, authority=authority)
+      return path